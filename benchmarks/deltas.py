@@ -0,0 +1,91 @@
+"""
+Storage and throughput of the full and the delta log encoding on an
+update heavy workload: replay speed, stored attribute bytes, database
+file size and the time of the reads reconstructing the attributes
+
+usage: python -m benchmarks.deltas [--logs 100000] [--updates-per-user 20] [--interval 16]
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from benchmarks.replay import generate_logs
+
+# logs replayed per request
+CHUNK_SIZE = 10000
+# users whose logs are read by the per user reads
+SAMPLED_USERS = 200
+
+
+def measure(encoding, interval, logs, directory):
+    """
+    Gives the results of one encoding and the body of its export
+    """
+    from service import db
+    from service.app import create_app
+    from service.rebuild import rebuild_users
+    path = os.path.join(directory, encoding + '.sqlite3')
+    app = create_app(config={
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + path, 'LOG_LEVEL': 'WARNING',
+        'LOG_ENCODING': encoding, 'LOG_KEYFRAME_INTERVAL': interval, 'LIST_MAX_ROWS': len(logs),
+    })
+    client = app.test_client()
+    result = {}
+
+    started = time.perf_counter()
+    for start in range(0, len(logs), CHUNK_SIZE):
+        response = client.post('/logs/replay', json={'logs': logs[start:start + CHUNK_SIZE]})
+        assert response.status_code == 204, response.get_data()
+    result['replay logs/s'] = len(logs) / (time.perf_counter() - started)
+
+    with app.app_context():
+        result['stored MB'] = db.session.execute(
+            'SELECT sum(length(attributes)) FROM ActivityLog').scalar() / 1e6
+        result['deltas'] = db.session.execute(
+            'SELECT count(*) FROM ActivityLog WHERE base_id IS NOT NULL').scalar()
+        db.session.commit()
+        db.session.execute('VACUUM')
+    result['file MB'] = os.path.getsize(path) / 1e6
+
+    started = time.perf_counter()
+    export = client.get('/logs/export').get_data()
+    result['export s'] = time.perf_counter() - started
+
+    user_ids = random.Random(0).sample(sorted({log['user_id'] for log in logs}), SAMPLED_USERS)
+    started = time.perf_counter()
+    for user_id in user_ids:
+        client.get('/logs/user/' + user_id).get_data()
+    result['user logs ms'] = (time.perf_counter() - started) / len(user_ids) * 1000
+
+    with app.app_context():
+        started = time.perf_counter()
+        rebuild_users(app.config['ARCHIVE_DIR'])
+        result['rebuild s'] = time.perf_counter() - started
+        db.session.rollback()
+    return result, export
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--logs', type=int, default=100000)
+    parser.add_argument('--updates-per-user', type=int, default=20)
+    parser.add_argument('--interval', type=int, default=16, help='LOG_KEYFRAME_INTERVAL of the delta encoding')
+    args = parser.parse_args()
+
+    logs = generate_logs(args.logs, args.updates_per_user)
+    directory = tempfile.mkdtemp()
+    results, exports = {}, {}
+    for encoding in ('full', 'delta'):
+        results[encoding], exports[encoding] = measure(encoding, args.interval, logs, directory)
+    assert exports['full'] == exports['delta'], 'exports differ'
+
+    metrics = list(results['full'])
+    print('{:<16} {:>12} {:>12}'.format('', 'full', 'delta'))
+    for metric in metrics:
+        print('{:<16} {:>12.2f} {:>12.2f}'.format(metric, results['full'][metric], results['delta'][metric]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""
+Write throughput of concurrent POST /users with and without group commit
+
+usage: python -m benchmarks.group_commit [--threads 1 8 32] [--requests 200]
+"""
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+from service import db
+from service.app import create_app
+
+
+def run(group_commit, threads, requests):
+    """
+    Gives (requests per second, failed requests) for `threads` concurrent clients
+    """
+    path = os.path.join(tempfile.mkdtemp(), 'bench.sqlite3')
+    app = create_app(config={
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + path,
+        'GROUP_COMMIT': group_commit,
+    })
+    failures = []
+
+    def client():
+        http = app.test_client()
+        for i in range(requests):
+            status = http.post('/users', json={'email': 'foo@bar.com', 'name': 'user {}'.format(i)}).status_code
+            if status != 201:
+                failures.append(status)
+
+    workers = [threading.Thread(target=client) for _ in range(threads)]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+
+    if group_commit:
+        app.extensions['group_commit'].stop()
+    with app.app_context():
+        db.engine.dispose()
+    return threads * requests / elapsed, len(failures)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--requests', type=int, default=200, help='requests per thread')
+    args = parser.parse_args()
+
+    print('{:>8} {:>14} {:>9} {:>14} {:>9}'.format(
+        'threads', 'direct req/s', 'failed', 'grouped req/s', 'failed'))
+    for threads in args.threads:
+        direct, direct_failed = run(False, threads, args.requests)
+        grouped, grouped_failed = run(True, threads, args.requests)
+        print('{:>8} {:>14.0f} {:>9} {:>14.0f} {:>9}'.format(
+            threads, direct, direct_failed, grouped, grouped_failed))
+
+
+if __name__ == '__main__':
+    main()
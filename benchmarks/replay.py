@@ -0,0 +1,133 @@
+"""
+Compares the set-based replay with the previous one-lookup-per-log replay,
+and with validating and applying in --workers processes
+
+usage: python -m benchmarks.replay [--sizes 10000 100000 1000000] [--workers 4]
+"""
+import argparse
+import os
+import tempfile
+import time
+import uuid
+
+from service import db
+from service.models import User, ActivityLog
+from service.parallel import apply_logs_parallel, validate_logs
+from service.replay import apply_logs
+from service.utils import to_datetime
+from service.validation import log_validator
+
+TIMESTAMP = "2020-02-18T11:24:01.764973Z"
+
+
+def generate_logs(count, updates_per_user=3):
+    """
+    Gives `count` logs, every user is created, updated a few times
+    and every tenth user is deleted at the end
+    """
+    logs = []
+    user_number = 0
+    while len(logs) < count:
+        user_id = str(uuid.uuid4())
+        actions = ['create'] + ['update'] * updates_per_user
+        if user_number % 10 == 0:
+            actions.append('delete')
+        for action in actions[:count - len(logs)]:
+            logs.append({
+                'id': str(uuid.uuid4()),
+                'user_id': user_id,
+                'action': action,
+                'attributes': {
+                    'id': user_id,
+                    'email': 'user{}@bar.com'.format(user_number),
+                    'name': 'user {} {}'.format(user_number, len(logs)),
+                    'created_at': TIMESTAMP,
+                    'updated_at': TIMESTAMP,
+                },
+                'created_at': TIMESTAMP,
+                'updated_at': TIMESTAMP,
+            })
+        user_number += 1
+    return logs
+
+
+def point_lookup_replay(logs):
+    """
+    The replay loop as it was before, two primary key lookups per log
+    """
+    for log in logs:
+        user_data = log['attributes']
+        user = User.query.get(user_data['id'])
+        if log['action'] == 'create':
+            user = User(id=user_data['id'])
+            db.session.add(user)
+        if log['action'] in ('create', 'update'):
+            user.email = user_data['email']
+            user.name = user_data['name']
+            user.created_at = to_datetime(user_data['created_at'])
+            user.updated_at = to_datetime(user_data['updated_at'])
+        else:
+            db.session.delete(user)
+        ActivityLog.query.get(log['id'])
+        db.session.add(ActivityLog(
+            id=log['id'], user_id=log['user_id'], action=log['action'],
+            attributes=log['attributes'],
+            created_at=to_datetime(log['created_at']),
+            updated_at=to_datetime(log['updated_at'])))
+    db.session.commit()
+
+
+def set_based_replay(logs):
+    assert not [errors for errors in map(log_validator.errors, logs) if errors]
+    apply_logs(logs)
+    db.session.commit()
+
+
+def parallel_replay(workers):
+    def replay(logs):
+        assert not validate_logs(logs, workers)
+        apply_logs_parallel(logs, workers)
+        db.session.commit()
+    return replay
+
+
+def measure(app, replay, logs):
+    with app.app_context():
+        User.query.delete()
+        ActivityLog.query.delete()
+        db.session.commit()
+        started = time.perf_counter()
+        replay(logs)
+        elapsed = time.perf_counter() - started
+        db.session.remove()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--point-lookup-limit', type=int, default=100000,
+                        help='skip the old replay above this many logs')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(directory, 'bench.sqlite3')
+    from service.app import create_app
+    app = create_app()
+
+    print('{:>10} {:>14} {:>14} {:>9} {:>14}'.format(
+        'logs', 'point lookup', 'set based', 'speedup', '{} workers'.format(args.workers)))
+    for size in args.sizes:
+        logs = generate_logs(size)
+        new = measure(app, set_based_replay, logs)
+        parallel = '{:>13.2f}s'.format(measure(app, parallel_replay(args.workers), logs))
+        if size <= args.point_lookup_limit:
+            old = measure(app, point_lookup_replay, logs)
+            print('{:>10} {:>13.2f}s {:>13.2f}s {:>8.1f}x {}'.format(size, old, new, old / new, parallel))
+        else:
+            print('{:>10} {:>14} {:>13.2f}s {:>9} {}'.format(size, '-', new, '-', parallel))
+
+
+if __name__ == '__main__':
+    main()
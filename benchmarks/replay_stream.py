@@ -0,0 +1,81 @@
+"""
+Peak RSS of replaying a log history through the JSON body and the NDJSON stream
+
+usage: python -m benchmarks.replay_stream [--sizes 10000 100000 1000000]
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.replay import generate_logs
+
+
+def write_payload(path, mode, size):
+    """
+    Writes `size` generated logs into `path` without keeping them all around
+    """
+    with open(path, 'w') as f:
+        if mode == 'json':
+            f.write('{"logs": [')
+        written = 0
+        while written < size:
+            batch = generate_logs(min(10000, size - written))
+            if mode == 'json':
+                f.write(('' if written == 0 else ',') + ','.join(json.dumps(log) for log in batch))
+            else:
+                f.write(''.join(json.dumps(log) + '\n' for log in batch))
+            written += len(batch)
+        if mode == 'json':
+            f.write(']}')
+
+
+def child(mode, path):
+    """
+    Replays the payload in this process and prints elapsed seconds and peak RSS
+    """
+    os.environ['DATABASE_URL'] = 'sqlite:///' + path + '.sqlite3'
+    from service.app import create_app
+    app = create_app()
+    client = app.test_client()
+    content_type = 'application/json' if mode == 'json' else 'application/x-ndjson'
+    started = time.perf_counter()
+    with open(path, 'rb') as f:
+        response = client.post('/logs/replay', input_stream=f,
+                               content_length=os.path.getsize(path),
+                               content_type=content_type)
+    elapsed = time.perf_counter() - started
+    assert response.status_code in (200, 204), response.data
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({'seconds': elapsed, 'peak_rss_kb': peak}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--child', nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        return child(*args.child)
+
+    directory = tempfile.mkdtemp()
+    print('{:>10} {:>8} {:>10} {:>14}'.format('logs', 'mode', 'seconds', 'peak RSS MiB'))
+    for size in args.sizes:
+        for mode in ('json', 'ndjson'):
+            path = os.path.join(directory, '{}-{}.{}'.format(mode, size, mode))
+            write_payload(path, mode, size)
+            output = subprocess.check_output(
+                [sys.executable, '-m', 'benchmarks.replay_stream', '--child', mode, path],
+                stderr=subprocess.DEVNULL)
+            result = json.loads(output.decode().strip().splitlines()[-1])
+            print('{:>10} {:>8} {:>10.2f} {:>14.1f}'.format(
+                size, mode, result['seconds'], result['peak_rss_kb'] / 1024.0))
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
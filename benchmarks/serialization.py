@@ -0,0 +1,56 @@
+"""
+Rows per second of the GET /logs body built with to_dict and jsonify
+against the lean raw column encoders
+
+usage: python -m benchmarks.serialization [--sizes 10000 100000] [--repeat 3]
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from benchmarks.streaming import seed
+
+
+def orm_body(size):
+    from flask import jsonify
+    from service.models import ActivityLog
+    logs = ActivityLog.query.order_by(ActivityLog.created_at, ActivityLog.id).limit(size)
+    return jsonify({'logs': [log.to_dict() for log in logs]}).get_data()
+
+
+def lean_body(size):
+    from service.models import ActivityLog
+    from service.serialization import encode_log, lean_logs, list_body
+    logs = lean_logs().order_by(ActivityLog.created_at, ActivityLog.id).limit(size)
+    return list_body('logs', map(encode_log, logs)).encode()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), 'logs.sqlite3')
+    seed(path, max(args.sizes))
+    from service.app import create_app
+    app = create_app()
+
+    print('{:>10} {:>6} {:>10} {:>12}'.format('logs', 'path', 'seconds', 'rows/s'))
+    for size in args.sizes:
+        bodies = {}
+        for name, build in (('orm', orm_body), ('lean', lean_body)):
+            best = None
+            for _ in range(args.repeat):
+                with app.test_request_context():
+                    started = time.perf_counter()
+                    bodies[name] = build(size)
+                    elapsed = time.perf_counter() - started
+                best = elapsed if best is None else min(best, elapsed)
+            print('{:>10} {:>6} {:>10.3f} {:>12.0f}'.format(size, name, best, size / best))
+        assert bodies['orm'] == bodies['lean'], 'bodies differ'
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""
+Throughput and latency of the development server run.py starts against
+gunicorn with gunicorn.conf.py at several worker counts, loaded over HTTP
+by --clients processes each keeping one connection open
+
+usage: python -m benchmarks.serving [--logs 10000] [--workers 1 2 4] [--clients 8] [--seconds 10]
+"""
+import argparse
+import http.client
+import json
+import math
+import multiprocessing
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.streaming import seed
+
+PORT = 5099
+
+
+def servers(workers):
+    """
+    Gives (name, command) of every compared server
+    """
+    found = [('dev server', [
+        sys.executable, '-c', 'from service.app import create_app; '
+                              'create_app().run(host="127.0.0.1", port={})'.format(PORT)])]
+    for count in workers:
+        found.append(('gunicorn -w {}'.format(count), [
+            sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py',
+            '-b', '127.0.0.1:{}'.format(PORT), '-w', str(count), 'wsgi:app']))
+    return found
+
+
+def wait_for_port(timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', PORT), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError('server did not start')
+
+
+def load(args):
+    """
+    Requests `paths` in turn until `seconds` passed, gives the latencies
+    """
+    paths, seconds, number = args
+    rng = random.Random(number)
+    connection = http.client.HTTPConnection('127.0.0.1', PORT)
+    latencies = []
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        started = time.perf_counter()
+        connection.request('GET', rng.choice(paths))
+        response = connection.getresponse()
+        response.read()
+        latencies.append(time.perf_counter() - started)
+        if response.status != 200:
+            raise RuntimeError('{} answered {}'.format(paths, response.status))
+    connection.close()
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--logs', type=int, default=10000)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=10)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), 'serving.sqlite3')
+    subprocess.check_call([sys.executable, '-c', 'from benchmarks.streaming import seed; '
+                           'seed({!r}, {})'.format(path, args.logs)], stderr=subprocess.DEVNULL)
+    env = dict(os.environ, DATABASE_URL='sqlite:///' + path)
+    # gunicorn workers start lean, only serving a database at the migrations head
+    subprocess.check_call([sys.executable, '-m', 'flask', 'db', 'stamp', 'head'], env=dict(env, FLASK_APP='run.py'),
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    env.setdefault('SQLITE_PROFILE', 'performance')
+
+    print('{} cores, {} client processes'.format(multiprocessing.cpu_count(), args.clients))
+    print('{:<16} {:>10} {:>9} {:>9}'.format('server', 'req/s', 'p50 ms', 'p99 ms'))
+    paths = None
+    for name, command in servers(args.workers):
+        server = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_for_port()
+            if paths is None:
+                connection = http.client.HTTPConnection('127.0.0.1', PORT)
+                connection.request('GET', '/users?limit=100')
+                users = json.loads(connection.getresponse().read())['users']
+                paths = ['/health', '/logs?limit=100'] + ['/users/' + user['id'] for user in users]
+            with multiprocessing.Pool(args.clients) as pool:
+                results = pool.map(load, [(paths, args.seconds, number) for number in range(args.clients)])
+        finally:
+            server.terminate()
+            server.wait()
+        latencies = sorted(latency for result in results for latency in result)
+        p50, p99 = (latencies[max(0, int(math.ceil(p * len(latencies))) - 1)] * 1000 for p in (0.5, 0.99))
+        print('{:<16} {:>10.0f} {:>9.2f} {:>9.2f}'.format(name, len(latencies) / args.seconds, p50, p99))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""
+Concurrent read/write throughput of the SQLite profiles
+
+usage: python -m benchmarks.sqlite_profiles [--readers 8] [--writers 4] [--seconds 5]
+"""
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+
+from service import db
+from service.app import create_app
+from service.sqlite import PROFILES
+
+
+def run(profile, readers, writers, seconds, users=1000):
+    """
+    Gives (reads/s, writes/s, failed requests) of GET and PATCH /users/<id>
+    issued by concurrent clients for `seconds`
+    """
+    path = os.path.join(tempfile.mkdtemp(), 'bench.sqlite3')
+    app = create_app(config={
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + path,
+        'SQLITE_PROFILE': profile,
+    })
+    http = app.test_client()
+    ids = [
+        http.post('/users', json={'email': 'foo@bar.com', 'name': 'user {}'.format(i)}).get_json()['id']
+        for i in range(users)
+    ]
+    counts = {'read': 0, 'write': 0, 'failed': 0}
+    lock = threading.Lock()
+    deadline = time.monotonic() + seconds
+
+    def client(kind):
+        http = app.test_client()
+        done = failed = 0
+        while time.monotonic() < deadline:
+            user_id = random.choice(ids)
+            if kind == 'read':
+                status = http.get('/users/' + user_id).status_code
+            else:
+                status = http.patch('/users/' + user_id, json={'name': 'name {}'.format(done)}).status_code
+            done += 1
+            failed += status != 200
+        with lock:
+            counts[kind] += done
+            counts['failed'] += failed
+
+    threads = [threading.Thread(target=client, args=('read',)) for _ in range(readers)]
+    threads += [threading.Thread(target=client, args=('write',)) for _ in range(writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    with app.app_context():
+        db.engine.dispose()
+    return counts['read'] / seconds, counts['write'] / seconds, counts['failed']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--profiles', nargs='+', default=sorted(PROFILES))
+    args = parser.parse_args()
+
+    print('{:>12} {:>10} {:>10} {:>8}'.format('profile', 'reads/s', 'writes/s', 'failed'))
+    for profile in args.profiles:
+        reads, writes, failed = run(profile, args.readers, args.writers, args.seconds)
+        print('{:>12} {:>10.0f} {:>10.0f} {:>8}'.format(profile, reads, writes, failed))
+
+
+if __name__ == '__main__':
+    main()
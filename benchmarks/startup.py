@@ -0,0 +1,80 @@
+"""
+Cold start of the app in a fresh interpreter: importing service.app,
+create_app and the first GET /health, with the default startup against
+LEAN_STARTUP, on a database migrated with `flask db upgrade`
+
+With --max-seconds the exit status is 1 when the median lean total
+takes longer.
+
+usage: python -m benchmarks.startup [--runs 5] [--max-seconds 1.5]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+# run in a new interpreter for every measurement, prints its timings as JSON
+PROBE = '''
+import json, sys, time
+started = time.perf_counter()
+from service.app import create_app
+imported = time.perf_counter()
+app = create_app(config={{"LEAN_STARTUP": {lean}, "LOG_LEVEL": "WARNING"}})
+created = time.perf_counter()
+assert app.test_client().get("/health").status_code == 200
+served = time.perf_counter()
+print(json.dumps({{
+    "import": imported - started, "create_app": created - imported,
+    "first_request": served - created, "total": served - started,
+    "modules": len(sys.modules),
+}}))
+'''
+PHASES = ('import', 'create_app', 'first_request', 'total')
+
+
+def migrate(path):
+    subprocess.check_call(
+        [sys.executable, '-m', 'flask', 'db', 'upgrade'],
+        env=dict(os.environ, DATABASE_URL='sqlite:///' + path, CREATE_TABLES='false', FLASK_APP='run.py'),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def probe(path, lean):
+    output = subprocess.check_output(
+        [sys.executable, '-c', PROBE.format(lean=lean)],
+        env=dict(os.environ, DATABASE_URL='sqlite:///' + path))
+    return json.loads(output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--max-seconds', type=float, help='budget of the median lean total')
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), 'startup.sqlite3')
+    migrate(path)
+
+    print('{:<8} {:>10} {:>13} {:>16} {:>10} {:>9}'.format(
+        'startup', 'import ms', 'create_app ms', 'first request ms', 'total ms', 'modules'))
+    medians = {}
+    for name, lean in (('full', False), ('lean', True)):
+        runs = [probe(path, lean) for _ in range(args.runs)]
+        median = medians[name] = {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+        print('{:<8} {:>10.0f} {:>13.0f} {:>16.0f} {:>10.0f} {:>9.0f}'.format(
+            name, *(median[phase] * 1000 for phase in PHASES), median['modules']))
+
+    if args.max_seconds is not None:
+        if medians['lean']['total'] > args.max_seconds:
+            print('Lean startup took {:.3f}s, over the {:.3f}s budget'.format(
+                medians['lean']['total'], args.max_seconds))
+            return 1
+        print('Lean startup within the {:.3f}s budget'.format(args.max_seconds))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,98 @@
+"""
+Time to first byte and peak RSS of GET /logs, buffered against streamed,
+and of the NDJSON GET /logs/export, plain and gzip compressed
+
+usage: python -m benchmarks.streaming [--sizes 10000 100000 1000000]
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.replay import generate_logs
+
+# request of every compared mode
+MODES = {
+    'buffered': ('/logs', {}),
+    'streamed': ('/logs?stream=true', {}),
+    'export': ('/logs/export', {}),
+    'gzip': ('/logs/export', {'Accept-Encoding': 'gzip'}),
+}
+
+
+def seed(path, size):
+    """
+    Creates a database at `path` holding `size` activity logs
+    """
+    os.environ['DATABASE_URL'] = 'sqlite:///' + path
+    from service import db
+    from service.app import create_app
+    from service.replay import apply_logs
+    app = create_app()
+    with app.app_context():
+        written = 0
+        while written < size:
+            logs = generate_logs(min(50000, size - written))
+            apply_logs(logs)
+            db.session.commit()
+            written += len(logs)
+
+
+def child(mode, path, size):
+    """
+    Fetches all logs in this process and prints timings and peak RSS
+    """
+    os.environ['DATABASE_URL'] = 'sqlite:///' + path
+    from service.app import create_app
+    app = create_app()
+    app.config['LIST_MAX_ROWS'] = int(size)
+    client = app.test_client()
+    started = time.perf_counter()
+    path, headers = MODES[mode]
+    response = client.get(path, headers=headers, buffered=False)
+    chunks = iter(response.response)
+    received = len(next(chunks))
+    first_byte = time.perf_counter() - started
+    for chunk in chunks:
+        received += len(chunk)
+    elapsed = time.perf_counter() - started
+    response.close()
+    print(json.dumps({
+        'first_byte': first_byte,
+        'seconds': elapsed,
+        'bytes': received,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--child', nargs=3, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        return child(*args.child)
+
+    directory = tempfile.mkdtemp()
+    print('{:>10} {:>9} {:>13} {:>10} {:>14}'.format(
+        'logs', 'mode', 'first byte', 'seconds', 'peak RSS MiB'))
+    for size in args.sizes:
+        path = os.path.join(directory, 'logs-{}.sqlite3'.format(size))
+        subprocess.check_call([sys.executable, '-c', 'from benchmarks.streaming import seed; '
+                               'seed({!r}, {})'.format(path, size)], stderr=subprocess.DEVNULL)
+        for mode in MODES:
+            output = subprocess.check_output(
+                [sys.executable, '-m', 'benchmarks.streaming', '--child', mode, path, str(size)],
+                stderr=subprocess.DEVNULL)
+            result = json.loads(output.decode().strip().splitlines()[-1])
+            print('{:>10} {:>9} {:>12.3f}s {:>10.2f} {:>14.1f}'.format(
+                size, mode, result['first_byte'], result['seconds'],
+                result['peak_rss_kb'] / 1024.0))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+"""
+Latency percentiles and throughput of every route, served in process by
+the Flask test client from a seeded in-memory database
+
+Results are printed and saved with --output. With --baseline, metrics
+are compared with a saved run and the exit status is 1 when one of them
+regressed by more than --threshold.
+
+usage: python -m benchmarks.suite [--logs 10000] [--requests 50] [--bulk-requests 5]
+           [--replay-sizes 100 1000 10000] [--only REGEX] [--output results.json]
+           [--baseline baseline.json] [--threshold 0.25] [--metrics p50_ms p90_ms]
+"""
+import argparse
+import gzip
+import json
+import math
+import platform
+import random
+import re
+import sqlite3
+import sys
+import time
+from datetime import datetime
+
+from benchmarks.replay import TIMESTAMP, generate_logs
+
+PERCENTILES = (50, 90, 99)
+# metrics getting worse as they grow, the others get worse as they shrink
+LATENCY_METRICS = frozenset('p{}_ms'.format(p) for p in PERCENTILES) | {'mean_ms'}
+
+
+class Case(object):
+    """
+    Requests of one benchmarked route, `request(iteration)` gives
+    (method, path, keyword arguments of the test client's open),
+    bulk cases run --bulk-requests times instead of --requests
+    """
+
+    def __init__(self, name, request, bulk=False):
+        self.name = name
+        self.request = request
+        self.bulk = bulk
+
+
+def seed(app, size):
+    """
+    Replays `size` generated logs and snapshots the users,
+    gives ids of the users which exist afterwards
+    """
+    from service import db
+    from service.replay import apply_logs
+    from service.snapshots import take_snapshot
+    users = {}
+    with app.app_context():
+        written = 0
+        while written < size:
+            logs = generate_logs(min(50000, size - written))
+            apply_logs(logs)
+            db.session.commit()
+            written += len(logs)
+            for log in logs:
+                users[log['user_id']] = log['action'] != 'delete'
+        take_snapshot()
+        db.session.commit()
+    return [user_id for user_id, exists in users.items() if exists]
+
+
+def ndjson(logs):
+    return ''.join(json.dumps(log) + '\n' for log in logs)
+
+
+def cases(user_ids, replay_sizes):
+    """
+    Gives Cases of every route in service.views, reads first as writes
+    invalidate the caches they go through
+    """
+    from service.pagination import encode_cursor
+    from service.utils import to_datetime
+    pick = random.Random(0).choice
+    middle = encode_cursor(to_datetime(TIMESTAMP), sorted(user_ids)[len(user_ids) // 2])
+    deleted = list(reversed(user_ids))
+
+    def fixed(path, method='GET', **kwargs):
+        return lambda iteration: (method, path, kwargs)
+
+    def per_user(method, path, **kwargs):
+        return lambda iteration: (method, path.format(pick(user_ids)), kwargs)
+
+    found = [
+        Case('GET /health', fixed('/health')),
+        Case('GET /cache/stats', fixed('/cache/stats')),
+        Case('GET /users?limit=100', fixed('/users?limit=100')),
+        Case('GET /users?limit=100&after', fixed('/users', query_string={'limit': 100, 'after': middle})),
+        Case('GET /users', fixed('/users'), bulk=True),
+        Case('GET /users?as_of&limit=100', fixed('/users', query_string={'as_of': TIMESTAMP, 'limit': 100})),
+        Case('GET /users/<id>', per_user('GET', '/users/{}')),
+        Case('GET /users/<id>?as_of', per_user('GET', '/users/{}', query_string={'as_of': TIMESTAMP})),
+        Case('GET /logs?limit=100', fixed('/logs?limit=100')),
+        Case('GET /logs?limit=100&order=desc', fixed('/logs?limit=100&order=desc')),
+        Case('GET /logs?action=delete&limit=100', fixed('/logs?action=delete&limit=100')),
+        Case('GET /logs', fixed('/logs'), bulk=True),
+        Case('GET /logs?stream=true', fixed('/logs?stream=true'), bulk=True),
+        Case('GET /logs/user/<id>', per_user('GET', '/logs/user/{}')),
+        Case('GET /logs/stats', fixed('/logs/stats')),
+        Case('GET /logs/stats?user_id', per_user('GET', '/logs/stats?granularity=day&user_id={}')),
+        Case('GET /logs/export', fixed('/logs/export'), bulk=True),
+        Case('GET /logs/export gzip', fixed('/logs/export', headers={'Accept-Encoding': 'gzip'}), bulk=True),
+        Case('POST /users', fixed('/users', 'POST', json={'email': 'bench@bar.com', 'name': 'bench'})),
+        Case('PATCH /users/<id>', per_user('PATCH', '/users/{}', json={'name': 'patched'})),
+        Case('DELETE /users/<id>', lambda iteration: ('DELETE', '/users/' + deleted.pop(), {})),
+    ]
+    for size in replay_sizes:
+        found.append(Case('POST /logs/replay {}'.format(size), lambda iteration, size=size: (
+            'POST', '/logs/replay', {'json': {'logs': generate_logs(size)}}), bulk=True))
+    found.append(Case('POST /logs/replay ndjson gzip 1000', lambda iteration: (
+        'POST', '/logs/replay', {
+            'data': gzip.compress(ndjson(generate_logs(1000)).encode()),
+            'headers': {'Content-Type': 'application/x-ndjson', 'Content-Encoding': 'gzip'},
+        }), bulk=True))
+    return found
+
+
+def measure(client, case, requests):
+    """
+    Gives latency percentiles and throughput of `requests` runs of a case,
+    building the requests is not timed
+    """
+    latencies, size = [], 0
+    for iteration in range(requests):
+        method, path, kwargs = case.request(iteration)
+        started = time.perf_counter()
+        response = client.open(path, method=method, **kwargs)
+        # streamed bodies are produced while being read
+        size = len(response.get_data())
+        latencies.append(time.perf_counter() - started)
+        assert response.status_code < 400, '{}: {}'.format(case.name, response.status_code)
+    latencies.sort()
+    result = {
+        'requests': requests,
+        'mean_ms': sum(latencies) / requests * 1000,
+        'rps': requests / sum(latencies),
+        'bytes': size,
+    }
+    for percentile in PERCENTILES:
+        rank = max(0, int(math.ceil(percentile / 100.0 * requests)) - 1)
+        result['p{}_ms'.format(percentile)] = latencies[rank] * 1000
+    return result
+
+
+def regressions(results, baseline, metrics, threshold):
+    """
+    Gives (case, metric, baseline value, value) of the metrics worse than
+    their baseline by more than `threshold`, a fraction of it
+    """
+    found = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for metric in metrics:
+            old, new = baseline[name][metric], result[metric]
+            if metric in LATENCY_METRICS:
+                worse = new > old * (1 + threshold)
+            else:
+                worse = new * (1 + threshold) < old
+            if worse:
+                found.append((name, metric, old, new))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--logs', type=int, default=10000, help='logs seeded before measuring')
+    parser.add_argument('--requests', type=int, default=50)
+    parser.add_argument('--bulk-requests', type=int, default=5,
+                        help='requests of the cases reading or writing whole tables')
+    parser.add_argument('--replay-sizes', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument('--only', help='only run the cases whose name matches this regex')
+    parser.add_argument('--output', help='file the results are saved to as JSON')
+    parser.add_argument('--baseline', help='results saved by an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.25)
+    parser.add_argument('--metrics', nargs='+', default=['p50_ms', 'p90_ms'])
+    args = parser.parse_args()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['meta']['logs'] != args.logs:
+            parser.error('baseline was measured with --logs {}'.format(baseline['meta']['logs']))
+
+    from service.app import create_app
+    app = create_app(testing=True, config={'LOG_LEVEL': 'WARNING'})
+    user_ids = seed(app, args.logs)
+    client = app.test_client()
+
+    results = {}
+    print('{:<40} {:>9} {:>9} {:>9} {:>9} {:>11}'.format('case', 'p50 ms', 'p90 ms', 'p99 ms', 'req/s', 'bytes'))
+    for case in cases(user_ids, args.replay_sizes):
+        if args.only and not re.search(args.only, case.name):
+            continue
+        result = results[case.name] = measure(client, case, args.bulk_requests if case.bulk else args.requests)
+        print('{:<40} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.1f} {:>11}'.format(
+            case.name, result['p50_ms'], result['p90_ms'], result['p99_ms'], result['rps'], result['bytes']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'meta': {
+                    'logs': args.logs,
+                    'python': platform.python_version(),
+                    'sqlite': sqlite3.sqlite_version,
+                    'machine': platform.machine(),
+                    'measured_at': datetime.utcnow().isoformat() + 'Z',
+                },
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+
+    if baseline is not None:
+        found = regressions(results, baseline['results'], args.metrics, args.threshold)
+        for name, metric, old, new in found:
+            print('REGRESSION {} {}: {:.2f} -> {:.2f}'.format(name, metric, old, new))
+        if found:
+            return 1
+        print('No regression beyond {:.0%} of the baseline'.format(args.threshold))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,137 @@
+"""
+Ids stored as 36 character text against 16 byte binary UUIDs: database
+file, table and index sizes, and primary key and user_id lookups through a page
+cache of --cache-pages pages, their latency, the pages they read from
+the file and the share of them served by the cache alone
+
+The binary database is replayed by the app, the text one is a copy
+migrated down with `flask db downgrade`. The stdlib sqlite3 module does
+not expose the page cache counters, the reads are the rchar growth of
+/proc/self/io with memory mapping off.
+
+usage: python -m benchmarks.uuids [--logs 100000] [--lookups 5000] [--cache-pages 100]
+"""
+import argparse
+import os
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+from benchmarks.replay import generate_logs
+
+# logs replayed per request
+CHUNK_SIZE = 10000
+# revision before the binary ids
+TEXT_REVISION = 'c4e81f2a9d06'
+
+LOOKUPS = {
+    'log by id': 'SELECT * FROM ActivityLog WHERE id = ?',
+    'user by id': 'SELECT * FROM user WHERE id = ?',
+    'logs of user': 'SELECT id, created_at FROM ActivityLog WHERE user_id = ? ORDER BY created_at, id',
+}
+
+
+def flask(path, *args):
+    subprocess.check_call(
+        [sys.executable, '-m', 'flask', 'db'] + list(args),
+        env=dict(os.environ, DATABASE_URL='sqlite:///' + path, CREATE_TABLES='false', FLASK_APP='run.py'),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def seed(path, logs):
+    from service.app import create_app
+    app = create_app(config={
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + path, 'LOG_LEVEL': 'WARNING',
+    })
+    client = app.test_client()
+    for start in range(0, len(logs), CHUNK_SIZE):
+        response = client.post('/logs/replay', json={'logs': logs[start:start + CHUNK_SIZE]})
+        assert response.status_code == 204, response.get_data()
+    flask(path, 'stamp', 'head')
+
+
+def bytes_read():
+    with open('/proc/self/io') as f:
+        return int(next(line for line in f if line.startswith('rchar:')).split()[1])
+
+
+def measure(path, keys, cache_pages):
+    """
+    Gives the results of the database at `path`, looking up `keys`,
+    lookup name -> ids as they are stored
+    """
+    connection = sqlite3.connect(path)
+    connection.execute('VACUUM')
+    result = {'file MB': os.path.getsize(path) / 1e6}
+    for name, size in connection.execute(
+            "SELECT name, sum(pgsize) FROM dbstat WHERE name IN "
+            "(SELECT name FROM sqlite_master WHERE tbl_name IN ('ActivityLog', 'user')) GROUP BY name"):
+        result[name + ' MB'] = size / 1e6
+    page_size = connection.execute('PRAGMA page_size').fetchone()[0]
+    connection.close()
+
+    for name, query in LOOKUPS.items():
+        connection = sqlite3.connect(path)
+        connection.execute('PRAGMA mmap_size = 0')
+        connection.execute('PRAGMA cache_size = {}'.format(cache_pages))
+        pages, cached = 0, 0
+        started = time.perf_counter()
+        for key in keys[name]:
+            before = bytes_read()
+            rows = connection.execute(query, (key,)).fetchall()
+            read = (bytes_read() - before) // page_size
+            assert rows
+            pages += read
+            cached += not read
+        result[name + ' us'] = (time.perf_counter() - started) / len(keys[name]) * 1e6
+        result[name + ' pages'] = pages / len(keys[name])
+        result[name + ' cached %'] = cached / len(keys[name]) * 100
+        connection.close()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--logs', type=int, default=100000)
+    parser.add_argument('--updates-per-user', type=int, default=20)
+    parser.add_argument('--lookups', type=int, default=5000)
+    parser.add_argument('--cache-pages', type=int, default=100)
+    args = parser.parse_args()
+
+    logs = generate_logs(args.logs, args.updates_per_user)
+    directory = tempfile.mkdtemp()
+    paths = {'binary': os.path.join(directory, 'binary.sqlite3'), 'text': os.path.join(directory, 'text.sqlite3')}
+    seed(paths['binary'], logs)
+    shutil.copy(paths['binary'], paths['text'])
+    started = time.perf_counter()
+    flask(paths['text'], 'downgrade', TEXT_REVISION)
+    print('Migrated {} logs down in {:.2f}s'.format(len(logs), time.perf_counter() - started))
+
+    sample = random.Random(0)
+    keys = {
+        'log by id': [log['id'] for log in sample.sample(logs, min(args.lookups, len(logs)))],
+        'user by id': sample.choices(sorted(
+            {log['user_id'] for log in logs} - {log['user_id'] for log in logs if log['action'] == 'delete'}),
+            k=args.lookups),
+    }
+    keys['logs of user'] = keys['user by id']
+    results = {
+        'text': measure(paths['text'], keys, args.cache_pages),
+        'binary': measure(paths['binary'], {
+            name: [uuid.UUID(key).bytes for key in ids] for name, ids in keys.items()}, args.cache_pages),
+    }
+
+    width = max(len(metric) for metric in results['text'])
+    print('{:<{}} {:>12} {:>12}'.format('', width, 'text', 'binary'))
+    for metric in results['text']:
+        print('{:<{}} {:>12.2f} {:>12.2f}'.format(
+            metric, width, results['text'][metric], results['binary'][metric]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+"""
+Per-log validation cost of Cerberus against the compiled validators
+
+usage: python -m benchmarks.validation [--logs 100000]
+"""
+import argparse
+import time
+
+from cerberus import Validator
+
+from benchmarks.replay import generate_logs
+from service.utils import log_schema
+from service.validation import log_validator
+
+
+def per_log(validate, logs):
+    started = time.perf_counter()
+    for log in logs:
+        validate(log)
+    return (time.perf_counter() - started) / len(logs) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--logs', type=int, default=100000)
+    args = parser.parse_args()
+
+    valid = generate_logs(args.logs)
+    invalid = [dict(log, action='rename') for log in valid[:max(1, args.logs // 10)]]
+    v = Validator(log_schema)
+
+    print('{:>10} {:>14} {:>14} {:>9}'.format('logs', 'cerberus', 'compiled', 'speedup'))
+    for name, logs in (('valid', valid), ('invalid', invalid)):
+        old = per_log(v.validate, logs)
+        new = per_log(log_validator.errors, logs)
+        print('{:>10} {:>11.1f} us {:>11.1f} us {:>8.1f}x'.format(name, old, new, old / new))
+
+
+if __name__ == '__main__':
+    main()
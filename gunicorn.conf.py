@@ -0,0 +1,38 @@
+"""
+Gunicorn settings of the production server:
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+The app is loaded once by the master and every worker is forked from it,
+service.app.prepare_worker then gives each worker its own connections.
+SIGTERM stops accepting connections and lets running requests finish
+within graceful_timeout, SIGHUP replaces the workers the same way. The
+app is preloaded, so new code needs a restart rather than a SIGHUP.
+"""
+import multiprocessing
+import os
+
+bind = os.environ.get("BIND", "0.0.0.0:5000")
+# worker processes, one per core by default
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+# threads per worker, above 1 the gthread worker also keeps connections alive
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
+worker_class = "gthread" if threads > 1 else "sync"
+# seconds an idle connection is kept open, above the 2s of gunicorn as
+# clients and load balancers reuse connections for longer
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE", 5))
+# seconds a silent worker is given before it is killed and replaced
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 60))
+# seconds running requests are given to finish on SIGTERM or SIGHUP
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", 30))
+# requests after which a worker is replaced, 0 keeps workers for good
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", 0))
+max_requests_jitter = max_requests // 10
+preload_app = True
+# access log destination, "-" for stdout, none by default
+accesslog = os.environ.get("GUNICORN_ACCESS_LOG")
+
+
+def post_fork(server, worker):
+    from service.app import prepare_worker
+    prepare_worker(worker.app.wsgi(), server.cfg.workers)
@@ -0,0 +1,1743 @@
+import gzip
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import uuid
+
+from cerberus import Validator
+from flask import jsonify
+from sqlalchemy import event
+
+from service import db
+from service.app import create_app, prepare_worker
+from service.cache import LRUCache
+from service.models import (
+    ActivityLog, ActivityRollup, ArchivedLog, ArchiveSegment, Snapshot, SnapshotUser, User
+)
+from service.pagination import encode_cursor
+from service.schema import MIGRATIONS_DIR, SchemaError, migration_heads
+from service.utils import log_schema, to_datetime, user_schema, user_update_schema
+from service.validation import log_validator, user_update_validator, user_validator
+
+TIMESTAMP = "2020-02-18T11:24:01.764973Z"
+
+
+def make_log(action, user_id, name="foo bar", log_id=None):
+    return {
+        "id": log_id or str(uuid.uuid4()),
+        "user_id": user_id,
+        "action": action,
+        "attributes": {
+            "id": user_id,
+            "email": "foo@bar.com",
+            "name": name,
+            "created_at": TIMESTAMP,
+            "updated_at": TIMESTAMP,
+        },
+        "created_at": TIMESTAMP,
+        "updated_at": TIMESTAMP,
+    }
+
+
+class Base(object):
+    """
+    Runs the service in-process against an in-memory database
+    """
+
+    # overrides of the app's defaults
+    config = {}
+
+    def setUp(self):
+        self.app = create_app(testing=True, config=self.config)
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def replay(self, logs):
+        return self.client.post("/logs/replay", json={"logs": logs})
+
+
+class ReplayTests(Base, unittest.TestCase):
+
+    def test_replay_sequence(self):
+        one, two = str(uuid.uuid4()), str(uuid.uuid4())
+        replay = self.replay([
+            make_log("create", one, name="one"),
+            make_log("update", one, name="one_new"),
+            make_log("create", two, name="two"),
+            make_log("delete", two),
+            make_log("create", two, name="two_again"),
+        ])
+
+        self.assertEqual(replay.status_code, 204)
+        users = self.client.get("/users").get_json()["users"]
+        self.assertEqual(
+            sorted(user["name"] for user in users),
+            ["one_new", "two_again"]
+        )
+        logs = self.client.get("/logs").get_json()["logs"]
+        self.assertEqual(len(logs), 5)
+
+    def test_replay_on_top_of_existing_state(self):
+        user = self.client.post(
+            "/users", json={"email": "foo@bar.com", "name": "one"}
+        ).get_json()
+
+        replay = self.replay([make_log("update", user["id"], name="one_new")])
+        self.assertEqual(replay.status_code, 204)
+        self.assertEqual(
+            self.client.get("/users/" + user["id"]).get_json()["name"],
+            "one_new"
+        )
+
+        replay = self.replay([make_log("delete", user["id"])])
+        self.assertEqual(replay.status_code, 204)
+        self.assertEqual(self.client.get("/users").get_json(), {"users": []})
+
+    def test_replay_create_existing_user(self):
+        user_id = str(uuid.uuid4())
+        replay = self.replay([
+            make_log("create", user_id),
+            make_log("create", user_id),
+        ])
+
+        self.assertEqual(replay.status_code, 400)
+        self.assertEqual(
+            replay.get_json(),
+            {
+                "code": "BAD_REQUEST",
+                "message": "User with ID: {} already exist".format(user_id)
+            }
+        )
+        # nothing is applied when one of the logs fails
+        self.assertEqual(self.client.get("/logs").get_json(), {"logs": []})
+
+    def test_replay_update_deleted_user(self):
+        user_id = str(uuid.uuid4())
+        replay = self.replay([
+            make_log("create", user_id),
+            make_log("delete", user_id),
+            make_log("update", user_id),
+        ])
+
+        self.assertEqual(replay.status_code, 404)
+        self.assertEqual(
+            replay.get_json(),
+            {
+                "code": "NOT_FOUND",
+                "message": "User with ID: {} does not exist".format(user_id)
+            }
+        )
+        self.assertEqual(self.client.get("/users").get_json(), {"users": []})
+
+    def test_replay_duplicate_log_id(self):
+        user_id = str(uuid.uuid4())
+        create = make_log("create", user_id)
+        self.assertEqual(self.replay([create]).status_code, 204)
+
+        replay = self.replay([make_log("update", user_id, log_id=create["id"])])
+        self.assertEqual(replay.status_code, 400)
+        self.assertEqual(
+            replay.get_json()["message"],
+            "ActivityLog with ID: {} already exist".format(user_id)
+        )
+
+
+class ReplayStreamTests(Base, unittest.TestCase):
+
+    def setUp(self):
+        super(ReplayStreamTests, self).setUp()
+        self.app.config["REPLAY_CHUNK_SIZE"] = 2
+
+    def replay_stream(self, lines):
+        return self.client.post(
+            "/logs/replay",
+            data="\n".join(lines),
+            content_type="application/x-ndjson"
+        )
+
+    def test_replay_stream(self):
+        user_id = str(uuid.uuid4())
+        replay = self.replay_stream([
+            json.dumps(make_log("create", user_id, name="one")),
+            "",
+            json.dumps(make_log("update", user_id, name="two")),
+            json.dumps(make_log("update", user_id, name="three")),
+        ])
+
+        self.assertEqual(replay.status_code, 200)
+        self.assertEqual(replay.get_json(), {"applied": 3})
+        self.assertEqual(
+            self.client.get("/users/" + user_id).get_json()["name"],
+            "three"
+        )
+
+    def test_replay_stream_invalid_line(self):
+        log = make_log("create", str(uuid.uuid4()))
+        del log["action"]
+        replay = self.replay_stream([
+            json.dumps(make_log("create", str(uuid.uuid4()))),
+            json.dumps(make_log("create", str(uuid.uuid4()))),
+            json.dumps(log),
+        ])
+
+        self.assertEqual(replay.status_code, 400)
+        self.assertEqual(
+            replay.get_json()["message"],
+            {
+                "line": 3,
+                "applied": 2,
+                "errors": {"action": ["required field"]}
+            }
+        )
+        # chunks committed before the failing line are kept
+        self.assertEqual(len(self.client.get("/users").get_json()["users"]), 2)
+
+    def test_replay_stream_conflict(self):
+        user_id = str(uuid.uuid4())
+        replay = self.replay_stream([
+            json.dumps(make_log("create", user_id)),
+            json.dumps(make_log("create", str(uuid.uuid4()))),
+            json.dumps(make_log("delete", user_id)),
+            json.dumps(make_log("delete", user_id)),
+        ])
+
+        self.assertEqual(replay.status_code, 404)
+        self.assertEqual(
+            replay.get_json()["message"],
+            {
+                "line": 4,
+                "applied": 2,
+                "errors": "User with ID: {} does not exist".format(user_id)
+            }
+        )
+        self.assertEqual(len(self.client.get("/users").get_json()["users"]), 2)
+
+    def test_replay_stream_invalid_json(self):
+        replay = self.replay_stream(["{"])
+
+        self.assertEqual(replay.status_code, 400)
+        self.assertEqual(
+            replay.get_json()["message"],
+            {"line": 1, "applied": 0, "errors": "Invalid JSON"}
+        )
+
+
+class ParallelReplayTests(unittest.TestCase):
+
+    def outcome(self, config, *batches):
+        """
+        Gives responses of the replays of each batch, then the users and
+        logs they leave
+        """
+        app = create_app(testing=True, config=config)
+        client = app.test_client()
+        responses = []
+        for logs in batches:
+            response = client.post("/logs/replay", json={"logs": logs})
+            responses.append((response.status_code, response.get_json(silent=True)))
+        return responses, client.get("/users").get_json(), client.get("/logs").get_json()
+
+    def assertSameOutcome(self, *batches):
+        serial = self.outcome({}, *batches)
+        parallel = self.outcome({"REPLAY_WORKERS": 2, "PARALLEL_REPLAY_MIN_LOGS": 1}, *batches)
+        self.assertEqual(parallel, serial)
+        return serial
+
+    def history(self, users=20):
+        ids = [str(uuid.uuid4()) for _ in range(users)]
+        logs = [make_log("create", user_id) for user_id in ids]
+        for round in range(3):
+            logs.extend(make_log("update", user_id, name="{} {}".format(user_id, round)) for user_id in ids)
+        logs.extend(make_log("delete", user_id) for user_id in ids[::4])
+        return ids, logs
+
+    def test_applies_like_serial(self):
+        ids, logs = self.history()
+        more = [make_log("update", ids[1], name="later"), make_log("create", ids[0], name="again")]
+
+        responses, users, logs = self.assertSameOutcome(logs, more)
+        self.assertEqual([status for status, body in responses], [204, 204])
+        self.assertEqual(len(users["users"]), 16)
+
+    def test_validation_errors(self):
+        ids, logs = self.history()
+        logs[7]["action"] = "rename"
+        del logs[30]["user_id"]
+
+        responses, users, logs = self.assertSameOutcome(logs)
+        self.assertEqual(responses[0][0], 400)
+        self.assertEqual(len(responses[0][1]["message"]), 2)
+
+    def test_first_conflict(self):
+        ids, logs = self.history()
+        conflicting = [
+            (40, make_log("create", ids[3])),
+            (25, make_log("update", str(uuid.uuid4()))),
+            (50, dict(make_log("update", ids[5]), id=logs[2]["id"])),
+        ]
+        for position, log in conflicting:
+            logs.insert(position, log)
+            responses, users, stored = self.assertSameOutcome(logs)
+            self.assertIn(responses[0][0], (400, 404))
+            self.assertEqual(users, {"users": []})
+
+    def test_duplicate_and_conflict_at_once(self):
+        ids, logs = self.history()
+        logs.insert(10, dict(make_log("delete", str(uuid.uuid4())), id=logs[3]["id"]))
+        logs.insert(5, dict(make_log("create", ids[9]), id=logs[0]["id"]))
+
+        responses, users, stored = self.assertSameOutcome(logs)
+        self.assertEqual(responses[0][0], 400)
+        self.assertIn(ids[9], responses[0][1]["message"])
+
+    def test_conflict_with_stored_state(self):
+        ids, logs = self.history()
+
+        responses, users, stored = self.assertSameOutcome(logs, [make_log("update", ids[4])], logs[:1])
+        self.assertEqual([status for status, body in responses], [204, 404, 400])
+
+
+class PaginationTests(Base, unittest.TestCase):
+
+    def setUp(self):
+        super(PaginationTests, self).setUp()
+        self.users = [
+            self.client.post(
+                "/users", json={"email": "foo@bar.com", "name": "user {}".format(i)}
+            ).get_json()
+            for i in range(5)
+        ]
+
+    def collect_pages(self, path, key, limit):
+        items, pages, params = [], 0, {"limit": limit}
+        while True:
+            page = self.client.get(path, query_string=params).get_json()
+            items.extend(page[key])
+            pages += 1
+            if page["next"] is None:
+                return items, pages
+            params = {"limit": limit, "after": page["next"]}
+
+    def test_users_pages(self):
+        users, pages = self.collect_pages("/users", "users", 2)
+
+        self.assertEqual(pages, 3)
+        self.assertEqual(users, self.client.get("/users").get_json()["users"])
+        self.assertEqual(
+            sorted(user["id"] for user in users),
+            sorted(user["id"] for user in self.users)
+        )
+
+    def test_logs_pages(self):
+        logs, pages = self.collect_pages("/logs", "logs", 4)
+
+        self.assertEqual(pages, 2)
+        self.assertEqual(logs, self.client.get("/logs").get_json()["logs"])
+
+    def test_invalid_parameters(self):
+        for params in ({"limit": "ten"}, {"limit": 0}, {"after": "not-a-cursor"}):
+            response = self.client.get("/users", query_string=params)
+            self.assertEqual(response.status_code, 400)
+
+    def test_unpaginated_cap(self):
+        self.app.config["LIST_MAX_ROWS"] = 3
+
+        self.assertEqual(
+            self.client.get("/users").get_json(),
+            {"users": self.client.get("/users?limit=3").get_json()["users"]}
+        )
+
+
+class StreamingTests(Base, unittest.TestCase):
+
+    def test_stream_logs(self):
+        user_id = str(uuid.uuid4())
+        self.replay([make_log("create", user_id)] + [
+            make_log("update", user_id, name="name {}".format(i)) for i in range(3)
+        ] + [make_log("create", str(uuid.uuid4()))])
+
+        for path in ("/logs", "/logs/user/" + user_id):
+            streamed = self.client.get(path + "?stream=true")
+            self.assertEqual(streamed.status_code, 200)
+            self.assertEqual(streamed.mimetype, "application/json")
+            self.assertEqual(
+                streamed.get_json(),
+                self.client.get(path).get_json()
+            )
+
+    def test_stream_empty(self):
+        streamed = self.client.get("/logs?stream=1")
+
+        self.assertEqual(streamed.get_data(as_text=True), '{"logs":[]}\n')
+
+
+class SerializationTests(Base, unittest.TestCase):
+
+    def setUp(self):
+        super(SerializationTests, self).setUp()
+        self.user_id = str(uuid.uuid4())
+        log = make_log("create", self.user_id, name="Zo\u00eb \u00c5str\u00f6m \"q\" \\ \u2603")
+        log["attributes"]["email"] = "zoe@example.com"
+        self.replay([log, make_log("update", self.user_id, name="b\u00e9")] + [
+            make_log("create", str(uuid.uuid4()), name="user {}".format(i)) for i in range(3)
+        ])
+        self.client.post("/users", json={"email": "foo@bar.com", "name": "fresh \u00fc"})
+
+    def jsonify_body(self, key, model, *criteria):
+        """
+        Gives what jsonify writes for to_dict of the matching rows
+        """
+        with self.app.test_request_context():
+            rows = model.query.filter(*criteria).order_by(model.created_at, model.id)
+            return jsonify({key: [row.to_dict() for row in rows]}).get_data()
+
+    def test_lean_bodies_match_jsonify(self):
+        expected = {
+            "/users": self.jsonify_body("users", User),
+            "/logs": self.jsonify_body("logs", ActivityLog),
+            "/logs/user/" + self.user_id: self.jsonify_body(
+                "logs", ActivityLog, ActivityLog.user_id == self.user_id
+            ),
+        }
+        for path, body in expected.items():
+            self.assertEqual(self.client.get(path).get_data(), body, path)
+            self.assertEqual(self.client.get(path + "?stream=true").get_data(), body, path)
+
+    def test_pages_match_jsonify(self):
+        logs = json.loads(self.jsonify_body("logs", ActivityLog).decode())["logs"]
+        first = self.client.get("/logs?limit=2").get_data()
+        cursor = json.loads(first.decode())["next"]
+        second = self.client.get("/logs?limit=2&after=" + cursor).get_data()
+
+        with self.app.test_request_context():
+            self.assertEqual(first, jsonify({"logs": logs[:2], "next": cursor}).get_data())
+            self.assertEqual(second, jsonify({
+                "logs": logs[2:4],
+                "next": encode_cursor(to_datetime(logs[3]["created_at"]), logs[3]["id"]),
+            }).get_data())
+
+    def test_attributes_stored_canonical(self):
+        with self.app.app_context():
+            rows = db.session.execute('SELECT attributes FROM "ActivityLog"').fetchall()
+        for (attributes,) in rows:
+            self.assertEqual(
+                attributes,
+                json.dumps(json.loads(attributes), sort_keys=True, separators=(",", ":"))
+            )
+
+    def test_pretty_print_falls_back(self):
+        self.app.config["JSONIFY_PRETTYPRINT_REGULAR"] = True
+
+        body = self.client.get("/users").get_data(as_text=True)
+        self.assertIn('\n  "users": [', body)
+        self.assertEqual(
+            json.loads(body),
+            json.loads(self.client.get("/users?stream=true").get_data(as_text=True))
+        )
+
+
+class FilterTests(Base, unittest.TestCase):
+
+    def setUp(self):
+        super(FilterTests, self).setUp()
+        self.one, self.two = str(uuid.uuid4()), str(uuid.uuid4())
+        logs = [
+            make_log("create", self.one), make_log("create", self.two),
+            make_log("update", self.one), make_log("delete", self.two),
+            make_log("update", self.one),
+        ]
+        for minute, log in enumerate(logs):
+            log["created_at"] = "2020-02-18T11:{:02d}:00.000000Z".format(minute)
+        self.replay(logs)
+
+    def actions(self, **params):
+        response = self.client.get("/logs", query_string=params)
+        self.assertEqual(response.status_code, 200, response.get_data())
+        return [(log["action"], log["user_id"]) for log in response.get_json()["logs"]]
+
+    def test_action(self):
+        self.assertEqual(self.actions(action="update"), [("update", self.one)] * 2)
+        self.assertEqual(
+            self.actions(action="create,delete"),
+            [("create", self.one), ("create", self.two), ("delete", self.two)]
+        )
+
+    def test_user_ids(self):
+        self.assertEqual(len(self.actions(user_id=self.one)), 3)
+        self.assertEqual(len(self.actions(user_id=[self.one, self.two])), 5)
+        self.assertEqual(self.actions(user_id=self.two, action="delete"), [("delete", self.two)])
+
+    def test_time_range(self):
+        self.assertEqual(
+            self.actions(since="2020-02-18T11:01:00.000000Z", until="2020-02-18T11:03:00.000000Z"),
+            [("create", self.two), ("update", self.one)]
+        )
+
+    def test_descending_pages(self):
+        everything = self.client.get("/logs").get_json()["logs"]
+        newest_first, params = [], {"order": "desc", "limit": 2}
+        while True:
+            page = self.client.get("/logs", query_string=params).get_json()
+            newest_first.extend(page["logs"])
+            if page["next"] is None:
+                break
+            params["after"] = page["next"]
+
+        self.assertEqual(newest_first, everything[::-1])
+        self.assertEqual(
+            self.client.get("/logs?order=desc&stream=true").get_json()["logs"],
+            everything[::-1]
+        )
+
+    def test_user_logs_filtered(self):
+        response = self.client.get("/logs/user/" + self.one, query_string={"action": "update"})
+
+        self.assertEqual(len(response.get_json()["logs"]), 2)
+
+    def test_invalid_filters(self):
+        for params in (
+            {"action": "drop"}, {"since": "yesterday"}, {"order": "random"},
+            {"user_id": ",".join(str(i) for i in range(501))},
+            {"order": "up", "stream": "true"},
+        ):
+            response = self.client.get("/logs", query_string=params)
+            self.assertEqual(response.status_code, 400, params)
+
+
+class RollupTests(Base, unittest.TestCase):
+
+    def setUp(self):
+        super(RollupTests, self).setUp()
+        self.one, self.two = str(uuid.uuid4()), str(uuid.uuid4())
+        logs = [
+            make_log("create", self.one), make_log("create", self.two),
+            make_log("update", self.one), make_log("delete", self.two),
+        ]
+        for log, created_at in zip(logs, (
+            "2020-02-18T11:24:01.764973Z", "2020-02-18T11:59:59.000000Z",
+            "2020-02-18T12:00:00.000000Z", "2020-02-19T00:30:00.000000Z",
+        )):
+            log["created_at"] = created_at
+        self.replay(logs)
+
+    def stats(self, **params):
+        response = self.client.get("/logs/stats", query_string=params)
+        self.assertEqual(response.status_code, 200, response.get_data())
+        return response.get_json()
+
+    def rollups(self):
+        with self.app.app_context():
+            return sorted(
+                tuple(row) for row in db.session.query(
+                    ActivityRollup.granularity, ActivityRollup.user_id, ActivityRollup.bucket,
+                    ActivityRollup.action, ActivityRollup.count
+                )
+            )
+
+    def test_hour_histogram(self):
+        self.assertEqual(self.stats(), {
+            "granularity": "hour",
+            "buckets": [
+                {"bucket": "2020-02-18T11:00:00.000000Z", "counts": {"create": 2}, "total": 2},
+                {"bucket": "2020-02-18T12:00:00.000000Z", "counts": {"update": 1}, "total": 1},
+                {"bucket": "2020-02-19T00:00:00.000000Z", "counts": {"delete": 1}, "total": 1},
+            ],
+            "total": 4,
+        })
+
+    def test_filters(self):
+        self.assertEqual(self.stats(granularity="day", user_id=self.one)["buckets"], [
+            {"bucket": "2020-02-18T00:00:00.000000Z", "counts": {"create": 1, "update": 1}, "total": 2},
+        ])
+        self.assertEqual(self.stats(granularity="minute", action="create")["total"], 2)
+        self.assertEqual(
+            self.stats(since="2020-02-18T11:30:00.000000Z", until="2020-02-19T00:00:00.000000Z")["total"],
+            3
+        )
+
+    def test_counts_api_writes(self):
+        user = self.client.post("/users", json={"email": "foo@bar.com", "name": "foo"}).get_json()
+        self.client.patch("/users/" + user["id"], json={"name": "bar"})
+
+        counts = self.stats(granularity="day", user_id=user["id"])["buckets"][0]["counts"]
+        self.assertEqual(counts, {"create": 1, "update": 1})
+
+    def test_rebuild(self):
+        counted = self.rollups()
+        with self.app.app_context():
+            db.session.query(ActivityRollup).delete()
+            db.session.commit()
+        result = self.app.test_cli_runner().invoke(args=["rebuild-rollups", "--batch-size", "3"])
+
+        self.assertEqual(result.exit_code, 0, result.output or repr(result.exception))
+        self.assertEqual(self.rollups(), counted)
+
+    def test_rolled_back_writes_not_counted(self):
+        counted = self.rollups()
+        self.replay([make_log("create", str(uuid.uuid4())), make_log("create", self.one)])
+
+        self.assertEqual(self.rollups(), counted)
+
+    def test_wipe(self):
+        self.replay([])
+
+        self.assertEqual(self.rollups(), [])
+        self.assertEqual(self.stats()["buckets"], [])
+
+    def test_invalid_parameters(self):
+        for params in ({"granularity": "week"}, {"action": "drop"}, {"since": "now"}):
+            response = self.client.get("/logs/stats", query_string=params)
+            self.assertEqual(response.status_code, 400, params)
+
+
+class SnapshotTests(Base, unittest.TestCase):
+
+    def setUp(self):
+        super(SnapshotTests, self).setUp()
+        self.runner = self.app.test_cli_runner()
+        self.minute = 0
+
+    def replay_at(self, *logs):
+        """
+        Replays logs created one minute after another
+        """
+        for log in logs:
+            log["created_at"] = "2020-02-18T11:{:02d}:00.000000Z".format(self.minute)
+            self.minute += 1
+        response = self.replay(list(logs))
+        self.assertEqual(response.status_code, 204, response.get_data())
+
+    def invoke(self, *args):
+        result = self.runner.invoke(args=list(args))
+        self.assertEqual(result.exit_code, 0, result.output or repr(result.exception))
+        return result.output
+
+    def users(self):
+        return self.client.get("/users").get_json()["users"]
+
+    def count(self, model):
+        with self.app.app_context():
+            return model.query.count()
+
+    def test_rebuild_from_snapshot(self):
+        one, two, three = (str(uuid.uuid4()) for _ in range(3))
+        self.replay_at(make_log("create", one), make_log("create", two), make_log("update", one, name="one"))
+        self.invoke("snapshot")
+        self.replay_at(make_log("delete", two), make_log("create", three), make_log("update", one, name="uno"))
+        users = self.users()
+        with self.app.app_context():
+            User.query.delete()
+            db.session.commit()
+
+        self.assertIn("Applied 3 logs on top of snapshot", self.invoke("rebuild-users"))
+        self.assertEqual(self.users(), users)
+        self.assertEqual(self.client.get("/users/" + one).get_json()["name"], "uno")
+
+    def test_rebuild_without_snapshot(self):
+        one, two = str(uuid.uuid4()), str(uuid.uuid4())
+        self.replay_at(make_log("create", one), make_log("create", two), make_log("delete", one))
+        users = self.users()
+
+        self.assertIn("Applied 3 logs on top of no snapshot", self.invoke("rebuild-users"))
+        self.assertEqual(self.users(), users)
+
+    def test_older_log_discards_snapshot(self):
+        self.minute = 30
+        self.replay_at(make_log("create", str(uuid.uuid4())))
+        self.invoke("snapshot")
+        self.minute = 10
+        self.replay_at(make_log("create", str(uuid.uuid4())))
+
+        self.assertEqual(self.count(Snapshot), 0)
+        self.assertEqual(self.count(SnapshotUser), 0)
+
+    def test_prune(self):
+        self.replay_at(make_log("create", str(uuid.uuid4())))
+        for _ in range(3):
+            self.invoke("snapshot", "--keep", "2")
+
+        self.assertEqual(self.count(Snapshot), 2)
+        self.assertEqual(self.count(SnapshotUser), 2)
+
+    def test_compaction(self):
+        one, two = str(uuid.uuid4()), str(uuid.uuid4())
+        self.replay_at(
+            make_log("create", one), make_log("create", two),
+            *[make_log("update", one, name="one {}".format(i)) for i in range(3)]
+        )
+        self.replay_at(make_log("update", two), make_log("update", two), make_log("delete", two))
+        users = self.users()
+
+        self.assertIn("Deleted 4 superseded", self.invoke("compact", "--batch-size", "2"))
+        actions = [(log["action"], log["user_id"]) for log in self.client.get("/logs").get_json()["logs"]]
+        self.assertEqual(actions, [
+            ("create", one), ("create", two), ("update", one), ("delete", two),
+        ])
+        self.assertEqual(self.client.get("/logs/stats").get_json()["total"], 4)
+
+        self.invoke("rebuild-users")
+        self.assertEqual(self.users(), users)
+        with self.app.app_context():
+            before = sorted(tuple(row) for row in db.session.query(
+                ActivityRollup.granularity, ActivityRollup.user_id, ActivityRollup.bucket,
+                ActivityRollup.action, ActivityRollup.count).filter(ActivityRollup.count > 0))
+        self.invoke("rebuild-rollups")
+        with self.app.app_context():
+            after = sorted(tuple(row) for row in db.session.query(
+                ActivityRollup.granularity, ActivityRollup.user_id, ActivityRollup.bucket,
+                ActivityRollup.action, ActivityRollup.count))
+        self.assertEqual(before, after)
+
+    def test_compaction_keeps_recent_logs(self):
+        user_id = str(uuid.uuid4())
+        self.replay_at(make_log("create", user_id), make_log("update", user_id), make_log("update", user_id))
+        self.client.patch("/users/" + user_id, json={"name": "recent"})
+
+        self.assertIn("Deleted 0 superseded", self.invoke("compact", "--retention-days", "36500"))
+        self.assertIn("Deleted 2 superseded", self.invoke("compact"))
+        self.assertIn("Deleted 0 superseded", self.invoke("compact", "--retention-days", "0"))
+        self.assertEqual(len(self.client.get("/logs/user/" + user_id).get_json()["logs"]), 2)
+
+class AsOfTests(Base, unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.app = create_app(testing=True, config={"ARCHIVE_DIR": self.directory})
+        self.client = self.app.test_client()
+        self.runner = self.app.test_cli_runner()
+        self.ids = one, two, three = sorted(str(uuid.uuid4()) for _ in range(3))
+        self.logs = [
+            make_log("create", one, name="one"),
+            make_log("create", two, name="two"),
+            make_log("update", one, name="one new"),
+            make_log("delete", two),
+            make_log("update", one, name="one newer"),
+            make_log("create", three, name="three"),
+            make_log("create", two, name="two again"),
+        ]
+        for minute, log in enumerate(self.logs):
+            log["created_at"] = "2020-02-18T11:{:02d}:00.000000Z".format(minute)
+        # every log time, and times between them
+        self.times = ["2020-02-18T10:59:59.999999Z"] + [
+            "2020-02-18T11:{:02d}:{}".format(minute, second)
+            for minute in range(len(self.logs)) for second in ("00.000000Z", "30.000000Z")
+        ]
+
+    def tearDown(self):
+        super(AsOfTests, self).tearDown()
+        shutil.rmtree(self.directory)
+
+    def replayed(self, as_of):
+        """
+        Gives client of a new app holding the logs created up to as_of
+        """
+        client = create_app(testing=True).test_client()
+        logs = [log for log in self.logs if log["created_at"] <= as_of]
+        if logs:
+            self.assertEqual(client.post("/logs/replay", json={"logs": logs}).status_code, 204)
+        return client
+
+    def assert_history(self):
+        for as_of in self.times:
+            expected = self.replayed(as_of)
+            self.assertEqual(
+                self.client.get("/users", query_string={"as_of": as_of}).get_json(),
+                expected.get("/users").get_json(), as_of)
+            for user_id in self.ids:
+                response = self.client.get("/users/" + user_id, query_string={"as_of": as_of})
+                reference = expected.get("/users/" + user_id)
+                self.assertEqual(response.status_code, reference.status_code, as_of)
+                self.assertEqual(response.get_json(), reference.get_json(), as_of)
+
+    def test_from_logs(self):
+        self.replay(self.logs)
+        self.assert_history()
+
+    def test_from_checkpoints(self):
+        self.replay(self.logs[:2])
+        self.runner.invoke(args=["snapshot", "--keep", "5"])
+        self.replay(self.logs[2:5])
+        self.runner.invoke(args=["snapshot", "--keep", "5"])
+        self.replay(self.logs[5:])
+        with self.app.app_context():
+            self.assertEqual(Snapshot.query.count(), 2)
+        self.assert_history()
+
+    def test_from_archive(self):
+        self.replay(self.logs)
+        self.runner.invoke(args=["snapshot"])
+        self.runner.invoke(args=["archive", "--older-than-days", "1", "--segment-size", "3"])
+        with self.app.app_context():
+            self.assertEqual(ActivityLog.query.count(), 0)
+        self.assert_history()
+
+    def test_pages(self):
+        self.replay(self.logs)
+        as_of = self.logs[-1]["created_at"]
+        users = self.client.get("/users", query_string={"as_of": as_of}).get_json()["users"]
+        for order, expected in (("asc", users), ("desc", users[::-1])):
+            params = {"as_of": as_of, "limit": 2, "order": order}
+            first = self.client.get("/users", query_string=params).get_json()
+            params["after"] = first["next"]
+            second = self.client.get("/users", query_string=params).get_json()
+            self.assertEqual(first["users"] + second["users"], expected)
+            self.assertIsNone(second["next"])
+
+    def test_invalid_as_of(self):
+        for path in ("/users", "/users/" + self.ids[0]):
+            response = self.client.get(path, query_string={"as_of": "yesterday"})
+            self.assertEqual(response.status_code, 400)
+
+
+class ExportTests(Base, unittest.TestCase):
+
+    def setUp(self):
+        super(ExportTests, self).setUp()
+        self.user_id = str(uuid.uuid4())
+        logs = [make_log("create", self.user_id, name="Zo\u00eb")] + [
+            make_log("update", self.user_id, name="name {}".format(i)) for i in range(4)
+        ] + [make_log("create", str(uuid.uuid4())), make_log("delete", self.user_id)]
+        # export order is (created_at, id), replay order has to follow it
+        for second, log in enumerate(logs):
+            log["created_at"] = "2020-02-18T11:24:{:02d}.764973Z".format(second)
+        self.replay(logs)
+        self.logs = self.client.get("/logs").get_json()["logs"]
+
+    def export(self, **params):
+        response = self.client.get("/logs/export", query_string=params)
+        self.assertEqual(response.status_code, 200, response.get_data())
+        self.assertEqual(response.mimetype, "application/x-ndjson")
+        return response
+
+    def test_lines(self):
+        lines = self.export().get_data(as_text=True).splitlines()
+
+        self.assertEqual([json.loads(line) for line in lines], self.logs)
+
+    def test_resume(self):
+        self.assertEqual(
+            [json.loads(line) for line in self.export(after_id=self.logs[2]["id"]).get_data().splitlines()],
+            self.logs[3:]
+        )
+        self.assertEqual(self.export(after_id=self.logs[-1]["id"]).get_data(), b"")
+        response = self.client.get("/logs/export", query_string={"after_id": "missing"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_round_trip_gzip(self):
+        response = self.client.get("/logs/export", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        body = response.get_data()
+        self.assertEqual(gzip.decompress(body).decode(), self.export().get_data(as_text=True))
+
+        self.replay([])
+        replayed = self.client.post(
+            "/logs/replay", data=body,
+            headers={"Content-Type": "application/x-ndjson", "Content-Encoding": "gzip"}
+        )
+        self.assertEqual(replayed.get_json(), {"applied": len(self.logs)})
+        self.assertEqual(self.client.get("/logs").get_json()["logs"], self.logs)
+
+    def test_corrupt_gzip(self):
+        response = self.client.post(
+            "/logs/replay", data=b"not gzip",
+            headers={"Content-Type": "application/x-ndjson", "Content-Encoding": "gzip"}
+        )
+
+        self.assertEqual(response.status_code, 400)
+
+
+class ArchiveTests(Base, unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.app = create_app(testing=True, config=dict(self.config, ARCHIVE_DIR=self.directory))
+        self.client = self.app.test_client()
+        self.runner = self.app.test_cli_runner()
+        self.one, self.two = str(uuid.uuid4()), str(uuid.uuid4())
+        logs = [make_log("create", self.one), make_log("create", self.two)]
+        for i in range(16):
+            logs.append(make_log("update", (self.one, self.two)[i % 2], name="name {}".format(i)))
+        logs.append(make_log("delete", self.two))
+        self.replay_at(logs, "2020-02-18T11:{:02d}:00.000000Z", range(0, 38, 2))
+        self.client.post("/users", json={"email": "foo@bar.com", "name": "recent"})
+
+    def tearDown(self):
+        super(ArchiveTests, self).tearDown()
+        shutil.rmtree(self.directory)
+
+    def replay_at(self, logs, pattern, minutes):
+        for log, minute in zip(logs, minutes):
+            log["created_at"] = pattern.format(minute)
+        self.assertEqual(self.replay(logs).status_code, 204)
+
+    def invoke(self, *args):
+        result = self.runner.invoke(args=list(args))
+        self.assertEqual(result.exit_code, 0, result.output or repr(result.exception))
+        return result.output
+
+    def responses(self):
+        """
+        Gives bodies of the log reads, paging through them when paginated
+        """
+        bodies = {}
+        for path in (
+            "/logs", "/logs?stream=true", "/logs/export", "/logs/user/" + self.one,
+            "/logs/user/{}?stream=true&order=desc".format(self.two),
+            "/logs?action=update&since=2020-02-18T11:10:00.000000Z&until=2020-02-18T11:30:00.000000Z",
+            "/logs?user_id={},{}&order=desc".format(self.one, self.two),
+        ):
+            bodies[path] = self.client.get(path).get_data()
+        for params in ({"limit": 3}, {"limit": 4, "order": "desc"}, {"limit": 2, "action": "update"}):
+            pages, params = [], dict(params)
+            while True:
+                page = self.client.get("/logs", query_string=params)
+                pages.append(page.get_data())
+                cursor = page.get_json()["next"]
+                if cursor is None:
+                    break
+                params["after"] = cursor
+            bodies[repr(sorted(params.items()))] = pages
+        return bodies
+
+    def test_reads_unchanged(self):
+        before = self.responses()
+
+        self.assertIn("Archived 19 logs", self.invoke("archive", "--older-than-days", "1", "--segment-size", "7"))
+        with self.app.app_context():
+            self.assertEqual(ActivityLog.query.count(), 1)
+            self.assertEqual(ArchiveSegment.query.count(), 3)
+            self.assertEqual(ArchivedLog.query.count(), 19)
+        self.assertEqual(len(os.listdir(self.directory)), 9)
+        after = self.responses()
+        for key in before:
+            self.assertEqual(after[key], before[key], key)
+
+    def test_overlapping_segments(self):
+        self.invoke("archive", "--older-than-days", "1")
+        three = str(uuid.uuid4())
+        self.replay_at(
+            [make_log("create", three), make_log("update", three), make_log("delete", three)],
+            "2020-02-18T11:{:02d}:30.000000Z", (1, 15, 40)
+        )
+        before = self.responses()
+        self.invoke("archive", "--older-than-days", "1")
+
+        self.assertEqual(self.responses(), before)
+        created = [log["created_at"] for log in self.client.get("/logs").get_json()["logs"]]
+        self.assertEqual(created, sorted(created))
+        self.assertEqual(len(created), 23)
+
+    def test_pretty_print(self):
+        self.app.config["JSONIFY_PRETTYPRINT_REGULAR"] = True
+        before = self.client.get("/logs?limit=5&order=desc").get_json()
+        self.invoke("archive", "--older-than-days", "1")
+
+        self.assertEqual(self.client.get("/logs?limit=5&order=desc").get_json(), before)
+
+    def test_replay_refuses_archived_ids(self):
+        log_id = self.client.get("/logs?limit=1").get_json()["logs"][0]["id"]
+        self.invoke("archive", "--older-than-days", "1")
+
+        response = self.replay([make_log("create", str(uuid.uuid4()), log_id=log_id)])
+        self.assertEqual(response.status_code, 400)
+
+    def test_export_resumes_after_archived_log(self):
+        logs = self.client.get("/logs").get_json()["logs"]
+        self.invoke("archive", "--older-than-days", "1")
+
+        lines = self.client.get("/logs/export", query_string={"after_id": logs[10]["id"]}).get_data()
+        self.assertEqual([json.loads(line) for line in lines.splitlines()], logs[11:])
+
+    def test_rebuilds(self):
+        users = self.client.get("/users").get_json()
+        with self.app.app_context():
+            rollups = sorted(tuple(row) for row in db.session.query(
+                ActivityRollup.granularity, ActivityRollup.user_id, ActivityRollup.bucket,
+                ActivityRollup.action, ActivityRollup.count))
+        self.invoke("archive", "--older-than-days", "1")
+
+        self.assertIn("Applied 20 logs on top of no snapshot", self.invoke("rebuild-users"))
+        self.assertEqual(self.client.get("/users").get_json(), users)
+        self.invoke("rebuild-rollups")
+        with self.app.app_context():
+            self.assertEqual(sorted(tuple(row) for row in db.session.query(
+                ActivityRollup.granularity, ActivityRollup.user_id, ActivityRollup.bucket,
+                ActivityRollup.action, ActivityRollup.count)), rollups)
+
+    def test_wipe(self):
+        self.invoke("archive", "--older-than-days", "1")
+        self.replay([])
+
+        self.assertEqual(os.listdir(self.directory), [])
+        self.assertEqual(self.client.get("/logs").get_json(), {"logs": []})
+        self.assertEqual(self.client.get("/logs/export").get_data(), b"")
+
+
+class DeltaArchiveTests(ArchiveTests):
+    """
+    ArchiveTests with delta encoded logs, whose bases get archived first
+    """
+
+    config = {"LOG_ENCODING": "delta", "LOG_KEYFRAME_INTERVAL": 3}
+
+
+class DeltaSnapshotTests(SnapshotTests):
+    """
+    SnapshotTests with delta encoded logs, whose bases get compacted
+    """
+
+    config = {"LOG_ENCODING": "delta", "LOG_KEYFRAME_INTERVAL": 3}
+
+
+class DeltaEncodingTests(Base, unittest.TestCase):
+
+    config = {"LOG_ENCODING": "delta", "LOG_KEYFRAME_INTERVAL": 3}
+
+    def setUp(self):
+        super(DeltaEncodingTests, self).setUp()
+        self.runner = self.app.test_cli_runner()
+
+    def stored(self, user_id):
+        """
+        Gives (id, action, stored attributes, base_id) of the logs of a user in order
+        """
+        with self.app.app_context():
+            return [
+                (log.id, log.action.code, log.attributes, log.base_id)
+                for log in ActivityLog.query.filter_by(user_id=user_id).order_by(
+                    ActivityLog.created_at, ActivityLog.id)
+            ]
+
+    def responses(self, user_id):
+        bodies = {}
+        for path in (
+            "/logs", "/logs?stream=true", "/logs/export", "/logs?limit=2&order=desc",
+            "/logs/user/" + user_id, "/logs/user/{}?stream=true".format(user_id),
+        ):
+            bodies[path] = self.client.get(path).get_data()
+        return bodies
+
+    def test_replayed_logs(self):
+        user_id = str(uuid.uuid4())
+        logs = [make_log("create", user_id)]
+        logs += [make_log("update", user_id, name="name {}".format(i)) for i in range(5)]
+        logs.append(make_log("delete", user_id, name="name 4"))
+        for minute, log in enumerate(logs):
+            log["created_at"] = "2020-02-18T11:{:02d}:00.000000Z".format(minute)
+        self.assertEqual(self.replay(logs).status_code, 204)
+
+        stored = self.stored(user_id)
+        self.assertEqual([base_id for id, action, attributes, base_id in stored], [
+            None, logs[0]["id"], logs[0]["id"], logs[0]["id"], None, logs[4]["id"], logs[4]["id"],
+        ])
+        self.assertEqual(stored[1][2], {"name": "name 0"})
+        self.assertEqual(stored[6][2], {"name": "name 4"})
+        served = self.client.get("/logs/user/" + user_id).get_json()["logs"]
+        self.assertEqual(served, logs)
+
+    def test_api_writes(self):
+        user = self.client.post("/users", json={"email": "foo@bar.com", "name": "foo"}).get_json()
+        changed = [
+            self.client.patch("/users/" + user["id"], json={"name": name}).get_json() for name in ("bar", "baz")
+        ]
+        self.client.delete("/users/" + user["id"])
+
+        stored = self.stored(user["id"])
+        self.assertEqual([base_id for id, action, attributes, base_id in stored], [None] + [stored[0][0]] * 3)
+        self.assertEqual([attributes for id, action, attributes, base_id in stored[1:]], [
+            {"name": "bar"}, {"name": "baz"}, {"name": "baz"},
+        ])
+        served = [log["attributes"] for log in self.client.get("/logs/user/" + user["id"]).get_json()["logs"]]
+        self.assertEqual(served, [user] + changed + [changed[-1]])
+
+    def test_encode_logs(self):
+        self.app.config["LOG_ENCODING"] = "full"
+        user_id = str(uuid.uuid4())
+        self.replay([make_log("create", user_id, name="caf\u00e9")] + [
+            make_log("update", user_id, name="n\u00e4me {}".format(i)) for i in range(8)])
+        before = self.responses(user_id)
+
+        self.assertIn("Re-encoded 6 logs", self.runner.invoke(args=["encode-logs"]).output)
+        self.assertEqual(sum(base_id is not None for id, action, attributes, base_id in self.stored(user_id)), 6)
+        self.assertEqual(self.responses(user_id), before)
+
+        self.assertIn("Re-encoded 6 logs", self.runner.invoke(args=["encode-logs", "--encoding", "full"]).output)
+        self.assertEqual(sum(base_id is not None for id, action, attributes, base_id in self.stored(user_id)), 0)
+        self.assertEqual(self.responses(user_id), before)
+
+
+class BinaryUUIDTests(Base, unittest.TestCase):
+
+    def test_stored_as_bytes(self):
+        user = self.client.post("/users", json={"email": "foo@bar.com", "name": "foo"}).get_json()
+        log = self.client.get("/logs/user/" + user["id"]).get_json()["logs"][0]
+
+        with self.app.app_context():
+            stored = db.session.execute(
+                'SELECT typeof(l.id), length(l.id), typeof(l.user_id), hex(u.id) '
+                'FROM ActivityLog l JOIN user u ON u.id = l.user_id').fetchall()
+        self.assertEqual(stored, [("blob", 16, "blob", uuid.UUID(user["id"]).hex.upper())])
+        self.assertEqual(str(uuid.UUID(log["id"])), log["id"])
+        self.assertEqual(self.client.get("/users/" + user["id"]).get_json(), user)
+
+    def test_byte_order_matches_text_order(self):
+        # created at the same time, ordered by id alone
+        user_ids = [str(uuid.uuid4()) for _ in range(20)]
+        logs = [make_log("create", user_id) for user_id in user_ids]
+        self.replay(logs)
+
+        served = [log["id"] for log in self.client.get("/logs").get_json()["logs"]]
+        self.assertEqual(served, sorted(log["id"] for log in logs))
+        paged = []
+        params = {"limit": 3}
+        while True:
+            page = self.client.get("/users", query_string=params).get_json()
+            paged.extend(user["id"] for user in page["users"])
+            if page["next"] is None:
+                break
+            params = {"limit": 3, "after": page["next"]}
+        self.assertEqual(paged, sorted(user_ids))
+
+    def test_non_canonical_ids(self):
+        user = self.client.post("/users", json={"email": "foo@bar.com", "name": "foo"}).get_json()
+
+        for user_id in (user["id"].upper(), user["id"].replace("-", ""), "not-a-uuid"):
+            self.assertEqual(self.client.get("/users/" + user_id).status_code, 404)
+            self.assertEqual(self.client.get("/logs/user/" + user_id).get_json()["logs"], [])
+
+
+class MetricsTests(Base, unittest.TestCase):
+
+    def metric(self, text, line):
+        """
+        Gives value of the metric line starting with `line`
+        """
+        for found in text.splitlines():
+            if found.startswith(line + " "):
+                return float(found.rsplit(" ", 1)[1])
+        self.fail("{} not in metrics".format(line))
+
+    def test_route_metrics(self):
+        user = self.client.post("/users", json={"email": "foo@bar.com", "name": "foo"}).get_json()
+        for _ in range(3):
+            self.client.get("/users/" + user["id"])
+        self.client.get("/users/" + str(uuid.uuid4()))
+        self.client.get("/logs?stream=true").get_data()
+        self.client.get("/nowhere")
+
+        response = self.client.get("/metrics")
+        self.assertEqual(response.mimetype, "text/plain")
+        text = response.get_data(as_text=True)
+        route = 'method="GET",route="/users/<user_id>"'
+        self.assertEqual(self.metric(text, 'http_requests_total{%s,status="200"}' % route), 3)
+        self.assertEqual(self.metric(text, 'http_requests_total{%s,status="404"}' % route), 1)
+        self.assertEqual(self.metric(text, 'http_requests_total{method="GET",route="unmatched",status="404"}'), 1)
+        self.assertEqual(self.metric(text, 'http_request_duration_seconds_count{%s}' % route), 4)
+        self.assertEqual(self.metric(text, 'http_request_duration_seconds_bucket{%s,le="+Inf"}' % route), 4)
+        self.assertGreater(self.metric(text, 'sql_statements_per_request_sum{%s}' % route), 0)
+        self.assertGreater(self.metric(text, 'sql_statement_duration_seconds_total{%s}' % route), 0)
+        self.assertEqual(self.metric(text, 'http_response_size_bytes_count{%s}' % route), 4)
+
+        created = 'method="POST",route="/users"'
+        self.assertEqual(self.metric(text, 'db_request_commits_total{%s}' % created), 1)
+        self.assertGreater(self.metric(text, 'http_request_size_bytes_sum{%s}' % created), 0)
+        self.assertGreaterEqual(self.metric(text, "db_commits_total"), 1)
+        # streamed bodies are measured once they are sent
+        streamed = 'method="GET",route="/logs"'
+        self.assertEqual(self.metric(text, 'http_request_duration_seconds_count{%s}' % streamed), 1)
+        self.assertGreater(self.metric(text, 'sql_statements_per_request_sum{%s}' % streamed), 0)
+        self.assertEqual(self.metric(text, 'http_response_size_bytes_count{%s}' % streamed), 0)
+
+    def test_slow_request_log(self):
+        self.app.extensions["metrics"].slow_seconds = 0
+        with self.assertLogs("service.metrics", "WARNING") as logs:
+            self.client.get("/users")
+        self.assertIn("Slow request GET /users?", logs.output[0])
+        self.assertIn('FROM user', logs.output[0])
+
+    def test_disabled(self):
+        app = create_app(testing=True, config={"METRICS": False})
+        self.assertEqual(app.test_client().get("/metrics").status_code, 404)
+
+
+def top_level(statement):
+    """
+    Gives statement without what is within parentheses, such as subqueries
+    """
+    depth, kept = 0, []
+    for char in statement:
+        if char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif depth == 0:
+            kept.append(char)
+    return "".join(kept)
+
+
+class QueryPlanTests(Base, unittest.TestCase):
+    """
+    Runs EXPLAIN QUERY PLAN on every statement issued by the hot endpoints
+    and fails when one of them scans a table instead of seeking an index
+    """
+
+    def setUp(self):
+        super(QueryPlanTests, self).setUp()
+        self.user_ids = [str(uuid.uuid4()) for _ in range(3)]
+        self.replay([make_log("create", user_id) for user_id in self.user_ids])
+        with self.app.app_context():
+            self.engine = db.engine
+        self.statements = []
+        event.listen(self.engine, "before_cursor_execute", self.record)
+
+    def tearDown(self):
+        event.remove(self.engine, "before_cursor_execute", self.record)
+        super(QueryPlanTests, self).tearDown()
+
+    def record(self, conn, cursor, statement, parameters, context, executemany):
+        verb = statement.lstrip().split(None, 1)[0].upper()
+        if verb not in ("INSERT", "EXPLAIN") and not executemany:
+            self.statements.append((statement, parameters))
+
+    def assert_indexed(self, method, path, **kwargs):
+        self.statements = []
+        response = self.client.open(path, method=method, **kwargs)
+        # streamed bodies run their queries while being read
+        response.get_data()
+        self.assertLess(response.status_code, 300, path)
+
+        statements, self.statements = self.statements, []
+        with self.engine.connect() as connection:
+            for statement, parameters in statements:
+                plan = [
+                    row[-1] for row in connection.execute(
+                        "EXPLAIN QUERY PLAN " + statement, parameters
+                    )
+                ]
+                filtered = "WHERE" in top_level(statement).upper().split()
+                for step in plan:
+                    # walking an index in order is only fine for unfiltered lists
+                    scans = step.startswith("SCAN") and ("USING" not in step or filtered)
+                    self.assertFalse(scans, "{} {}: {}\n{}".format(method, path, plan, statement))
+                    self.assertNotIn("TEMP B-TREE", step, "{} {}: {}".format(method, path, plan))
+        return response
+
+    def test_user_queries(self):
+        user_id = self.user_ids[0]
+        self.assert_indexed("GET", "/users/" + user_id)
+        self.assert_indexed("PATCH", "/users/" + user_id, json={"name": "new name"})
+        self.assert_indexed("POST", "/users", json={"email": "foo@bar.com", "name": "foo"})
+        self.assert_indexed("DELETE", "/users/" + user_id)
+
+    def test_list_queries(self):
+        for path in ("/users", "/logs"):
+            self.assert_indexed("GET", path)
+            page = self.assert_indexed("GET", path + "?limit=1").get_json()
+            self.assert_indexed("GET", path, query_string={"limit": 1, "after": page["next"]})
+        self.assert_indexed("GET", "/logs?stream=true")
+
+    def test_filtered_log_queries(self):
+        for params in (
+            {"action": "delete"},
+            {"action": "create", "since": TIMESTAMP, "until": TIMESTAMP},
+            {"user_id": self.user_ids[0], "order": "desc"},
+            {"since": TIMESTAMP, "order": "desc", "limit": 1},
+        ):
+            self.assert_indexed("GET", "/logs", query_string=params)
+        self.assert_indexed("GET", "/logs?action=create&stream=true")
+
+    def test_stats_queries(self):
+        self.assert_indexed("GET", "/logs/stats")
+        self.assert_indexed("GET", "/logs/stats", query_string={
+            "granularity": "minute", "user_id": self.user_ids[0], "action": "create",
+            "since": TIMESTAMP, "until": TIMESTAMP,
+        })
+
+    def test_export_queries(self):
+        logs = self.client.get("/logs").get_json()["logs"]
+        self.assert_indexed("GET", "/logs/export")
+        self.assert_indexed("GET", "/logs/export", query_string={"after_id": logs[0]["id"]})
+
+    def test_as_of_queries(self):
+        self.app.test_cli_runner().invoke(args=["snapshot"])
+        self.replay([make_log("update", self.user_ids[0])])
+        for path in ("/users", "/users/" + self.user_ids[0]):
+            self.assert_indexed("GET", path, query_string={"as_of": TIMESTAMP})
+
+    def test_user_log_queries(self):
+        self.assert_indexed("GET", "/logs/user/" + self.user_ids[0])
+        self.assert_indexed("GET", "/logs/user/" + self.user_ids[0] + "?stream=true")
+
+    def test_replay_queries(self):
+        self.assert_indexed("POST", "/logs/replay", json={"logs": [
+            make_log("update", self.user_ids[0]),
+            make_log("delete", self.user_ids[1]),
+            make_log("create", str(uuid.uuid4())),
+        ]})
+
+
+class UnitOfWorkTests(Base, unittest.TestCase):
+    """
+    Injects a failure while the activity log is written and checks that
+    the user change of the same request is not kept either
+    """
+
+    def setUp(self):
+        super(UnitOfWorkTests, self).setUp()
+        self.user = self.client.post(
+            "/users", json={"email": "foo@bar.com", "name": "foo"}
+        ).get_json()
+        with self.app.app_context():
+            self.engine = db.engine
+        self.commits = 0
+        event.listen(self.engine, "commit", self.count_commit)
+
+    def tearDown(self):
+        event.remove(self.engine, "commit", self.count_commit)
+        super(UnitOfWorkTests, self).tearDown()
+
+    def count_commit(self, conn):
+        self.commits += 1
+
+    def crash_on_log_insert(self, conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith('INSERT INTO "ActivityLog"'):
+            raise RuntimeError("crash while writing the activity log")
+
+    def assert_atomic(self, method, path, **kwargs):
+        before = (
+            self.client.get("/users").get_json(),
+            self.client.get("/logs").get_json(),
+        )
+        event.listen(self.engine, "before_cursor_execute", self.crash_on_log_insert)
+        try:
+            with self.assertRaises(RuntimeError):
+                self.client.open(path, method=method, **kwargs)
+        finally:
+            event.remove(self.engine, "before_cursor_execute", self.crash_on_log_insert)
+
+        self.assertEqual(self.client.get("/users").get_json(), before[0])
+        self.assertEqual(self.client.get("/logs").get_json(), before[1])
+
+    def test_create_is_atomic(self):
+        self.assert_atomic("POST", "/users", json={"email": "new@bar.com", "name": "new"})
+
+    def test_update_is_atomic(self):
+        self.assert_atomic("PATCH", "/users/" + self.user["id"], json={"name": "new name"})
+
+    def test_delete_is_atomic(self):
+        self.assert_atomic("DELETE", "/users/" + self.user["id"])
+
+    def test_one_commit_per_write(self):
+        self.client.post("/users", json={"email": "new@bar.com", "name": "new"})
+        self.client.patch("/users/" + self.user["id"], json={"name": "new name"})
+        self.client.delete("/users/" + self.user["id"])
+
+        self.assertEqual(self.commits, 3)
+        self.assertEqual(len(self.client.get("/logs").get_json()["logs"]), 4)
+
+
+class GroupCommitTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.app = create_app(config={
+            "SQLALCHEMY_DATABASE_URI": "sqlite:///" + os.path.join(self.directory, "db.sqlite3"),
+            "GROUP_COMMIT": True,
+            "GROUP_COMMIT_WINDOW": 0.05,
+        })
+        self.writer = self.app.extensions["group_commit"]
+        with self.app.app_context():
+            self.engine = db.engine
+        self.commits = 0
+        event.listen(self.engine, "commit", self.count_commit)
+
+    def tearDown(self):
+        self.writer.stop()
+        event.remove(self.engine, "commit", self.count_commit)
+        with self.app.app_context():
+            db.session.remove()
+            db.engine.dispose()
+        shutil.rmtree(self.directory)
+
+    def count_commit(self, conn):
+        self.commits += 1
+
+    def test_concurrent_writes_share_commits(self):
+        responses = []
+
+        def create(i):
+            responses.append(self.app.test_client().post(
+                "/users", json={"email": "foo@bar.com", "name": "user {}".format(i)}
+            ).status_code)
+
+        threads = [threading.Thread(target=create, args=(i,)) for i in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(responses, [201] * 20)
+        self.assertLess(self.commits, 20)
+        client = self.app.test_client()
+        self.assertEqual(len(client.get("/users").get_json()["users"]), 20)
+        self.assertEqual(len(client.get("/logs").get_json()["logs"]), 20)
+
+    def test_failing_write_is_isolated(self):
+        from service.views import create_user
+
+        def fail():
+            create_user({"email": "foo@bar.com", "name": "bad"})
+            raise ValueError("broken write")
+
+        good = self.writer.submit(create_user, {"email": "foo@bar.com", "name": "good"})
+        bad = self.writer.submit(fail)
+        other = self.writer.submit(create_user, {"email": "foo@bar.com", "name": "other"})
+
+        self.assertEqual(good.result()["name"], "good")
+        self.assertEqual(other.result()["name"], "other")
+        self.assertRaises(ValueError, bad.result)
+        users = self.app.test_client().get("/users").get_json()["users"]
+        self.assertEqual(sorted(user["name"] for user in users), ["good", "other"])
+
+    def test_stop_flushes_pending_writes(self):
+        from service.views import create_user
+        futures = [
+            self.writer.submit(create_user, {"email": "foo@bar.com", "name": "user {}".format(i)})
+            for i in range(5)
+        ]
+        self.writer.stop()
+
+        self.assertTrue(all(future.done() for future in futures))
+        self.assertEqual(len(self.app.test_client().get("/users").get_json()["users"]), 5)
+
+
+class PrepareWorkerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def make_app(self, **config):
+        config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + os.path.join(self.directory, "db.sqlite3")
+        return create_app(config=config)
+
+    def test_user_cache(self):
+        for workers, config, size in ((1, {}, 1024), (4, {}, 0), (4, {"USER_CACHE_TTL": 5.0}, 1024)):
+            app = self.make_app(**config)
+            prepare_worker(app, workers)
+            self.assertEqual(app.extensions["user_cache"].maxsize, size, (workers, config))
+
+    def test_forked_worker_writes(self):
+        app = self.make_app(GROUP_COMMIT=True)
+        self.addCleanup(app.extensions["group_commit"].stop)
+        app.test_client().get("/users")
+
+        pid = os.fork()
+        if pid == 0:
+            # the parent's writer thread is not copied, without a new one the write would hang
+            prepare_worker(app, 2)
+            response = app.test_client().post("/users", json={"email": "foo@bar.com", "name": "forked"})
+            os._exit(0 if response.status_code == 201 else 1)
+        deadline = time.monotonic() + 10
+        while True:
+            done, status = os.waitpid(pid, os.WNOHANG)
+            if done:
+                break
+            if time.monotonic() > deadline:
+                os.kill(pid, 9)
+                self.fail("forked worker hung")
+            time.sleep(0.05)
+        self.assertEqual(status, 0)
+        self.assertEqual(app.test_client().get("/users").get_json()["users"][0]["name"], "forked")
+
+
+class LeanStartupTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.migrated = os.path.join(cls.directory, "migrated.sqlite3")
+        # in another process, Alembic's logging setup would replace the one of the tests
+        subprocess.check_call(
+            [sys.executable, "-m", "flask", "db", "upgrade", "-d", MIGRATIONS_DIR],
+            env=dict(os.environ, DATABASE_URL="sqlite:///" + cls.migrated, CREATE_TABLES="false", FLASK_APP="run.py"),
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def make_app(self, path, **config):
+        config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + path
+        return create_app(config=config)
+
+    def test_migration_heads(self):
+        from alembic.script import ScriptDirectory
+        self.assertEqual(migration_heads(), set(ScriptDirectory(MIGRATIONS_DIR).get_heads()))
+
+    def test_serves_migrated_database(self):
+        app = self.make_app(self.migrated, LEAN_STARTUP=True)
+        self.assertNotIn("migrate", app.extensions)
+        self.assertFalse(app.config["SQLALCHEMY_TRACK_MODIFICATIONS"])
+        client = app.test_client()
+        response = client.post("/users", json={"email": "foo@bar.com", "name": "lean"})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(client.get("/users/" + response.get_json()["id"]).get_json()["name"], "lean")
+
+    def test_refuses_unmigrated_database(self):
+        path = os.path.join(self.directory, "created.sqlite3")
+        # tables created without Alembic have no revision
+        self.make_app(path)
+        with self.assertRaisesRegex(SchemaError, "at no revision"):
+            self.make_app(path, LEAN_STARTUP=True)
+
+    def test_refuses_outdated_database(self):
+        path = os.path.join(self.directory, "outdated.sqlite3")
+        shutil.copy(self.migrated, path)
+        app = self.make_app(path, LEAN_STARTUP=True)
+        with app.app_context():
+            db.engine.execute("UPDATE alembic_version SET version_num = '9b21c6f0e3d8'")
+        with self.assertRaisesRegex(SchemaError, "at 9b21c6f0e3d8"):
+            self.make_app(path, LEAN_STARTUP=True)
+
+    def test_defers_imports(self):
+        script = (
+            "import sys\n"
+            "from service.app import create_app\n"
+            "app = create_app(config={'LEAN_STARTUP': True})\n"
+            "app.test_client().post('/users', json={'email': 'foo@bar.com', 'name': 'lean'})\n"
+            "print(' '.join(name for name in ('cerberus', 'flask_migrate', 'alembic') if name in sys.modules))\n"
+        )
+        output = subprocess.check_output(
+            [sys.executable, "-c", script], env=dict(os.environ, DATABASE_URL="sqlite:///" + self.migrated),
+            stderr=subprocess.DEVNULL)
+        self.assertEqual(output.decode().strip(), "")
+
+
+class SQLiteProfileTests(unittest.TestCase):
+
+    def pragmas(self, profile):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        app = create_app(config={
+            "SQLALCHEMY_DATABASE_URI": "sqlite:///" + os.path.join(directory, "db.sqlite3"),
+            "SQLITE_PROFILE": profile,
+        })
+        with app.app_context():
+            values = {
+                name: db.session.execute("PRAGMA " + name).scalar()
+                for name in ("journal_mode", "synchronous", "busy_timeout", "temp_store")
+            }
+            db.session.remove()
+            db.engine.dispose()
+        return values
+
+    def test_default_profile(self):
+        self.assertEqual(
+            self.pragmas("default"),
+            {"journal_mode": "delete", "synchronous": 2, "busy_timeout": 5000, "temp_store": 0}
+        )
+
+    def test_performance_profile(self):
+        self.assertEqual(
+            self.pragmas("performance"),
+            {"journal_mode": "wal", "synchronous": 1, "busy_timeout": 5000, "temp_store": 2}
+        )
+
+    def test_unknown_profile(self):
+        self.assertRaises(ValueError, self.pragmas, "fastest")
+
+
+class UserCacheTests(Base, unittest.TestCase):
+
+    def setUp(self):
+        super(UserCacheTests, self).setUp()
+        self.user = self.client.post(
+            "/users", json={"email": "foo@bar.com", "name": "foo"}
+        ).get_json()
+        self.path = "/users/" + self.user["id"]
+
+    def get_name(self):
+        response = self.client.get(self.path)
+        return response.get_json()["name"] if response.status_code == 200 else None
+
+    def stats(self):
+        return self.client.get("/cache/stats").get_json()["users"]
+
+    def test_hits_and_misses(self):
+        self.assertEqual(self.get_name(), "foo")
+        self.assertEqual(self.get_name(), "foo")
+        self.client.get("/users/" + str(uuid.uuid4()))
+
+        stats = self.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["size"]), (1, 2, 1))
+
+    def test_update_and_delete_invalidate(self):
+        self.get_name()
+        self.client.patch(self.path, json={"name": "bar"})
+        self.assertEqual(self.get_name(), "bar")
+
+        self.client.delete(self.path)
+        self.assertIsNone(self.get_name())
+
+    def test_replay_invalidates(self):
+        self.get_name()
+        self.replay([make_log("update", self.user["id"], name="replayed")])
+        self.assertEqual(self.get_name(), "replayed")
+
+        self.client.post(
+            "/logs/replay",
+            data=json.dumps(make_log("update", self.user["id"], name="streamed")),
+            content_type="application/x-ndjson"
+        )
+        self.assertEqual(self.get_name(), "streamed")
+
+        self.replay([])
+        self.assertIsNone(self.get_name())
+
+    def test_failed_replay_keeps_cache(self):
+        self.get_name()
+        self.replay([
+            make_log("update", self.user["id"], name="never"),
+            make_log("create", self.user["id"]),
+        ])
+
+        self.assertEqual(self.get_name(), "foo")
+        self.assertEqual(self.stats()["hits"], 1)
+
+    def test_eviction_and_ttl(self):
+        cache = LRUCache(2, ttl=0.05)
+        for key in ("a", "b", "c"):
+            cache.get_or_load(key, lambda: key.upper())
+        self.assertEqual(cache.stats()["evictions"], 1)
+        self.assertEqual(list(cache.data), ["b", "c"])
+
+        time.sleep(0.06)
+        self.assertEqual(cache.get_or_load("c", lambda: "new"), "new")
+
+    def test_load_racing_with_write_is_not_cached(self):
+        cache = LRUCache(10)
+
+        def load_then_write():
+            # a write commits and invalidates while the old value is loaded
+            cache.invalidate(["a"])
+            return "old"
+
+        self.assertEqual(cache.get_or_load("a", load_then_write), "old")
+        self.assertEqual(cache.get_or_load("a", lambda: "new"), "new")
+
+
+class ConditionalGetTests(Base, unittest.TestCase):
+
+    def setUp(self):
+        super(ConditionalGetTests, self).setUp()
+        self.user = self.client.post(
+            "/users", json={"email": "foo@bar.com", "name": "foo"}
+        ).get_json()
+
+    def poll(self, path, etag):
+        return self.client.get(path, headers={"If-None-Match": '"{}"'.format(etag)})
+
+    def test_unchanged_poll_is_not_modified(self):
+        for path in ("/users", "/logs", "/logs/user/" + self.user["id"], "/users?limit=1"):
+            first = self.client.get(path)
+            etag = first.get_etag()[0]
+
+            second = self.poll(path, etag)
+            self.assertEqual(second.status_code, 304, path)
+            self.assertEqual(second.get_data(), b"")
+
+    def test_write_changes_etag(self):
+        etag = self.client.get("/users").get_etag()[0]
+        writes = [
+            lambda: self.client.post("/users", json={"email": "foo@bar.com", "name": "bar"}),
+            lambda: self.client.patch("/users/" + self.user["id"], json={"name": "baz"}),
+            lambda: self.replay([make_log("create", str(uuid.uuid4()))]),
+            lambda: self.client.delete("/users/" + self.user["id"]),
+            lambda: self.replay([]),
+        ]
+        for write in writes:
+            write()
+            response = self.poll("/users", etag)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.get_json(), {"users": response.get_json()["users"]})
+            self.assertNotEqual(response.get_etag()[0], etag)
+            etag = response.get_etag()[0]
+
+    def test_failed_write_keeps_etag(self):
+        etag = self.client.get("/users").get_etag()[0]
+        self.replay([make_log("create", self.user["id"])])
+        self.client.post("/users", json={"email": "foo@bar.com"})
+
+        self.assertEqual(self.poll("/users", etag).status_code, 304)
+
+    def test_body_cache(self):
+        first = self.client.get("/logs").get_data()
+        second = self.client.get("/logs").get_data()
+
+        self.assertEqual(first, second)
+        self.assertEqual(self.client.get("/cache/stats").get_json()["responses"]["hits"], 1)
+
+        self.client.patch("/users/" + self.user["id"], json={"name": "bar"})
+        logs = self.client.get("/logs").get_json()["logs"]
+        self.assertEqual(len(logs), 2)
+
+
+class ValidationTests(unittest.TestCase):
+    """
+    Compiled validators must agree with Cerberus on every document
+    """
+
+    def assert_same_errors(self, validator, schema, document):
+        v = Validator(schema)
+        expected = {} if v.validate(document) else v.errors
+        self.assertEqual(validator.errors(document), expected, document)
+
+    def test_log_documents(self):
+        valid = make_log("create", str(uuid.uuid4()))
+        documents = [valid, {}, {"extra": 1}, dict(valid, extra=1)]
+        for field, values in (
+                ("id", [None, 1, "", "not-a-uuid", valid["id"].upper(), valid["id"] + "\n"]),
+                ("action", ["create", "updated", None, ["create"]]),
+                ("created_at", ["2020-02-18T11:24:01Z", "2020-2-18T11:24:01.764973Z",
+                                "2020-02-30T11:24:01.764973Z", "2020-02-18T11:24:01.7649Z", 1]),
+                ("attributes", [None, [], {}, dict(valid["attributes"], name="x"),
+                                dict(valid["attributes"], updated_at="yesterday"),
+                                dict(valid["attributes"], extra="value")]),
+        ):
+            for value in values:
+                documents.append(dict(valid, **{field: value}))
+            documents.append({key: value for key, value in valid.items() if key != field})
+
+        for document in documents:
+            self.assert_same_errors(log_validator, log_schema, document)
+
+    def test_user_documents(self):
+        documents = [
+            {"email": "foo@bar.com", "name": "foo"},
+            {"email": "foo@bar.com", "name": "f"},
+            {"email": "foobar.com", "name": ""},
+            {"email": "foo@bar.com"},
+            {"email": None, "name": 12},
+            {"email": "foo@bar.com", "name": "foo", "id": "1"},
+            {},
+        ]
+        for document in documents:
+            self.assert_same_errors(user_validator, user_schema, document)
+            self.assert_same_errors(user_update_validator, user_update_schema, document)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,54 @@
+"""Add activity_rollup counts.
+
+Revision ID: 0d4f8b2e6a17
+Revises: 3c9a1e7d52b4
+Create Date: 2026-10-18 11:42:50.613904
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0d4f8b2e6a17'
+down_revision = '3c9a1e7d52b4'
+branch_labels = None
+depends_on = None
+
+# bucket start of created_at per granularity, as SQLAlchemy stores datetimes
+SQLITE_BUCKETS = {
+    'minute': "strftime('%Y-%m-%d %H:%M:00.000000', created_at)",
+    'hour': "strftime('%Y-%m-%d %H:00:00.000000', created_at)",
+    'day': "strftime('%Y-%m-%d 00:00:00.000000', created_at)",
+}
+POSTGRESQL_BUCKETS = {
+    granularity: "date_trunc('{}', created_at)".format(granularity)
+    for granularity in ('minute', 'hour', 'day')
+}
+
+
+def upgrade():
+    op.create_table('activity_rollup',
+    sa.Column('granularity', sa.String(length=6), nullable=False),
+    sa.Column('user_id', sa.String(length=255), nullable=False),
+    sa.Column('bucket', sa.DateTime(), nullable=False),
+    sa.Column('action', sa.String(length=6), nullable=False),
+    sa.Column('count', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('granularity', 'user_id', 'bucket', 'action')
+    )
+
+    # count the logs stored so far, per user and for all users ('')
+    connection = op.get_bind()
+    buckets = POSTGRESQL_BUCKETS if connection.dialect.name == 'postgresql' else SQLITE_BUCKETS
+    for granularity, bucket in buckets.items():
+        for user_id, group_by in (('user_id', 'user_id, '), ("''", '')):
+            connection.execute(
+                'INSERT INTO activity_rollup (granularity, user_id, bucket, action, count) '
+                "SELECT '{granularity}', {user_id}, {bucket}, action, count(*) "
+                'FROM "ActivityLog" GROUP BY {group_by}{bucket}, action'.format(
+                    granularity=granularity, user_id=user_id, bucket=bucket, group_by=group_by)
+            )
+
+
+def downgrade():
+    op.drop_table('activity_rollup')
@@ -0,0 +1,25 @@
+"""Index ActivityLog by (action, created_at, id).
+
+Revision ID: 3c9a1e7d52b4
+Revises: abfc6b529a89
+Create Date: 2026-10-18 11:05:12.418230
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3c9a1e7d52b4'
+down_revision = 'abfc6b529a89'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_ActivityLog_action_created_at', 'ActivityLog',
+                    ['action', 'created_at', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_ActivityLog_action_created_at', table_name='ActivityLog')
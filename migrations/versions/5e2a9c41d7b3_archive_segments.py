@@ -0,0 +1,43 @@
+"""Add archive segments of cold activity logs.
+
+Revision ID: 5e2a9c41d7b3
+Revises: 9b21c6f0e3d8
+Create Date: 2026-10-18 14:02:11.530917
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5e2a9c41d7b3'
+down_revision = '9b21c6f0e3d8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('archive_segment',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(length=32), nullable=False),
+    sa.Column('count', sa.Integer(), nullable=False),
+    sa.Column('first_created_at', sa.DateTime(), nullable=False),
+    sa.Column('first_log_id', sa.Text(length=36), nullable=False),
+    sa.Column('last_created_at', sa.DateTime(), nullable=False),
+    sa.Column('last_log_id', sa.Text(length=36), nullable=False),
+    sa.Column('archived_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('name')
+    )
+    op.create_table('archived_log',
+    sa.Column('id', sa.Text(length=36), nullable=False),
+    sa.Column('segment_id', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['segment_id'], ['archive_segment.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('archived_log')
+    op.drop_table('archive_segment')
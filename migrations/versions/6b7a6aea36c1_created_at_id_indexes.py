@@ -0,0 +1,26 @@
+"""Index (created_at, id) for keyset pagination.
+
+Revision ID: 6b7a6aea36c1
+Revises: ce18d7138631
+Create Date: 2026-10-18 09:20:12.418305
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6b7a6aea36c1'
+down_revision = 'ce18d7138631'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_user_created_at_id', 'user', ['created_at', 'id'], unique=False)
+    op.create_index('ix_ActivityLog_created_at_id', 'ActivityLog', ['created_at', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_ActivityLog_created_at_id', table_name='ActivityLog')
+    op.drop_index('ix_user_created_at_id', table_name='user')
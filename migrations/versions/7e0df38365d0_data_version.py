@@ -0,0 +1,29 @@
+"""Add data_version counter.
+
+Revision ID: 7e0df38365d0
+Revises: f93d6c3cab4e
+Create Date: 2026-10-18 10:02:44.160521
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7e0df38365d0'
+down_revision = 'f93d6c3cab4e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    data_version = op.create_table('data_version',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('version', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.bulk_insert(data_version, [{'id': 1, 'version': 0}])
+
+
+def downgrade():
+    op.drop_table('data_version')
@@ -0,0 +1,43 @@
+"""Add user table snapshots.
+
+Revision ID: 9b21c6f0e3d8
+Revises: 0d4f8b2e6a17
+Create Date: 2026-10-18 12:20:37.184062
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9b21c6f0e3d8'
+down_revision = '0d4f8b2e6a17'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('snapshot',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('log_created_at', sa.DateTime(), nullable=True),
+    sa.Column('log_id', sa.Text(length=36), nullable=True),
+    sa.Column('taken_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_snapshot_log_created_at'), 'snapshot', ['log_created_at'], unique=False)
+    op.create_table('snapshot_user',
+    sa.Column('snapshot_id', sa.Integer(), nullable=False),
+    sa.Column('id', sa.Text(length=36), nullable=False),
+    sa.Column('email', sa.String(length=120), nullable=True),
+    sa.Column('name', sa.String(length=255), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.Column('updated_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['snapshot_id'], ['snapshot.id'], ),
+    sa.PrimaryKeyConstraint('snapshot_id', 'id')
+    )
+
+
+def downgrade():
+    op.drop_table('snapshot_user')
+    op.drop_index(op.f('ix_snapshot_log_created_at'), table_name='snapshot')
+    op.drop_table('snapshot')
@@ -0,0 +1,56 @@
+"""Store ActivityLog attributes as canonical JSON.
+
+Revision ID: abfc6b529a89
+Revises: 7e0df38365d0
+Create Date: 2026-10-18 10:31:09.275319
+
+"""
+import json
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'abfc6b529a89'
+down_revision = '7e0df38365d0'
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 1000
+
+activity_log = sa.table(
+    'ActivityLog',
+    sa.column('id', sa.Text),
+    sa.column('attributes', sa.Text),
+)
+
+
+def upgrade():
+    connection = op.get_bind()
+    last_id = ''
+    while True:
+        rows = connection.execute(
+            sa.select([activity_log.c.id, activity_log.c.attributes])
+            .where(activity_log.c.id > last_id)
+            .order_by(activity_log.c.id)
+            .limit(BATCH_SIZE)
+        ).fetchall()
+        if not rows:
+            break
+        for id, attributes in rows:
+            if attributes is None:
+                continue
+            text = json.dumps(json.loads(attributes), sort_keys=True, separators=(',', ':'))
+            if text != attributes:
+                connection.execute(
+                    activity_log.update()
+                    .where(activity_log.c.id == id)
+                    .values(attributes=text)
+                )
+        last_id = rows[-1][0]
+
+
+def downgrade():
+    # canonical text is plain JSON, still readable by the previous type
+    pass
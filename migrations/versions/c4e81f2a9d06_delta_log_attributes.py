@@ -0,0 +1,35 @@
+"""Add base log of delta encoded ActivityLog attributes.
+
+Revision ID: c4e81f2a9d06
+Revises: 5e2a9c41d7b3
+Create Date: 2026-10-18 17:12:40.318205
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4e81f2a9d06'
+down_revision = '5e2a9c41d7b3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # existing logs stay whole, `flask encode-logs` delta encodes them
+    op.add_column('ActivityLog', sa.Column('base_id', sa.Text(length=36), nullable=True))
+    op.create_index('ix_ActivityLog_base_id', 'ActivityLog', ['base_id'], unique=False,
+                    sqlite_where=sa.text('base_id IS NOT NULL'))
+
+
+def downgrade():
+    op.execute(
+        'UPDATE ActivityLog SET attributes = ('
+        'SELECT json_patch(base_log.attributes, ActivityLog.attributes) '
+        'FROM ActivityLog AS base_log WHERE base_log.id = ActivityLog.base_id'
+        ') WHERE base_id IS NOT NULL'
+    )
+    op.drop_index('ix_ActivityLog_base_id', table_name='ActivityLog')
+    with op.batch_alter_table('ActivityLog') as batch_op:
+        batch_op.drop_column('base_id')
@@ -0,0 +1,74 @@
+"""Store user and activity log ids as 16 byte binary UUIDs.
+
+Revision ID: e7b3d1c5a2f8
+Revises: c4e81f2a9d06
+Create Date: 2026-10-18 19:40:03.114529
+
+"""
+import re
+import uuid
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e7b3d1c5a2f8'
+down_revision = 'c4e81f2a9d06'
+branch_labels = None
+depends_on = None
+
+UUID_RE = re.compile(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}\Z')
+
+# table -> (column, type before this revision) of every converted column
+COLUMNS = {
+    'user': (('id', sa.Text(length=36)),),
+    'ActivityLog': (
+        ('id', sa.Text(length=36)), ('user_id', sa.String(length=255)), ('base_id', sa.Text(length=36)),
+    ),
+    'snapshot_user': (('id', sa.Text(length=36)),),
+    'archived_log': (('id', sa.Text(length=36)),),
+}
+
+
+def to_bytes(value):
+    if isinstance(value, str) and UUID_RE.match(value):
+        return uuid.UUID(value).bytes
+    return value
+
+
+def to_text(value):
+    if isinstance(value, bytes) and len(value) == 16:
+        return str(uuid.UUID(bytes=value))
+    return value
+
+
+def convert(function, binary):
+    """
+    Rewrites the values of every converted column with `function`,
+    registered on the connection, then gives the columns their new type
+    by copying the tables
+    """
+    op.get_bind().connection.create_function('convert_uuid', 1, function)
+    # batch copies do not keep the WHERE of partial indexes
+    op.drop_index('ix_ActivityLog_base_id', table_name='ActivityLog')
+    for table, columns in COLUMNS.items():
+        # converted first, SQLite keeps blobs in text columns and text in blob
+        # ones, so the CAST of the copy leaves the converted values alone
+        op.execute('UPDATE "{}" SET {}'.format(table, ', '.join(
+            '{0} = convert_uuid({0})'.format(column) for column, text_type in columns)))
+        with op.batch_alter_table(table, recreate='always') as batch_op:
+            for column, text_type in columns:
+                batch_op.alter_column(
+                    column, type_=sa.LargeBinary(length=16) if binary else text_type,
+                    existing_type=text_type if binary else sa.LargeBinary(length=16))
+    op.create_index('ix_ActivityLog_base_id', 'ActivityLog', ['base_id'], unique=False,
+                    sqlite_where=sa.text('base_id IS NOT NULL'))
+
+
+def upgrade():
+    convert(to_bytes, binary=True)
+
+
+def downgrade():
+    convert(to_text, binary=False)
@@ -0,0 +1,25 @@
+"""Index ActivityLog by (user_id, created_at, id).
+
+Revision ID: f93d6c3cab4e
+Revises: 6b7a6aea36c1
+Create Date: 2026-10-18 09:41:37.902114
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f93d6c3cab4e'
+down_revision = '6b7a6aea36c1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_ActivityLog_user_id_created_at', 'ActivityLog',
+                    ['user_id', 'created_at', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_ActivityLog_user_id_created_at', table_name='ActivityLog')
@@ -1,5 +1,8 @@
+import os
+
 from service.app import create_app
 
 if __name__ == "__main__":
+    # development server, production runs gunicorn -c gunicorn.conf.py wsgi:app
     app = create_app()
-    app.run(debug=True, host="0.0.0.0")
+    app.run(debug=os.environ.get("FLASK_DEBUG", "").lower() in ("1", "true"), host="0.0.0.0")
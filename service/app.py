@@ -1,11 +1,21 @@
+import atexit
 import logging
+import os
 
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
-from flask_migrate import Migrate
 
 from service import db
+from service.cache import LRUCache
+from service.commands import (
+    archive_command, compact_command, encode_logs_command, rebuild_rollups_command,
+    rebuild_users_command, snapshot_command
+)
+from service.metrics import instrument
+from service.schema import check_schema
+from service.sqlite import apply_pragmas, profile_pragmas
 from service.views import views_bp
+from service.writer import GroupCommitWriter
 
 logger = logging.getLogger(__name__)
 LOG_LEVEL_MAP = {
@@ -17,31 +27,130 @@ LOG_LEVEL_MAP = {
 }
 
 
-def create_app(testing=False):
+def create_app(testing=False, config=None):
     """
     Create a Flask app instance,
-    sets SQLALCHEMY configurations
+    sets SQLALCHEMY configurations,
+    `config` overrides the defaults and the environment
     """
-    migrate = Migrate()
-
     app = Flask(__name__)
     app.register_blueprint(views_bp, url_prefix="")
+    app.cli.add_command(rebuild_rollups_command)
+    app.cli.add_command(snapshot_command)
+    app.cli.add_command(rebuild_users_command)
+    app.cli.add_command(compact_command)
+    app.cli.add_command(archive_command)
+    app.cli.add_command(encode_logs_command)
 
     app.config["LOG_LEVEL"] = "INFO"
+    # number of logs applied per commit by the NDJSON replay
+    app.config["REPLAY_CHUNK_SIZE"] = int(os.environ.get("REPLAY_CHUNK_SIZE", 1000))
+    # processes validating and applying large JSON replays, 0 or 1 replays serially
+    app.config["REPLAY_WORKERS"] = int(os.environ.get("REPLAY_WORKERS", 0))
+    # fewest logs a replay needs to be handed to the workers
+    app.config["PARALLEL_REPLAY_MIN_LOGS"] = int(os.environ.get("PARALLEL_REPLAY_MIN_LOGS", 20000))
+    # largest page size accepted by `limit` on list endpoints
+    app.config["PAGE_MAX_LIMIT"] = int(os.environ.get("PAGE_MAX_LIMIT", 1000))
+    # rows returned by list endpoints called without `limit` or `after`
+    app.config["LIST_MAX_ROWS"] = int(os.environ.get("LIST_MAX_ROWS", 10000))
+    # queue user writes to one thread committing them in groups
+    app.config["GROUP_COMMIT"] = os.environ.get("GROUP_COMMIT", "").lower() in ("1", "true")
+    # seconds a group waits for more writes, and the most writes it holds
+    app.config["GROUP_COMMIT_WINDOW"] = float(os.environ.get("GROUP_COMMIT_WINDOW", 0.002))
+    app.config["GROUP_COMMIT_MAX_BATCH"] = int(os.environ.get("GROUP_COMMIT_MAX_BATCH", 64))
+    # PRAGMA profile applied to every SQLite connection, see service.sqlite
+    app.config["SQLITE_PROFILE"] = os.environ.get("SQLITE_PROFILE", "default")
+    # PRAGMA values overriding the ones of the profile
+    app.config["SQLITE_PRAGMAS"] = {}
+    # users kept by the GET /users/<user_id> cache, 0 disables it
+    app.config["USER_CACHE_SIZE"] = int(os.environ.get("USER_CACHE_SIZE", 1024))
+    # seconds a cached user is served for, None keeps it until it changes
+    app.config["USER_CACHE_TTL"] = float(os.environ["USER_CACHE_TTL"]) if "USER_CACHE_TTL" in os.environ else None
+    # serialized GET /users and /logs bodies kept until the next write
+    app.config["RESPONSE_CACHE_SIZE"] = int(os.environ.get("RESPONSE_CACHE_SIZE", 64))
+    # directory of the archive segments holding logs moved out of the database
+    app.config["ARCHIVE_DIR"] = os.environ.get("ARCHIVE_DIR", "archive")
+    # how new activity logs store their attributes: "full" copies of the user or,
+    # with "delta", the changed fields with a full keyframe every LOG_KEYFRAME_INTERVAL logs
+    app.config["LOG_ENCODING"] = os.environ.get("LOG_ENCODING", "full")
+    app.config["LOG_KEYFRAME_INTERVAL"] = int(os.environ.get("LOG_KEYFRAME_INTERVAL", 16))
+    # collect per route request metrics served by GET /metrics
+    app.config["METRICS"] = os.environ.get("METRICS", "true").lower() in ("1", "true")
+    # requests taking this many seconds are logged with their SQL, None disables it
+    app.config["SLOW_REQUEST_SECONDS"] = (
+        float(os.environ["SLOW_REQUEST_SECONDS"]) if "SLOW_REQUEST_SECONDS" in os.environ else None
+    )
 
-    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = True
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///db.sqlite3'
+    # serve a database already migrated to the head, without creating tables
+    # or loading Flask-Migrate, for worker processes started by gunicorn
+    app.config["LEAN_STARTUP"] = os.environ.get("LEAN_STARTUP", "").lower() in ("1", "true")
+    # create missing tables on startup, off when `flask db upgrade` creates them
+    app.config["CREATE_TABLES"] = os.environ.get("CREATE_TABLES", "true").lower() in ("1", "true")
 
-    db.init_app(app)
+    # nothing listens to models_committed, tracking only slows down flushes
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    if testing:
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    else:
+        app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get(
+            'DATABASE_URL', 'sqlite:///db.sqlite3')
+    if config:
+        app.config.update(config)
 
-    migrate.init_app(app, db)
+    db.init_app(app)
+    with app.app_context():
+        apply_pragmas(db.engine, profile_pragmas(
+            app.config["SQLITE_PROFILE"], app.config["SQLITE_PRAGMAS"]))
+        if app.config["METRICS"]:
+            instrument(app, db.engine)
+        if app.config["LEAN_STARTUP"]:
+            check_schema(db.engine)
 
-    db.create_all(app=app)
+    if not app.config["LEAN_STARTUP"]:
+        # Alembic is only needed by `flask db` and is slow to import
+        from flask_migrate import Migrate
+        Migrate().init_app(app, db)
+        if app.config["CREATE_TABLES"]:
+            db.create_all(app=app)
     setup_logging(app)
 
+    app.extensions["user_cache"] = LRUCache(app.config["USER_CACHE_SIZE"], app.config["USER_CACHE_TTL"])
+    app.extensions["response_cache"] = LRUCache(app.config["RESPONSE_CACHE_SIZE"])
+
+    if app.config["GROUP_COMMIT"]:
+        writer = GroupCommitWriter(
+            app, app.config["GROUP_COMMIT_WINDOW"], app.config["GROUP_COMMIT_MAX_BATCH"])
+        writer.start()
+        app.extensions["group_commit"] = writer
+        atexit.register(writer.stop)
+
     return app
 
 
+def prepare_worker(app, workers=1):
+    """
+    Readies an app created before forking to serve in one of `workers`
+    processes: database connections inherited from the parent are dropped
+    instead of being shared, the group commit thread, which a fork does not
+    copy, is started again and the user cache, which only sees the writes
+    of its own process, is turned off unless its entries expire
+    """
+    with app.app_context():
+        db.engine.dispose()
+
+    if app.config["GROUP_COMMIT"]:
+        writer = GroupCommitWriter(
+            app, app.config["GROUP_COMMIT_WINDOW"], app.config["GROUP_COMMIT_MAX_BATCH"])
+        writer.start()
+        app.extensions["group_commit"] = writer
+        atexit.register(writer.stop)
+
+    if workers > 1 and app.config["USER_CACHE_TTL"] is None:
+        app.extensions["user_cache"] = LRUCache(0)
+        logger.info("User cache disabled, %s workers and no USER_CACHE_TTL", workers)
+
+
 def setup_logging(app):
     verbosity = app.config["LOG_LEVEL"]
     global_logger = logging.getLogger("")
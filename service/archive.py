@@ -0,0 +1,347 @@
+import bisect
+import heapq
+import logging
+import mmap
+import os
+import struct
+import uuid
+
+from sqlalchemy import tuple_
+
+from service import db
+from service.deltas import rebase_logs
+from service.models import ActivityLog, ArchivedLog, ArchiveSegment, DataVersion, keyset
+from service.replay import chunked
+from service.serialization import api_timestamp, encode_log, lean_logs
+from service.utils import to_datetime
+
+logger = logging.getLogger(__name__)
+
+# data_version row counting changes of the archive segments
+ARCHIVE_VERSION_ID = 2
+# every that many lines of a segment get an entry in its sparse index
+SPARSE_EVERY = 128
+# logs per segment file at most
+SEGMENT_SIZE = 1000000
+# logs read from the database per query while archiving
+ARCHIVE_BATCH_SIZE = 10000
+
+# segment lines are what encode_log writes, with API timestamps and UUIDs,
+# so the sort key, action and user_id sit at fixed places around these
+CREATED_AT = b',"created_at":"'
+TIMESTAMP_LENGTH = 27
+ID_OFFSET = TIMESTAMP_LENGTH + len('","id":"')
+UUID_LENGTH = 36
+ACTION_SLICE = slice(len('{"action":"'), len('{"action":"create'))
+USER_ID_SUFFIX = len('"}') + UUID_LENGTH
+# record of the per user index: user_id and offset of one of its lines
+USER_RECORD = struct.Struct('>{}sQ'.format(UUID_LENGTH))
+
+# (directory, archive version) -> Segments, segment files never change once written
+open_segments = {}
+
+
+class Segment(object):
+    """
+    Read only view of an archive segment, memory mapped.
+
+    `<name>.ndjson` holds the logs in (created_at, id) order, one per line
+    as GET /logs/export writes them. `<name>.idx` is the sparse index, the
+    key and offset of every SPARSE_EVERY-th line, and `<name>.users` holds
+    sorted (user_id, offset) records of every line. Sort keys, actions and
+    user ids are read in place from the mapping, only returned lines are
+    copied out of it.
+    """
+
+    def __init__(self, directory, name):
+        self.path = os.path.join(directory, name)
+        with open(self.path + '.ndjson', 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with open(self.path + '.users', 'rb') as f:
+            self.users = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.keys, self.offsets = [], []
+        with open(self.path + '.idx') as f:
+            for entry in f:
+                created_at, id, offset = entry.split()
+                self.keys.append((created_at, id))
+                self.offsets.append(int(offset))
+
+    def key(self, start, end):
+        """
+        Gives (created_at, id) of the line from start to end
+        """
+        at = self.data.rfind(CREATED_AT, start, end) + len(CREATED_AT)
+        return (
+            self.data[at:at + TIMESTAMP_LENGTH].decode(),
+            self.data[at + ID_OFFSET:at + ID_OFFSET + UUID_LENGTH].decode(),
+        )
+
+    def line(self, start):
+        """
+        Gives (key, action, user_id, line) of the line starting at offset
+        """
+        end = self.data.find(b'\n', start)
+        return (
+            self.key(start, end),
+            self.data[start + ACTION_SLICE.start:start + ACTION_SLICE.stop].decode(),
+            self.data[end - USER_ID_SUFFIX:end - 2].decode(),
+            self.data[start:end],
+        )
+
+    def scan(self, start=None):
+        """
+        Yields lines in order from the sparse entry before key `start`,
+        lines with smaller keys are not skipped one by one but may come first
+        """
+        position = 0
+        if start is not None:
+            entry = bisect.bisect_left(self.keys, start) - 1
+            position = self.offsets[entry] if entry >= 0 else 0
+        size = len(self.data)
+        while position < size:
+            line = self.line(position)
+            yield line
+            position += len(line[3]) + 1
+
+    def scan_backwards(self, end=None):
+        """
+        Yields lines in reverse order from the sparse entry at or after
+        key `end`, lines with larger keys may come first
+        """
+        boundary = len(self.data)
+        if end is not None:
+            entry = bisect.bisect_left(self.keys, end)
+            if entry < len(self.offsets):
+                boundary = self.offsets[entry]
+        while boundary > 0:
+            start = self.data.rfind(b'\n', 0, boundary - 1) + 1
+            yield self.line(start)
+            boundary = start
+
+    def user_lines(self, user_id):
+        """
+        Yields lines of one user in order, found by binary search
+        of the user index
+        """
+        target = user_id.encode()
+        low, high = 0, len(self.users) // USER_RECORD.size
+        while low < high:
+            middle = (low + high) // 2
+            record = middle * USER_RECORD.size
+            if self.users[record:record + UUID_LENGTH] < target:
+                low = middle + 1
+            else:
+                high = middle
+        record = low * USER_RECORD.size
+        while record < len(self.users):
+            found, offset = USER_RECORD.unpack_from(self.users, record)
+            if found != target:
+                break
+            yield self.line(offset)
+            record += USER_RECORD.size
+
+
+def archive_version():
+    """
+    Gives the version of the archive segments, 0 while there is none
+    """
+    table = DataVersion.__table__
+    return db.session.execute(
+        table.select().with_only_columns([table.c.version]).where(table.c.id == ARCHIVE_VERSION_ID)
+    ).scalar() or 0
+
+
+def bump_archive_version():
+    """
+    Makes readers reload the segments once the transaction commits
+    """
+    table = DataVersion.__table__
+    result = db.session.execute(
+        table.update()
+        .where(table.c.id == ARCHIVE_VERSION_ID)
+        .values(version=table.c.version + 1)
+    )
+    if result.rowcount == 0:
+        db.session.execute(table.insert().values(id=ARCHIVE_VERSION_ID, version=1))
+
+
+def segments(directory):
+    """
+    Gives Segments of the archive in `directory`, oldest first,
+    loaded once per archive version
+    """
+    version = archive_version()
+    if not version:
+        return []
+    cached = open_segments.get((directory, version))
+    if cached is None:
+        names = [row.name for row in ArchiveSegment.query.order_by(ArchiveSegment.id)]
+        cached = open_segments[directory, version] = [Segment(directory, name) for name in names]
+        for key in [key for key in open_segments if key[0] == directory and key[1] != version]:
+            del open_segments[key]
+    return cached
+
+
+def archived_lines(directory, filters, after=None, descending=False):
+    """
+    Yields (key, action, user_id, line) of archived logs matching LogFilters
+    in (created_at, id) order, newest first when `descending`, starting
+    after the `after` key.
+
+    Lines of every segment are merged, segments written by different runs
+    may overlap in time. A segment is entered with its sparse index, or
+    with its user index when filtering by user, instead of from its start.
+    """
+    since = filters.since and (api_timestamp(filters.since), '')
+    until = filters.until and (api_timestamp(filters.until), '')
+    if descending:
+        bound = min(key for key in (after, until) if key) if after or until else None
+    else:
+        bound = max(key for key in (after, since) if key) if after or since else None
+    actions = frozenset(filters.actions)
+
+    def matching(lines):
+        for key, action, user_id, line in lines:
+            if descending:
+                if since and key < since:
+                    return
+                if (after and key >= after) or (until and key >= until):
+                    continue
+            else:
+                if until and key >= until:
+                    return
+                if (after and key <= after) or (since and key < since):
+                    continue
+            if actions and action not in actions:
+                continue
+            yield key, action, user_id, line
+
+    streams = []
+    for segment in segments(directory):
+        if filters.user_ids:
+            lines = heapq.merge(*(segment.user_lines(user_id) for user_id in set(filters.user_ids)))
+            if descending:
+                lines = reversed(list(lines))
+        elif descending:
+            lines = segment.scan_backwards(bound)
+        else:
+            lines = segment.scan(bound)
+        streams.append(matching(lines))
+    return heapq.merge(*streams, reverse=descending)
+
+
+def write_segment(directory, rows):
+    """
+    Writes rows of lean_logs, with created_at as datetime added as
+    `position`, in (created_at, id) order into new segment
+    files, gives (name, [(id, created_at)], first key, last key),
+    None without rows.
+    Files are written under temporary names and renamed once complete.
+    """
+    name = uuid.uuid4().hex
+    path = os.path.join(directory, name)
+    ids, users, keys, offset = [], [], [], 0
+    with open(path + '.ndjson.tmp', 'wb') as data, open(path + '.idx.tmp', 'w') as index:
+        for row in rows:
+            line = encode_log(row[:-1]).encode()
+            key = (api_timestamp(row.created_at), row.id)
+            if len(ids) % SPARSE_EVERY == 0:
+                index.write('{} {} {}\n'.format(key[0], key[1], offset))
+            keys[1:] = [key]
+            if not ids:
+                keys.insert(0, key)
+            ids.append((row.id, row.position))
+            users.append(USER_RECORD.pack(row.user_id.encode(), offset))
+            data.write(line + b'\n')
+            offset += len(line) + 1
+        data.flush()
+        os.fsync(data.fileno())
+    if not ids:
+        for suffix in ('.ndjson.tmp', '.idx.tmp'):
+            os.remove(path + suffix)
+        return None
+
+    users.sort()
+    with open(path + '.users.tmp', 'wb') as f:
+        f.write(b''.join(users))
+        f.flush()
+        os.fsync(f.fileno())
+    # the data file comes last, a segment is complete once it is there
+    for suffix in ('.idx', '.users', '.ndjson'):
+        os.rename(path + suffix + '.tmp', path + suffix)
+    return name, ids, keys[0], keys[-1]
+
+
+def archive_logs(directory, before, segment_size=SEGMENT_SIZE, batch_size=ARCHIVE_BATCH_SIZE):
+    """
+    Moves activity logs created before `before` out of the database into
+    new segments of at most `segment_size` logs, committing once per segment
+    after its files are complete. Gives the number of archived logs.
+    """
+    os.makedirs(directory, exist_ok=True)
+    query = lean_logs().add_columns(ActivityLog.created_at.label('position')).filter(
+        ActivityLog.created_at < before).order_by(ActivityLog.created_at, ActivityLog.id)
+
+    def rows():
+        count, last = 0, None
+        while count < segment_size:
+            batch = query
+            if last is not None:
+                batch = batch.filter(tuple_(ActivityLog.created_at, ActivityLog.id) > keyset(ActivityLog, last.position, last.id))
+            batch = batch.limit(min(batch_size, segment_size - count)).all()
+            if not batch:
+                return
+            for row in batch:
+                yield row
+            count += len(batch)
+            last = batch[-1]
+
+    archived = 0
+    while True:
+        written = write_segment(directory, rows())
+        if written is None:
+            return archived
+        name, ids, first, last = written
+        segment = ArchiveSegment(
+            name=name, count=len(ids),
+            first_created_at=to_datetime(first[0]), first_log_id=first[1],
+            last_created_at=to_datetime(last[0]), last_log_id=last[1],
+        )
+        db.session.add(segment)
+        db.session.flush()
+        for chunk in chunked(ids):
+            db.session.bulk_insert_mappings(ArchivedLog, [
+                {'id': id, 'segment_id': segment.id, 'created_at': created_at} for id, created_at in chunk
+            ])
+            rebase_logs(id for id, created_at in chunk)
+            ActivityLog.query.filter(
+                ActivityLog.id.in_([id for id, created_at in chunk])).delete(synchronize_session=False)
+        bump_archive_version()
+        db.session.commit()
+        archived += len(ids)
+        logger.info("Archived %s logs into segment %s", archived, name)
+
+
+def clear_archive():
+    """
+    Forgets every segment, gives the names of the segments whose files
+    can be removed once the transaction commits
+    """
+    names = [row.name for row in ArchiveSegment.query.with_entities(ArchiveSegment.name)]
+    if names:
+        ArchivedLog.query.delete()
+        ArchiveSegment.query.delete()
+        bump_archive_version()
+    return names
+
+
+def remove_segment_files(directory, names):
+    """
+    Removes the files of forgotten segments
+    """
+    for name in names:
+        for suffix in ('.ndjson', '.idx', '.users'):
+            try:
+                os.remove(os.path.join(directory, name + suffix))
+            except FileNotFoundError:
+                pass
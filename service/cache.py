@@ -0,0 +1,157 @@
+import threading
+import time
+from collections import OrderedDict
+
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import event
+
+from service import db
+
+# session.info key collecting ids of users changed in the open transaction
+CHANGED_USERS = 'changed_users'
+# stands for every user, after the table was wiped
+ALL_USERS = 'all'
+
+
+class LRUCache(object):
+    """
+    Thread safe, size bounded least recently used cache,
+    entries optionally expire `ttl` seconds after being stored.
+
+    Loads racing with an invalidation are not stored: every invalidation
+    bumps a generation and a loaded value is only kept when no
+    invalidation happened while it was being loaded, so a reader can not
+    put back data older than the last write.
+    """
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_or_load(self, key, load):
+        """
+        Gives cached value of key or the one given by load(),
+        None values are returned but not cached
+        """
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is not None and (entry[1] is None or entry[1] > time.monotonic()):
+                self.data.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            generation = self.generation
+
+        value = load()
+        if value is None or self.maxsize <= 0:
+            return value
+
+        with self.lock:
+            if self.generation == generation:
+                self.store(key, value)
+        return value
+
+    def get(self, key):
+        """
+        Gives cached value of key, None when it is not cached
+        """
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is None or (entry[1] is not None and entry[1] <= time.monotonic()):
+                self.misses += 1
+                return None
+            self.data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        """
+        Caches value of key, evicting the least recently used ones
+        """
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            self.store(key, value)
+
+    def store(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        self.data[key] = (value, expires)
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, keys):
+        """
+        Drops cached values of keys
+        """
+        with self.lock:
+            self.generation += 1
+            for key in keys:
+                self.data.pop(key, None)
+
+    def clear(self):
+        """
+        Drops every cached value
+        """
+        with self.lock:
+            self.generation += 1
+            self.data.clear()
+
+    def stats(self):
+        """
+        Gives hit, miss and eviction counters with the current size
+        """
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self.data),
+                'maxsize': self.maxsize,
+            }
+
+
+def track_user_changes(user_ids):
+    """
+    Marks users whose cached data goes stale once the transaction commits
+    """
+    changed = db.session.info.setdefault(CHANGED_USERS, set())
+    if changed is not ALL_USERS:
+        changed.update(user_ids)
+
+
+def track_all_users():
+    """
+    Marks every cached user stale once the transaction commits
+    """
+    db.session.info[CHANGED_USERS] = ALL_USERS
+
+
+@event.listens_for(SignallingSession, 'after_commit')
+def invalidate_changed_users(session):
+    """
+    Drops cached data of users changed by the committed transaction
+    """
+    changed = session.info.pop(CHANGED_USERS, None)
+    cache = session.app.extensions.get('user_cache')
+    if changed is None or cache is None:
+        return
+    if changed is ALL_USERS:
+        cache.clear()
+    else:
+        cache.invalidate(changed)
+
+
+@event.listens_for(SignallingSession, 'after_rollback')
+def forget_changed_users(session):
+    """
+    Nothing changed when the transaction is rolled back
+    """
+    session.info.pop(CHANGED_USERS, None)
@@ -0,0 +1,104 @@
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from service import db
+from service.archive import SEGMENT_SIZE, archive_logs, archived_lines
+from service.conditional import mark_data_changed
+from service.filters import NO_FILTERS
+from service.rebuild import BATCH_SIZE, compact_logs, encode_logs, rebuild_users
+from service.rollups import REBUILD_BATCH_SIZE, rebuild_rollups
+from service.snapshots import prune_snapshots, take_snapshot
+from service.utils import to_datetime
+
+
+@click.command('rebuild-rollups')
+@click.option('--batch-size', default=REBUILD_BATCH_SIZE, show_default=True,
+              help='Logs read per query.')
+@with_appcontext
+def rebuild_rollups_command(batch_size):
+    """
+    Recounts the activity rollups from every stored log in one transaction.
+    """
+    archived = (
+        (action, user_id, to_datetime(key[0]))
+        for key, action, user_id, line in archived_lines(current_app.config['ARCHIVE_DIR'], NO_FILTERS)
+    )
+    counted = rebuild_rollups(batch_size, archived)
+    mark_data_changed()
+    db.session.commit()
+    click.echo('Counted {} logs'.format(counted))
+
+
+@click.command('snapshot')
+@click.option('--keep', default=2, show_default=True,
+              help='Most recent snapshots kept, older ones are deleted. '
+                   'Older as_of queries walk more logs from the closest snapshot kept.')
+@with_appcontext
+def snapshot_command(keep):
+    """
+    Snapshots the user table at the newest log, meant to run periodically.
+    """
+    snapshot = take_snapshot()
+    prune_snapshots(max(keep, 1))
+    db.session.commit()
+    click.echo('Took snapshot {} at log {}'.format(snapshot.id, snapshot.log_id))
+
+
+@click.command('rebuild-users')
+@click.option('--batch-size', default=BATCH_SIZE, show_default=True,
+              help='Logs read per query.')
+@with_appcontext
+def rebuild_users_command(batch_size):
+    """
+    Rebuilds the user table from the newest snapshot and the logs after it.
+    """
+    snapshot, applied = rebuild_users(current_app.config['ARCHIVE_DIR'], batch_size)
+    db.session.commit()
+    click.echo('Applied {} logs on top of {}'.format(
+        applied, 'snapshot {}'.format(snapshot.id) if snapshot else 'no snapshot'))
+
+
+@click.command('compact')
+@click.option('--retention-days', default=30, show_default=True,
+              help='Logs of the last days are all kept.')
+@click.option('--batch-size', default=BATCH_SIZE, show_default=True,
+              help='Logs read per query.')
+@with_appcontext
+def compact_command(retention_days, batch_size):
+    """
+    Deletes update logs older than the retention which later logs supersede.
+    """
+    deleted = compact_logs(datetime.utcnow() - timedelta(days=retention_days), batch_size)
+    click.echo('Deleted {} superseded update logs'.format(deleted))
+
+
+@click.command('archive')
+@click.option('--older-than-days', default=90, show_default=True,
+              help='Logs created before that many days ago are archived.')
+@click.option('--segment-size', default=SEGMENT_SIZE, show_default=True,
+              help='Logs per segment file at most.')
+@with_appcontext
+def archive_command(older_than_days, segment_size):
+    """
+    Moves old activity logs out of the database into archive segments.
+    """
+    before = datetime.utcnow() - timedelta(days=older_than_days)
+    archived = archive_logs(current_app.config['ARCHIVE_DIR'], before, segment_size)
+    click.echo('Archived {} logs'.format(archived))
+
+
+@click.command('encode-logs')
+@click.option('--encoding', type=click.Choice(['full', 'delta']), default='delta', show_default=True,
+              help='Encoding the stored logs are converted to.')
+@click.option('--batch-size', default=BATCH_SIZE, show_default=True,
+              help='Logs read per query.')
+@with_appcontext
+def encode_logs_command(encoding, batch_size):
+    """
+    Re-encodes the attributes of the stored activity logs, set LOG_ENCODING alike.
+    """
+    encoded = encode_logs(encoding, current_app.config['LOG_KEYFRAME_INTERVAL'], batch_size)
+    click.echo('Re-encoded {} logs'.format(encoded))
@@ -0,0 +1,91 @@
+import functools
+
+from flask import current_app, request
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import event
+
+from service import db
+from service.models import DataVersion
+
+# session.info key set when the open transaction writes users or logs
+DATA_CHANGED = 'data_changed'
+DATA_VERSION_ID = 1
+SELECT_DATA_VERSION = (
+    DataVersion.__table__.select()
+    .with_only_columns([DataVersion.__table__.c.version])
+    .where(DataVersion.__table__.c.id == DATA_VERSION_ID)
+)
+
+
+def mark_data_changed():
+    """
+    Makes the open transaction bump the data version when it commits
+    """
+    db.session.info[DATA_CHANGED] = True
+
+
+@event.listens_for(SignallingSession, 'before_commit')
+def bump_data_version(session):
+    """
+    Bumps the data version inside the committing transaction,
+    creates the counter row the first time
+    """
+    if not session.info.pop(DATA_CHANGED, False):
+        return
+    table = DataVersion.__table__
+    result = session.execute(
+        table.update()
+        .where(table.c.id == DATA_VERSION_ID)
+        .values(version=table.c.version + 1)
+    )
+    if result.rowcount == 0:
+        session.execute(table.insert().values(id=DATA_VERSION_ID, version=1))
+
+
+@event.listens_for(SignallingSession, 'after_rollback')
+def forget_data_changed(session):
+    """
+    Nothing changed when the transaction is rolled back
+    """
+    session.info.pop(DATA_CHANGED, None)
+
+
+def data_version():
+    """
+    Gives the current data version, 0 before the first write
+    """
+    return db.session.execute(SELECT_DATA_VERSION).scalar() or 0
+
+
+def conditional(view):
+    """
+    Serves GET `view` with an ETag of the data version.
+
+    A request whose If-None-Match holds the current version is answered
+    with 304, other responses are cached per path and query string and
+    served as is until the next write bumps the version. Streamed
+    responses get the ETag but are never cached.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        etag = 'v{}'.format(data_version())
+        if request.if_none_match.contains(etag):
+            response = current_app.response_class(status=304)
+            response.set_etag(etag)
+            return response
+
+        cache = current_app.extensions['response_cache']
+        key = request.full_path
+        cached = cache.get(key)
+        if cached is not None and cached[0] == etag:
+            response = current_app.response_class(cached[1], mimetype=cached[2])
+        else:
+            response = current_app.make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+            if not response.is_streamed:
+                cache.put(key, (etag, response.get_data(), response.mimetype))
+        response.set_etag(etag)
+        return response
+
+    return wrapper
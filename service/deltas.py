@@ -0,0 +1,133 @@
+import uuid
+
+from flask import current_app
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import event, func
+
+from service import db
+from service.models import ActivityLog
+from service.utils import chunked
+
+# values json_patch replaces as they are, it merges objects and drops nulls
+PATCHABLE = (str, int, float, bool)
+
+
+def changes(base, attributes):
+    """
+    Gives the fields of `attributes` differing from `base`, None when
+    patching `base` with them would not give `attributes` back
+    """
+    if not isinstance(attributes, dict) or attributes.keys() != base.keys():
+        return None
+    changed = {}
+    for field, value in attributes.items():
+        if type(value) is not type(base[field]) or value != base[field]:
+            if not isinstance(value, PATCHABLE):
+                return None
+            changed[field] = value
+    return changed
+
+
+def latest_keyframes(user_ids):
+    """
+    Gives user id -> [id, attributes, number of logs based on it] of the
+    newest full log of the users in `user_ids` which have one
+    """
+    newest = {}
+    for chunk in chunked(user_ids):
+        rows = db.session.query(ActivityLog.user_id, ActivityLog.created_at, ActivityLog.id).filter(
+            ActivityLog.user_id.in_(chunk), ActivityLog.base_id.is_(None))
+        for user_id, created_at, id in rows:
+            if user_id not in newest or newest[user_id] < (created_at, id):
+                newest[user_id] = (created_at, id)
+
+    users = {id: user_id for user_id, (created_at, id) in newest.items()}
+    keyframes = {}
+    for chunk in chunked(users):
+        for id, attributes in db.session.query(ActivityLog.id, ActivityLog.attributes).filter(
+                ActivityLog.id.in_(chunk)):
+            if isinstance(attributes, dict):
+                keyframes[users[id]] = [id, attributes, 0]
+        counts = db.session.query(ActivityLog.base_id, func.count()).filter(
+            ActivityLog.base_id.in_(chunk)).group_by(ActivityLog.base_id)
+        for id, count in counts:
+            if users[id] in keyframes:
+                keyframes[users[id]][2] = count
+    return keyframes
+
+
+def encode_delta(keyframes, id, user_id, action, attributes, interval):
+    """
+    Gives (attributes to store, base_id) of a log: the changes from the
+    keyframe of its user while fewer than `interval` logs are based on it,
+    else the whole attributes, the log becoming the user's keyframe.
+    Creates are always stored whole. `keyframes` is updated along.
+    """
+    keyframe = keyframes.get(user_id)
+    if keyframe is not None and action != 'create' and keyframe[2] < interval:
+        delta = changes(keyframe[1], attributes)
+        if delta is not None:
+            keyframe[2] += 1
+            return delta, keyframe[0]
+    if isinstance(attributes, dict):
+        keyframes[user_id] = [id, attributes, 0]
+    return attributes, None
+
+
+def encode_deltas(logs):
+    """
+    Delta encodes ActivityLog mappings in place, in order,
+    when LOG_ENCODING is 'delta'
+    """
+    config = current_app.config
+    if config['LOG_ENCODING'] != 'delta' or not logs:
+        return
+    keyframes = latest_keyframes({log['user_id'] for log in logs})
+    for log in logs:
+        log['attributes'], log['base_id'] = encode_delta(
+            keyframes, log['id'], log['user_id'], log['action'], log['attributes'],
+            config['LOG_KEYFRAME_INTERVAL'])
+
+
+def store_whole(query):
+    """
+    Stores the delta encoded logs of an ActivityLog query whole again,
+    gives their number
+    """
+    return query.filter(ActivityLog.base_id.isnot(None)).update({
+        ActivityLog.attributes: ActivityLog.full_attributes.expression,
+        ActivityLog.base_id: None,
+    }, synchronize_session=False)
+
+
+def rebase_logs(base_ids):
+    """
+    Stores the logs based on one of `base_ids` whole again,
+    to be called before deleting those base logs
+    """
+    for chunk in chunked(base_ids):
+        store_whole(ActivityLog.query.filter(ActivityLog.base_id.in_(chunk)))
+
+
+@event.listens_for(SignallingSession, 'before_flush')
+def encode_new_logs(session, flush_context, instances):
+    """
+    Delta encodes ActivityLog objects added to the session like
+    encode_deltas does the bulk inserted mappings
+    """
+    config = session.app.config
+    if config['LOG_ENCODING'] != 'delta':
+        return
+    logs = [
+        obj for obj in session.new
+        if isinstance(obj, ActivityLog) and obj.base_id is None and isinstance(obj.attributes, dict)
+    ]
+    if not logs:
+        return
+    keyframes = latest_keyframes({log.user_id for log in logs})
+    for log in logs:
+        if log.id is None:
+            # set before the insert so later logs of the flush can be based on it
+            log.id = str(uuid.uuid4())
+        log.attributes, log.base_id = encode_delta(
+            keyframes, log.id, log.user_id, log.action, log.attributes, config['LOG_KEYFRAME_INTERVAL'])
@@ -0,0 +1,91 @@
+from collections import namedtuple
+
+from service.models import ActivityLog
+from service.rollups import GRANULARITIES
+from service.utils import IN_CLAUSE_CHUNK_SIZE, to_datetime
+
+ACTIONS = frozenset(code for code, label in ActivityLog.TYPES)
+
+# narrowing of activity logs, empty lists and None do not narrow
+LogFilters = namedtuple('LogFilters', 'actions user_ids since until')
+NO_FILTERS = LogFilters([], [], None, None)
+
+
+class FilterError(Exception):
+    """
+    Raised for a malformed filter query parameter
+    """
+
+
+def listed(args, name):
+    """
+    Gives values of a query parameter given repeated and/or comma separated
+    """
+    values = [value for arg in args.getlist(name) for value in arg.split(',') if value]
+    if len(values) > IN_CLAUSE_CHUNK_SIZE:
+        raise FilterError('At most {} values of {} are allowed'.format(IN_CLAUSE_CHUNK_SIZE, name))
+    return values
+
+
+def timestamp(args, name):
+    """
+    Gives datetime of a timestamp query parameter, None when it is missing
+    """
+    if name not in args:
+        return None
+    try:
+        return to_datetime(args[name])
+    except ValueError:
+        raise FilterError('{} must be a timestamp like 2020-02-18T11:24:01.764973Z'.format(name))
+
+
+def listed_actions(args):
+    """
+    Gives the actions of `action` query parameter
+    """
+    actions = listed(args, 'action')
+    unknown = set(actions) - ACTIONS
+    if unknown:
+        raise FilterError('Unknown action: {}'.format(', '.join(sorted(unknown))))
+    return actions
+
+
+def granularity(args):
+    """
+    Gives rollup granularity of `granularity` query parameter, hour by default
+    """
+    value = args.get('granularity', 'hour')
+    if value not in GRANULARITIES:
+        raise FilterError('granularity must be one of {}'.format(', '.join(GRANULARITIES)))
+    return value
+
+
+def log_filters(args):
+    """
+    Gives LogFilters from the query parameters:
+    `action` and `user_id`, each repeated or comma separated,
+    and the created_at range `since` (inclusive) to `until` (exclusive)
+    """
+    return LogFilters(
+        listed_actions(args), listed(args, 'user_id'),
+        timestamp(args, 'since'), timestamp(args, 'until'),
+    )
+
+
+def log_criteria(filters):
+    """
+    Gives ActivityLog criteria of LogFilters.
+
+    Every single valued combination is served by an index seek:
+    (action, created_at, id), (user_id, created_at, id) or (created_at, id)
+    """
+    criteria = []
+    if filters.actions:
+        criteria.append(ActivityLog.action.in_(filters.actions))
+    if filters.user_ids:
+        criteria.append(ActivityLog.user_id.in_(filters.user_ids))
+    if filters.since is not None:
+        criteria.append(ActivityLog.created_at >= filters.since)
+    if filters.until is not None:
+        criteria.append(ActivityLog.created_at < filters.until)
+    return criteria
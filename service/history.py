@@ -0,0 +1,66 @@
+from datetime import timedelta
+
+from service.filters import NO_FILTERS
+from service.models import Snapshot, SnapshotUser
+from service.rebuild import log_tail
+
+# timestamps are stored to the microsecond, `as_of` covers logs created
+# before it plus this
+RESOLUTION = timedelta(microseconds=1)
+
+
+def checkpoint(as_of):
+    """
+    Gives the snapshot holding the most logs created at or before `as_of`,
+    None when there is none. Stale snapshots are discarded, so of two
+    taken at the same log_created_at the later one holds more.
+    """
+    return Snapshot.query.filter(Snapshot.log_created_at <= as_of).order_by(
+        Snapshot.log_created_at.desc(), Snapshot.id.desc()).first()
+
+
+def tail_start(snapshot):
+    """
+    Gives position of the last log a snapshot holds, None without a snapshot
+    """
+    return snapshot and (snapshot.log_created_at, snapshot.log_id)
+
+
+def user_as_of(user_id, as_of, directory):
+    """
+    Gives data of the user as it was once every log created at or before
+    `as_of` was applied, None when it did not exist then.
+
+    Starts from the user's row in the checkpoint and only walks the user's
+    logs after it, an index seek on (user_id, created_at, id) plus the
+    user indexes of the archive segments in `directory`.
+    Update logs removed by compaction are missing from the walk, times
+    between a compacted update and the one superseding it are only exact
+    at a checkpoint.
+    """
+    snapshot = checkpoint(as_of)
+    data = None
+    if snapshot is not None:
+        row = SnapshotUser.query.get((snapshot.id, user_id))
+        data = row and row.to_dict()
+    filters = NO_FILTERS._replace(user_ids=[user_id], until=as_of + RESOLUTION)
+    for key, action, attributes in log_tail(directory, tail_start(snapshot), filters):
+        data = None if action == 'delete' else attributes
+    return data
+
+
+def users_as_of(as_of, directory):
+    """
+    Gives data of every user existing once every log created at or before
+    `as_of` was applied, ordered by (created_at, id) like GET /users.
+    Starts from the checkpoint and walks the logs after it, like user_as_of.
+    """
+    snapshot = checkpoint(as_of)
+    users = {}
+    if snapshot is not None:
+        for row in SnapshotUser.query.filter(SnapshotUser.snapshot_id == snapshot.id):
+            users[row.id] = row.to_dict()
+    filters = NO_FILTERS._replace(until=as_of + RESOLUTION)
+    for key, action, attributes in log_tail(directory, tail_start(snapshot), filters):
+        users[attributes['id']] = None if action == 'delete' else attributes
+    return sorted((data for data in users.values() if data), key=lambda data: (data['created_at'], data['id']))
@@ -0,0 +1,248 @@
+import bisect
+import logging
+import threading
+import time
+from collections import Counter
+
+from flask import request
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+# upper bounds of the histogram buckets: request seconds,
+# statements per request and body bytes
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 1000)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+# (name, type, RouteStats attribute, help) of the metrics given per route
+ROUTE_METRICS = (
+    ('http_request_duration_seconds', 'histogram', 'latency',
+     'Seconds from receiving a request to sending the last byte of its response.'),
+    ('sql_statements_per_request', 'histogram', 'statements', 'SQL statements executed by a request.'),
+    ('sql_statement_duration_seconds_total', 'counter', 'sql_seconds', 'Seconds spent executing SQL statements.'),
+    ('db_request_commits_total', 'counter', 'commits', 'Transactions committed by requests.'),
+    ('http_request_size_bytes', 'histogram', 'request_size', 'Sizes of request bodies.'),
+    ('http_response_size_bytes', 'histogram', 'response_size', 'Sizes of response bodies of known length.'),
+)
+# route label of requests no URL rule matched
+UNMATCHED = 'unmatched'
+
+
+class Histogram(object):
+    """
+    Counts of observed values per bucket, with their sum
+    """
+
+    __slots__ = ('buckets', 'counts', 'sum')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # the last count is of the values above every bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def lines(self, name, labels):
+        """
+        Gives Prometheus text lines of the histogram, buckets cumulative
+        """
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += count
+            yield '{}_bucket{{{},le="{}"}} {}'.format(name, labels, bound, cumulative)
+        yield '{}_sum{{{}}} {}'.format(name, labels, self.sum)
+        yield '{}_count{{{}}} {}'.format(name, labels, cumulative)
+
+
+class RouteStats(object):
+    """
+    Totals of the requests of one method and route
+    """
+
+    __slots__ = ('latency', 'statements', 'sql_seconds', 'commits', 'request_size', 'response_size')
+
+    def __init__(self):
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.statements = Histogram(STATEMENT_BUCKETS)
+        self.sql_seconds = 0.0
+        self.commits = 0
+        self.request_size = Histogram(SIZE_BUCKETS)
+        self.response_size = Histogram(SIZE_BUCKETS)
+
+
+class RequestStats(object):
+    """
+    What the request running on a thread did so far
+    """
+
+    __slots__ = ('started', 'statements', 'sql_seconds', 'commits', 'statement_started', 'executed',
+                 'status', 'response_size')
+
+    def __init__(self, record_statements):
+        self.started = time.perf_counter()
+        self.statements = 0
+        self.sql_seconds = 0.0
+        self.commits = 0
+        self.statement_started = None
+        # (statement, seconds) of every statement, kept for the slow request log
+        self.executed = [] if record_statements else None
+        # unhandled errors skip after_request
+        self.status = 500
+        self.response_size = None
+
+
+class Metrics(object):
+    """
+    Per route latency, SQL and payload size metrics of the requests,
+    rendered in Prometheus text format.
+
+    A request is measured on its own thread without locking, the lock is
+    only taken once to fold it into the totals. With `slow_seconds` the
+    statements of every request are kept and requests taking longer are
+    logged with them.
+    """
+
+    def __init__(self, slow_seconds=None):
+        self.slow_seconds = slow_seconds
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        # (method, route) -> RouteStats
+        self.routes = {}
+        # (method, route, status) -> number of responses
+        self.responses = Counter()
+        self.commits = 0
+
+    def current(self):
+        """
+        Gives RequestStats of the request running on this thread, None outside of one
+        """
+        return getattr(self.local, 'request', None)
+
+    def start_request(self):
+        self.local.request = RequestStats(self.slow_seconds is not None)
+
+    def record_response(self, response):
+        stats = self.current()
+        if stats is not None:
+            stats.status = response.status_code
+            # streamed bodies have no Content-Length
+            stats.response_size = response.content_length
+        return response
+
+    def finish_request(self, exc=None):
+        stats = self.current()
+        if stats is None:
+            return
+        self.local.request = None
+        elapsed = time.perf_counter() - stats.started
+        rule = request.url_rule
+        method, route = request.method, rule.rule if rule is not None else UNMATCHED
+
+        with self.lock:
+            totals = self.routes.get((method, route))
+            if totals is None:
+                totals = self.routes[method, route] = RouteStats()
+            totals.latency.observe(elapsed)
+            totals.statements.observe(stats.statements)
+            totals.sql_seconds += stats.sql_seconds
+            totals.commits += stats.commits
+            totals.request_size.observe(request.content_length or 0)
+            if stats.response_size is not None:
+                totals.response_size.observe(stats.response_size)
+            self.responses[method, route, stats.status] += 1
+
+        if self.slow_seconds is not None and elapsed >= self.slow_seconds:
+            logger.warning(
+                "Slow request %s %s took %.3fs, %s statements in %.3fs:\n%s",
+                method, request.full_path, elapsed, stats.statements, stats.sql_seconds,
+                '\n'.join('[{:.3f}s] {}'.format(seconds, statement) for statement, seconds in stats.executed)
+            )
+
+    def before_statement(self, conn, cursor, statement, parameters, context, executemany):
+        stats = self.current()
+        if stats is not None:
+            stats.statement_started = time.perf_counter()
+
+    def after_statement(self, conn, cursor, statement, parameters, context, executemany):
+        stats = self.current()
+        if stats is None or stats.statement_started is None:
+            return
+        seconds = time.perf_counter() - stats.statement_started
+        stats.statement_started = None
+        stats.statements += 1
+        stats.sql_seconds += seconds
+        if stats.executed is not None:
+            stats.executed.append((statement, seconds))
+
+    def committed(self):
+        stats = self.current()
+        if stats is not None:
+            stats.commits += 1
+        with self.lock:
+            self.commits += 1
+
+    def render(self):
+        """
+        Gives the metrics in Prometheus text exposition format
+        """
+        with self.lock:
+            lines = list(self.lines())
+        return '\n'.join(lines) + '\n'
+
+    def lines(self):
+        """
+        Yields the lines of render, the lock has to be held
+        """
+        yield '# HELP http_requests_total Responses given, by method, route and status.'
+        yield '# TYPE http_requests_total counter'
+        for (method, route, status), count in sorted(self.responses.items()):
+            yield 'http_requests_total{{{},status="{}"}} {}'.format(labels(method, route), status, count)
+
+        routes = sorted(self.routes.items())
+        for name, kind, value, text in ROUTE_METRICS:
+            yield '# HELP {} {}'.format(name, text)
+            yield '# TYPE {} {}'.format(name, kind)
+            for (method, route), totals in routes:
+                metric = getattr(totals, value)
+                if kind == 'histogram':
+                    yield from metric.lines(name, labels(method, route))
+                else:
+                    yield '{}{{{}}} {}'.format(name, labels(method, route), metric)
+
+        yield '# HELP db_commits_total Transactions committed, by requests or not.'
+        yield '# TYPE db_commits_total counter'
+        yield 'db_commits_total {}'.format(self.commits)
+
+
+def labels(method, route):
+    """
+    Gives Prometheus label pairs of a method and route
+    """
+    return 'method="{}",route="{}"'.format(method, route.replace('\\', '\\\\').replace('"', '\\"'))
+
+
+def instrument(app, engine):
+    """
+    Measures every request of the app and the SQL it runs on `engine`
+    """
+    metrics = app.extensions['metrics'] = Metrics(app.config['SLOW_REQUEST_SECONDS'])
+    app.before_request(metrics.start_request)
+    app.after_request(metrics.record_response)
+    app.teardown_request(metrics.finish_request)
+    event.listen(engine, 'before_cursor_execute', metrics.before_statement)
+    event.listen(engine, 'after_cursor_execute', metrics.after_statement)
+    return metrics
+
+
+@event.listens_for(SignallingSession, 'after_commit')
+def count_commit(session):
+    """
+    Counts every committed transaction of an instrumented app
+    """
+    metrics = session.app.extensions.get('metrics')
+    if metrics is not None:
+        metrics.committed()
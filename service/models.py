@@ -1,30 +1,98 @@
+import json
+import re
 import uuid
 from datetime import datetime
 from pprint import pprint
 
+from sqlalchemy import case, func, literal, select, tuple_, type_coerce
+from sqlalchemy.types import LargeBinary, TypeDecorator
 from sqlalchemy_utils import ChoiceType, JSONType
 
 from service import db
 
 
+class CanonicalJSONType(JSONType):
+    """
+    JSONType storing text the way jsonify writes it: sorted keys, compact
+    separators and ASCII only, so stored values can be served as they are
+    """
+
+    def process_bind_param(self, value, dialect):
+        if value is None or dialect.name == 'postgresql':
+            return super(CanonicalJSONType, self).process_bind_param(value, dialect)
+        return json.dumps(value, sort_keys=True, separators=(',', ':'))
+
+
+UUID_RE = re.compile(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}\Z')
+
+
+def uuid_bytes(value):
+    """
+    Gives the 16 bytes of a canonical UUID string, anything else as it is
+    """
+    if isinstance(value, str) and UUID_RE.match(value):
+        return bytes.fromhex(value[:8] + value[9:13] + value[14:18] + value[19:23] + value[24:])
+    return value
+
+
+class BinaryUUID(TypeDecorator):
+    """
+    UUID stored as its 16 bytes and given back as the canonical lowercase
+    string. Other strings are bound as they are, SQLite never finds text
+    equal to a blob, so they match no id like they did when ids were text
+    """
+
+    impl = LargeBinary(16)
+
+    def process_bind_param(self, value, dialect):
+        return uuid_bytes(value)
+
+    def bind_processor(self, dialect):
+        # sqlite3 binds bytes as blobs by itself, LargeBinary's wrapping would refuse text
+        return uuid_bytes
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        value = value.hex()
+        return '{}-{}-{}-{}-{}'.format(value[:8], value[8:12], value[12:16], value[16:20], value[20:])
+
+
+def keyset(model, created_at, id):
+    """
+    Gives the (created_at, id) sort key of a row to compare with
+    tuple_(model.created_at, model.id), bound with the column types
+    """
+    return tuple_(literal(created_at, model.created_at.type), literal(id, model.id.type))
+
+
 class ActivityLog(db.Model):
     TYPES = [
         ('create', 'Create'),
         ('update', 'Update'),
         ('delete', 'Delete'),
     ]
-    id = db.Column(db.Text(length=36), default=lambda: str(uuid.uuid4()), primary_key=True)
+    id = db.Column(BinaryUUID, default=lambda: str(uuid.uuid4()), primary_key=True)
 
     action = db.Column(ChoiceType(TYPES))
 
-    user_id = db.Column(db.String(255), db.ForeignKey('user.id'))
+    user_id = db.Column(BinaryUUID, db.ForeignKey('user.id'))
 
-    attributes = db.Column(JSONType)
+    # as stored: the whole user, or only the fields differing from the
+    # attributes of the base log when delta encoded, see service.deltas
+    attributes = db.Column(CanonicalJSONType)
+    base_id = db.Column(BinaryUUID)
 
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow)
 
     __tablename__ = 'ActivityLog'
+    __table_args__ = (
+        db.Index('ix_ActivityLog_created_at_id', 'created_at', 'id'),
+        db.Index('ix_ActivityLog_user_id_created_at', 'user_id', 'created_at', 'id'),
+        db.Index('ix_ActivityLog_action_created_at', 'action', 'created_at', 'id'),
+        db.Index('ix_ActivityLog_base_id', 'base_id', sqlite_where=db.text('base_id IS NOT NULL')),
+    )
 
     def __repr__(self):
         return 'User id {}'.format(self.user_id)
@@ -34,7 +102,7 @@ class ActivityLog(db.Model):
             "id": self.id,
             "user_id": self.user_id,
             "action": self.action.code,
-            "attributes": self.attributes,
+            "attributes": self.full_attributes,
             'created_at': self.created_at.strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
             'updated_at': self.updated_at.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
         }
@@ -46,7 +114,7 @@ class User(db.Model):
     User model used for storing name and email of the user
     """
 
-    id = db.Column(db.Text(length=36), default=lambda: str(uuid.uuid4()), primary_key=True)
+    id = db.Column(BinaryUUID, default=lambda: str(uuid.uuid4()), primary_key=True)
 
     email = db.Column(db.String(120), index=True)
     name = db.Column(db.String(255))
@@ -54,6 +122,9 @@ class User(db.Model):
     updated_at = db.Column(db.DateTime, default=datetime.utcnow)
 
     __tablename__ = 'user'
+    __table_args__ = (
+        db.Index('ix_user_created_at_id', 'created_at', 'id'),
+    )
 
     def __repr__(self):
         return 'User {}'.format(self.name)
@@ -70,3 +141,104 @@ class User(db.Model):
             'updated_at': self.updated_at.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
         }
         return data
+
+
+base_log = ActivityLog.__table__.alias('base_log')
+# attributes of every log as a whole user: delta encoded ones are patched
+# onto their base in SQL, giving the canonical text a full log would store,
+# defined once the user table its foreign key refers to exists
+ActivityLog.full_attributes = db.column_property(type_coerce(case(
+    [(ActivityLog.__table__.c.base_id.is_(None), ActivityLog.__table__.c.attributes)],
+    else_=select([func.json_patch(base_log.c.attributes, ActivityLog.__table__.c.attributes)]).where(
+        base_log.c.id == ActivityLog.__table__.c.base_id).as_scalar()
+), CanonicalJSONType))
+
+
+class DataVersion(db.Model):
+    """
+    Single row counter bumped by every transaction writing users or logs
+    """
+
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+    __tablename__ = 'data_version'
+
+
+class ActivityRollup(db.Model):
+    """
+    Number of activity logs per time bucket, action and user,
+    rows with user_id '' count the logs of all users
+    """
+
+    granularity = db.Column(db.String(6), primary_key=True)
+    user_id = db.Column(db.String(255), primary_key=True)
+    bucket = db.Column(db.DateTime, primary_key=True)
+    action = db.Column(db.String(6), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+    __tablename__ = 'activity_rollup'
+
+
+class Snapshot(db.Model):
+    """
+    Copy of the user table taken once every log up to
+    (log_created_at, log_id) was applied
+    """
+
+    id = db.Column(db.Integer, primary_key=True)
+    # position of the newest applied log, None when there was no log
+    log_created_at = db.Column(db.DateTime, index=True)
+    log_id = db.Column(db.Text(length=36))
+    taken_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __tablename__ = 'snapshot'
+
+
+class SnapshotUser(db.Model):
+    """
+    User row as it was when its snapshot was taken
+    """
+
+    snapshot_id = db.Column(db.Integer, db.ForeignKey('snapshot.id'), primary_key=True)
+    id = db.Column(BinaryUUID, primary_key=True)
+    email = db.Column(db.String(120))
+    name = db.Column(db.String(255))
+    created_at = db.Column(db.DateTime)
+    updated_at = db.Column(db.DateTime)
+
+    __tablename__ = 'snapshot_user'
+
+    to_dict = User.to_dict
+
+
+class ArchiveSegment(db.Model):
+    """
+    Immutable file of activity logs moved out of the database,
+    see service.archive
+    """
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(32), nullable=False, unique=True)
+    count = db.Column(db.Integer, nullable=False)
+    # positions of the first and the last log of the segment
+    first_created_at = db.Column(db.DateTime, nullable=False)
+    first_log_id = db.Column(db.Text(length=36), nullable=False)
+    last_created_at = db.Column(db.DateTime, nullable=False)
+    last_log_id = db.Column(db.Text(length=36), nullable=False)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __tablename__ = 'archive_segment'
+
+
+class ArchivedLog(db.Model):
+    """
+    Activity log moved to an archive segment, kept so replays still
+    refuse its id and exports can resume after it
+    """
+
+    id = db.Column(BinaryUUID, primary_key=True)
+    segment_id = db.Column(db.Integer, db.ForeignKey('archive_segment.id'), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False)
+
+    __tablename__ = 'archived_log'
@@ -0,0 +1,103 @@
+import base64
+import json
+
+from sqlalchemy import tuple_
+
+from service.models import keyset
+from service.serialization import api_timestamp
+from service.utils import to_datetime
+
+
+class PaginationError(Exception):
+    """
+    Raised for a malformed `limit` or `after` query parameter
+    """
+
+
+def encode_cursor(created_at, id):
+    """
+    Gives opaque cursor pointing right after the row with given sort key,
+    created_at may be a datetime or a raw column value
+    """
+    key = [api_timestamp(created_at), id]
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """
+    Gives (created_at, id) sort key from an opaque cursor
+    """
+    try:
+        created_at, id = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        return to_datetime(created_at), id
+    except (ValueError, TypeError):
+        raise PaginationError('Invalid cursor')
+
+
+def parse_limit(value, max_limit):
+    """
+    Gives page size from `limit` query parameter
+    """
+    try:
+        limit = int(value)
+    except (TypeError, ValueError):
+        raise PaginationError('limit must be an integer')
+    if not 1 <= limit <= max_limit:
+        raise PaginationError('limit must be between 1 and {}'.format(max_limit))
+    return limit
+
+
+def is_descending(args):
+    """
+    Tells if `order` query parameter asks for the newest rows first
+    """
+    order = args.get('order', 'asc')
+    if order not in ('asc', 'desc'):
+        raise PaginationError('order must be asc or desc')
+    return order == 'desc'
+
+
+def sort_key(model, args):
+    """
+    Gives ORDER BY clauses of (created_at, id) in the requested order
+    """
+    if is_descending(args):
+        return model.created_at.desc(), model.id.desc()
+    return model.created_at, model.id
+
+
+def is_paginated(args):
+    """
+    Tells if the request asks for a page instead of the whole list
+    """
+    return 'limit' in args or 'after' in args
+
+
+def paginate(query, model, args, max_limit, max_rows):
+    """
+    Gives (rows, next_cursor) of `query` ordered by (created_at, id),
+    newest first with `order=desc`.
+
+    A page starts right after the `after` cursor with an index seek, so deep
+    pages cost the same as the first one. Without `limit` and `after` the
+    rows are returned in one go, capped at `max_rows`, and next_cursor is
+    None. Raises PaginationError for malformed parameters.
+    """
+    query = query.order_by(*sort_key(model, args))
+    if not is_paginated(args):
+        return query.limit(max_rows).all(), None
+
+    limit = parse_limit(args.get('limit', max_limit), max_limit)
+    if 'after' in args:
+        created_at, id = decode_cursor(args['after'])
+        position = tuple_(model.created_at, model.id)
+        if is_descending(args):
+            query = query.filter(position < keyset(model, created_at, id))
+        else:
+            query = query.filter(position > keyset(model, created_at, id))
+
+    rows = query.limit(limit + 1).all()
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor(rows[-1].created_at, rows[-1].id)
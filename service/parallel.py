@@ -0,0 +1,117 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from operator import itemgetter
+
+from service.models import User
+from service.replay import (
+    ReplayError, activity_log_mapping, apply_user_log, chunked, duplicate_log_error,
+    existing_ids, stored_log_ids, write_replay,
+)
+from service.validation import log_validator
+
+# logs validated per task
+VALIDATION_CHUNK_SIZE = 5000
+# user partitions per worker, more than one evens out users with many logs
+PARTITIONS_PER_WORKER = 4
+
+# number of workers -> ProcessPoolExecutor, started on first use and kept
+pools = {}
+
+
+def worker_pool(workers):
+    """
+    Gives the pool of `workers` processes.
+    Workers are spawned rather than forked, so they inherit neither
+    database connections nor locks held by other threads of the app.
+    """
+    pool = pools.get(workers)
+    if pool is None:
+        pool = pools[workers] = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+    return pool
+
+
+def validate_chunk(logs):
+    """
+    Gives Cerberus errors of the invalid logs of a chunk, in order
+    """
+    return [errors for errors in map(log_validator.errors, logs) if errors]
+
+
+def validate_logs(logs, workers):
+    """
+    Gives errors of the invalid logs in order, exactly what validating them
+    one by one gives, validated in chunks by `workers` processes
+    """
+    results = worker_pool(workers).map(validate_chunk, chunked(logs, VALIDATION_CHUNK_SIZE))
+    return [errors for chunk_errors in results for errors in chunk_errors]
+
+
+def apply_partition(partition, stored_users):
+    """
+    Walks the (position, log) pairs of a partition of users in order on top
+    of `stored_users`, gives (users, [(position, ActivityLog mapping)],
+    first conflict as (position, status code, message) or None)
+    """
+    users = dict.fromkeys(stored_users, True)
+    mappings = []
+    for position, log in partition:
+        conflict = apply_user_log(users, log)
+        if conflict is not None:
+            return users, mappings, (position,) + conflict
+        mappings.append((position, activity_log_mapping(log)))
+    return users, mappings, None
+
+
+def apply_logs_parallel(logs, workers):
+    """
+    Applies validated logs like apply_logs does, walking them in `workers`
+    processes.
+
+    Logs of one user only depend on each other, so they are partitioned by
+    user id keeping their order and the partitions are walked on their own.
+    Log ids are unique across users, their duplicates are found here. The
+    earliest of the partitions' first conflicts and the first duplicate is
+    the error apply_logs raises. Nothing is written unless every log
+    applies, then the result is flushed with the same bulk writes.
+    """
+    user_ids = {log['attributes']['id'] for log in logs}
+    stored_users = existing_ids(User.id, user_ids)
+    stored_logs = stored_log_ids(logs)
+
+    duplicate = None
+    seen_logs = set()
+    for position, log in enumerate(logs):
+        if log['id'] in stored_logs or log['id'] in seen_logs:
+            duplicate = position
+            break
+        seen_logs.add(log['id'])
+
+    count = workers * PARTITIONS_PER_WORKER
+    partitions = [[] for _ in range(count)]
+    partition_users = [[] for _ in range(count)]
+    # logs after a duplicate never apply, the duplicate itself may conflict first
+    walked = logs if duplicate is None else logs[:duplicate + 1]
+    for position, log in enumerate(walked):
+        partitions[hash(log['attributes']['id']) % count].append((position, log))
+    for user_id in stored_users:
+        partition_users[hash(user_id) % count].append(user_id)
+
+    users, new_logs, conflicts = {}, [], []
+    for walked_users, mappings, conflict in worker_pool(workers).map(apply_partition, partitions, partition_users):
+        users.update(walked_users)
+        new_logs.extend(mappings)
+        if conflict is not None:
+            conflicts.append(conflict)
+
+    if conflicts:
+        position, status_code, message = min(conflicts)
+        # at the same position the user conflict is checked first
+        if duplicate is None or position <= duplicate:
+            raise ReplayError(status_code, message, position)
+    if duplicate is not None:
+        raise duplicate_log_error(logs, duplicate)
+
+    new_logs.sort(key=itemgetter(0))
+    new_logs = [mapping for position, mapping in new_logs]
+    write_replay(users, stored_users, new_logs)
+    return len(new_logs)
@@ -0,0 +1,187 @@
+import heapq
+import json
+import logging
+from collections import Counter
+from operator import itemgetter
+
+from sqlalchemy import select, tuple_
+
+from service import db
+from service.archive import archived_lines
+from service.cache import track_all_users
+from service.conditional import mark_data_changed
+from service.deltas import encode_delta, rebase_logs, store_whole
+from service.filters import NO_FILTERS, log_criteria
+from service.models import ActivityLog, SnapshotUser, User, keyset
+from service.replay import chunked, existing_ids, write_users
+from service.rollups import add_counts, count_activity
+from service.serialization import api_timestamp
+from service.snapshots import newest_snapshot
+
+logger = logging.getLogger(__name__)
+
+# logs read per query while rebuilding or compacting
+BATCH_SIZE = 10000
+
+
+def log_batches(query, batch_size=BATCH_SIZE):
+    """
+    Yields rows of `query` over ActivityLog in (created_at, id) order,
+    one keyset page of `batch_size` at a time
+    """
+    query = query.order_by(ActivityLog.created_at, ActivityLog.id)
+    position = tuple_(ActivityLog.created_at, ActivityLog.id)
+    rows = query.limit(batch_size).all()
+    while rows:
+        yield rows
+        last = rows[-1]
+        rows = query.filter(position > keyset(ActivityLog, last.created_at, last.id)).limit(batch_size).all()
+
+
+def log_tail(directory, after=None, filters=NO_FILTERS, batch_size=BATCH_SIZE):
+    """
+    Yields (key, action, attributes) of the logs matching LogFilters after
+    the (created_at, id) position `after`, or of every one without it,
+    logs of the database and of the archive segments in `directory`
+    merged in (created_at, id) order
+    """
+    tail = db.session.query(
+        ActivityLog.created_at, ActivityLog.id, ActivityLog.action, ActivityLog.full_attributes
+    ).filter(*log_criteria(filters))
+    if after is not None:
+        tail = tail.filter(tuple_(ActivityLog.created_at, ActivityLog.id) > keyset(ActivityLog, *after))
+        after = (api_timestamp(after[0]), after[1])
+
+    hot = (
+        ((api_timestamp(row.created_at), row.id), row.action.code, row.full_attributes)
+        for rows in log_batches(tail, batch_size) for row in rows
+    )
+    archived = (
+        (key, action, json.loads(line)['attributes'])
+        for key, action, user_id, line in archived_lines(directory, filters, after)
+    )
+    return heapq.merge(hot, archived, key=itemgetter(0))
+
+
+def rebuild_users(directory, batch_size=BATCH_SIZE):
+    """
+    Rebuilds the user table from the newest snapshot and the logs after its
+    position, or from every log when there is no snapshot, without committing.
+    Logs of the archive segments in `directory` are folded in their place.
+
+    Only the users touched by the tail are held in memory, so the time and
+    memory of a rebuild follow the activity since the snapshot rather than
+    the whole history. Gives (snapshot, number of applied logs).
+    """
+    snapshot = newest_snapshot()
+    User.query.delete()
+    after = None
+    if snapshot is not None:
+        users = User.__table__
+        snapshot_users = SnapshotUser.__table__
+        db.session.execute(users.insert().from_select(
+            ['id', 'email', 'name', 'created_at', 'updated_at'],
+            select([
+                snapshot_users.c.id, snapshot_users.c.email, snapshot_users.c.name,
+                snapshot_users.c.created_at, snapshot_users.c.updated_at,
+            ]).where(snapshot_users.c.snapshot_id == snapshot.id)
+        ))
+        if snapshot.log_created_at is not None:
+            after = (snapshot.log_created_at, snapshot.log_id)
+
+    # user id -> latest attributes, None once deleted
+    users = {}
+    applied = 0
+    for key, action, attributes in log_tail(directory, after, batch_size=batch_size):
+        users[attributes['id']] = None if action == 'delete' else attributes
+        applied += 1
+
+    write_users(users, existing_ids(User.id, users))
+    track_all_users()
+    mark_data_changed()
+    return snapshot, applied
+
+
+def compact_logs(before, batch_size=BATCH_SIZE):
+    """
+    Deletes update logs created before `before` which a later update or
+    delete of the same user supersedes, committing once per batch.
+
+    Replaying what is left gives the same users: every update carries the
+    whole user, so only the last one before a delete or the end matters.
+    The rollups are decremented along. Gives the number of deleted logs.
+    """
+    updates = db.session.query(
+        ActivityLog.created_at, ActivityLog.id, ActivityLog.user_id
+    ).filter(ActivityLog.action == 'update', ActivityLog.created_at < before)
+
+    deleted = 0
+    for rows in log_batches(updates, batch_size):
+        latest = {}
+        for chunk in chunked({row.user_id for row in rows}):
+            changes = db.session.query(
+                ActivityLog.user_id, ActivityLog.created_at, ActivityLog.id
+            ).filter(ActivityLog.user_id.in_(chunk), ActivityLog.action.in_(['update', 'delete']))
+            for user_id, created_at, id in changes:
+                if user_id not in latest or latest[user_id] < (created_at, id):
+                    latest[user_id] = (created_at, id)
+
+        superseded = [row for row in rows if (row.created_at, row.id) < latest[row.user_id]]
+        if not superseded:
+            continue
+        rebase_logs(row.id for row in superseded)
+        for chunk in chunked(row.id for row in superseded):
+            ActivityLog.query.filter(ActivityLog.id.in_(chunk)).delete(synchronize_session=False)
+        counts = count_activity((('update', row.user_id, row.created_at) for row in superseded), Counter())
+        add_counts(db.session, {key: -count for key, count in counts.items()})
+        mark_data_changed()
+        db.session.commit()
+        deleted += len(superseded)
+        logger.info("Compacted %s update logs", deleted)
+    return deleted
+
+
+def encode_logs(encoding, interval, batch_size=BATCH_SIZE):
+    """
+    Stores the logs the way LOG_ENCODING `encoding` writes them, committing
+    once per batch: 'full' stores the delta encoded logs whole again,
+    'delta' walks the logs in (created_at, id) order and stores the whole
+    ones as changes from the keyframe of their user, with a new keyframe
+    every `interval` logs. Served logs stay the same.
+    Gives the number of re-encoded logs.
+    """
+    encoded = 0
+    if encoding == 'full':
+        while True:
+            ids = [row.id for row in db.session.query(ActivityLog.id).filter(
+                ActivityLog.base_id.isnot(None)).limit(batch_size)]
+            if not ids:
+                return encoded
+            for chunk in chunked(ids):
+                encoded += store_whole(ActivityLog.query.filter(ActivityLog.id.in_(chunk)))
+            db.session.commit()
+            logger.info("Stored %s logs whole", encoded)
+
+    logs = db.session.query(
+        ActivityLog.created_at, ActivityLog.id, ActivityLog.user_id, ActivityLog.action,
+        ActivityLog.attributes, ActivityLog.base_id
+    )
+    # user id -> [id, attributes, number of logs based on it] of its keyframe
+    keyframes = {}
+    for rows in log_batches(logs, batch_size):
+        updates = []
+        for row in rows:
+            if row.base_id is not None:
+                keyframe = keyframes.get(row.user_id)
+                if keyframe is not None and keyframe[0] == row.base_id:
+                    keyframe[2] += 1
+                continue
+            attributes, base_id = encode_delta(
+                keyframes, row.id, row.user_id, row.action.code, row.attributes, interval)
+            if base_id is not None:
+                updates.append({'id': row.id, 'attributes': attributes, 'base_id': base_id})
+        db.session.bulk_update_mappings(ActivityLog, updates)
+        db.session.commit()
+        encoded += len(updates)
+        logger.info("Delta encoded %s logs", encoded)
+    return encoded
@@ -0,0 +1,235 @@
+import json
+import logging
+
+from service import db
+from service.cache import track_user_changes
+from service.conditional import mark_data_changed
+from service.deltas import encode_deltas
+from service.models import User, ActivityLog, ArchivedLog
+from service.rollups import count_activity
+from service.snapshots import discard_snapshots_since
+from service.utils import chunked, to_datetime
+from service.validation import log_validator
+
+logger = logging.getLogger(__name__)
+
+
+class ReplayError(Exception):
+    """
+    Raised when a log can not be applied on top of the current state,
+    carries the status code and message of the error response
+    """
+
+    def __init__(self, status_code, message, position=None):
+        super(ReplayError, self).__init__(message)
+        self.status_code = status_code
+        self.message = message
+        # index of the failing log within the applied list
+        self.position = position
+
+
+def existing_ids(column, ids):
+    """
+    Gives the subset of `ids` which are present in `column`,
+    resolved with chunked IN (...) queries instead of one lookup per id
+    """
+    found = set()
+    for chunk in chunked(ids):
+        rows = db.session.query(column).filter(column.in_(chunk))
+        found.update(row[0] for row in rows)
+    return found
+
+
+def apply_logs(logs):
+    """
+    Applies validated logs in order on top of the current database state.
+
+    Users referenced by the logs are resolved up front and their state is
+    tracked in memory while walking the sequence, so the conflict checks
+    behave exactly like applying the logs one by one. Nothing is written
+    unless every log applies, then the result is flushed with bulk writes.
+    Raises ReplayError for the first log that conflicts.
+    """
+    user_ids = {log['attributes']['id'] for log in logs}
+    stored_users = existing_ids(User.id, user_ids)
+    stored_logs = stored_log_ids(logs)
+
+    # user id -> latest attributes, None once the user is deleted
+    users = dict.fromkeys(stored_users, True)
+    new_logs = []
+    seen_logs = set()
+    for position, log in enumerate(logs):
+        conflict = apply_user_log(users, log)
+        if conflict is not None:
+            raise ReplayError(*conflict, position=position)
+        if log['id'] in stored_logs or log['id'] in seen_logs:
+            raise duplicate_log_error(logs, position)
+        seen_logs.add(log['id'])
+        new_logs.append(activity_log_mapping(log))
+
+    write_replay(users, stored_users, new_logs)
+    return len(new_logs)
+
+
+def stored_log_ids(logs):
+    """
+    Gives ids of the logs which are already stored, in the table or archived
+    """
+    log_ids = {log['id'] for log in logs}
+    return existing_ids(ActivityLog.id, log_ids) | existing_ids(ArchivedLog.id, log_ids)
+
+
+def apply_user_log(users, log):
+    """
+    Applies one log to the tracked state of its user, gives
+    (status code, message) leaving the state as it is when the log conflicts
+    """
+    user_data = log['attributes']
+    exists = users.get(user_data['id']) is not None
+
+    if log['action'] == 'create':
+        if exists:
+            return 400, 'User with ID: {} already exist'.format(user_data['id'])
+        users[user_data['id']] = user_data
+    elif log['action'] == 'update':
+        if not exists:
+            return 404, 'User with ID: {} does not exist'.format(user_data['id'])
+        users[user_data['id']] = user_data
+    elif log['action'] == 'delete':
+        if not exists:
+            return 404, 'User with ID: {} does not exist'.format(user_data['id'])
+        users[user_data['id']] = None
+    return None
+
+
+def duplicate_log_error(logs, position):
+    """
+    Gives ReplayError of a log whose id is already taken
+    """
+    user_data = logs[position]['attributes']
+    return ReplayError(400, 'ActivityLog with ID: {} already exist'.format(user_data['id']), position)
+
+
+def write_replay(users, stored_users, new_logs):
+    """
+    Writes the outcome of applied logs: user states as write_users takes
+    them and ActivityLog column values of the new logs
+    """
+    track_user_changes(users)
+    mark_data_changed()
+    count_activity((log['action'], log['user_id'], log['created_at']) for log in new_logs)
+    if new_logs:
+        discard_snapshots_since(min(log['created_at'] for log in new_logs))
+    write_users(users, stored_users)
+    encode_deltas(new_logs)
+    db.session.bulk_insert_mappings(ActivityLog, new_logs)
+
+
+def write_users(users, stored_users):
+    """
+    Writes the latest state of users with bulk writes, `users` maps
+    user id -> log attributes, None once deleted or True when unchanged,
+    `stored_users` holds the ids present in the user table
+    """
+    inserts, updates, deletes = [], [], []
+    for user_id, user_data in users.items():
+        if user_data is None:
+            if user_id in stored_users:
+                deletes.append(user_id)
+        elif user_data is not True:
+            if user_id in stored_users:
+                updates.append(user_mapping(user_data))
+            else:
+                inserts.append(user_mapping(user_data))
+
+    for chunk in chunked(deletes):
+        User.query.filter(User.id.in_(chunk)).delete(synchronize_session=False)
+    db.session.bulk_update_mappings(User, updates)
+    db.session.bulk_insert_mappings(User, inserts)
+
+
+def apply_log_stream(lines, chunk_size):
+    """
+    Applies newline delimited logs without holding the whole input in memory.
+
+    Every line is parsed and validated as it is read, logs are applied and
+    committed in chunks of `chunk_size`, so a failure keeps the chunks that
+    were committed before it. Blank lines are skipped and an empty stream
+    applies nothing, it never wipes the data like an empty `logs` list does.
+    Returns the number of applied logs, raises ReplayError whose message
+    holds the number of the first failing line.
+    """
+    applied = 0
+    chunk = []
+    line_numbers = []
+
+    def flush():
+        try:
+            count = apply_logs(chunk)
+        except ReplayError as e:
+            db.session.rollback()
+            raise stream_error(e.status_code, line_numbers[e.position], applied, e.message)
+        db.session.commit()
+        logger.info("Replayed %s logs up to line %s", applied + count, line_numbers[-1])
+        del chunk[:]
+        del line_numbers[:]
+        return count
+
+    for line_number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            log = json.loads(line)
+        except ValueError:
+            raise stream_error(400, line_number, applied, 'Invalid JSON')
+        if not isinstance(log, dict):
+            raise stream_error(400, line_number, applied, 'Log must be an object')
+        errors = log_validator.errors(log)
+        if errors:
+            raise stream_error(400, line_number, applied, errors)
+        chunk.append(log)
+        line_numbers.append(line_number)
+        if len(chunk) >= chunk_size:
+            applied += flush()
+
+    if chunk:
+        applied += flush()
+    return applied
+
+
+def stream_error(status_code, line_number, applied, errors):
+    """
+    Gives ReplayError pointing at the failing line of a log stream
+    """
+    return ReplayError(status_code, {
+        'line': line_number,
+        'applied': applied,
+        'errors': errors,
+    })
+
+
+def user_mapping(user_data):
+    """
+    Gives column values of User from log attributes
+    """
+    return {
+        'id': user_data['id'],
+        'email': user_data['email'],
+        'name': user_data['name'],
+        'created_at': to_datetime(user_data['created_at']),
+        'updated_at': to_datetime(user_data['updated_at']),
+    }
+
+
+def activity_log_mapping(log_data):
+    """
+    Gives column values of ActivityLog from log data
+    """
+    return {
+        'id': log_data['id'],
+        'user_id': log_data['user_id'],
+        'action': log_data['action'],
+        'attributes': log_data['attributes'],
+        'created_at': to_datetime(log_data['created_at']),
+        'updated_at': to_datetime(log_data['updated_at']),
+    }
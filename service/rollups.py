@@ -0,0 +1,155 @@
+from collections import Counter
+from itertools import islice
+
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import bindparam, event, text, tuple_
+
+from service import db
+from service.models import ActivityLog, ActivityRollup, keyset
+
+GRANULARITIES = ('minute', 'hour', 'day')
+# user_id of the rows counting the logs of all users
+ALL_USERS = ''
+# session.info key holding counts the open transaction adds to the rollups
+PENDING_COUNTS = 'rollup_counts'
+# logs read per query when rebuilding the rollups
+REBUILD_BATCH_SIZE = 10000
+# rows written per executemany
+WRITE_BATCH_SIZE = 500
+# understood by SQLite 3.24+ and PostgreSQL 9.5+
+UPSERT_COUNT = text(
+    'INSERT INTO activity_rollup (granularity, user_id, bucket, action, count) '
+    'VALUES (:granularity, :user_id, :bucket, :action, :count) '
+    'ON CONFLICT (granularity, user_id, bucket, action) '
+    'DO UPDATE SET count = activity_rollup.count + excluded.count'
+).bindparams(bindparam('bucket', type_=db.DateTime))
+
+
+def truncate(timestamp, granularity):
+    """
+    Gives start of the `granularity` bucket holding timestamp
+    """
+    if granularity == 'minute':
+        return timestamp.replace(second=0, microsecond=0)
+    if granularity == 'hour':
+        return timestamp.replace(minute=0, second=0, microsecond=0)
+    return timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def count_activity(logs, counts=None):
+    """
+    Adds (action, user_id, created_at) of the logs to the rollup counts
+    written when the open transaction commits
+    """
+    if counts is None:
+        counts = db.session.info.setdefault(PENDING_COUNTS, Counter())
+    for action, user_id, created_at in logs:
+        action = getattr(action, 'code', action)
+        for granularity in GRANULARITIES:
+            bucket = truncate(created_at, granularity)
+            counts[granularity, user_id, bucket, action] += 1
+            counts[granularity, ALL_USERS, bucket, action] += 1
+    return counts
+
+
+@event.listens_for(SignallingSession, 'before_commit')
+def write_pending_counts(session):
+    """
+    Adds counts of the logs written by the committing transaction
+    to the rollups, inside that same transaction
+    """
+    counts = session.info.pop(PENDING_COUNTS, None)
+    if counts:
+        add_counts(session, counts)
+
+
+@event.listens_for(SignallingSession, 'after_rollback')
+def forget_pending_counts(session):
+    """
+    Nothing was logged when the transaction is rolled back
+    """
+    session.info.pop(PENDING_COUNTS, None)
+
+
+def add_counts(session, counts):
+    """
+    Increments rollup rows by `counts`, creating the missing ones
+    """
+    rows = [
+        {'granularity': granularity, 'user_id': user_id, 'bucket': bucket, 'action': action, 'count': count}
+        for (granularity, user_id, bucket, action), count in counts.items()
+    ]
+    for start in range(0, len(rows), WRITE_BATCH_SIZE):
+        session.execute(UPSERT_COUNT, rows[start:start + WRITE_BATCH_SIZE])
+
+
+def rebuild_rollups(batch_size=REBUILD_BATCH_SIZE, archived=()):
+    """
+    Recounts the rollups from every stored activity log, and from the
+    (action, user_id, created_at) of the `archived` ones, without committing.
+    Logs are read in (created_at, id) order one batch at a time, so memory
+    stays bounded by the batch and its buckets.
+    Gives the number of counted logs.
+    """
+    clear_rollups()
+    query = db.session.query(
+        ActivityLog.action, ActivityLog.user_id, ActivityLog.created_at, ActivityLog.id
+    ).order_by(ActivityLog.created_at, ActivityLog.id)
+    position = tuple_(ActivityLog.created_at, ActivityLog.id)
+
+    counted = 0
+    rows = query.limit(batch_size).all()
+    while rows:
+        add_counts(db.session, count_activity((row[:3] for row in rows), Counter()))
+        counted += len(rows)
+        last = rows[-1]
+        rows = query.filter(position > keyset(ActivityLog, last.created_at, last.id)).limit(batch_size).all()
+
+    archived = iter(archived)
+    batch = list(islice(archived, batch_size))
+    while batch:
+        add_counts(db.session, count_activity(batch, Counter()))
+        counted += len(batch)
+        batch = list(islice(archived, batch_size))
+    return counted
+
+
+def clear_rollups():
+    """
+    Deletes every rollup row along with any count pending in the transaction
+    """
+    ActivityRollup.query.delete()
+    db.session.info.pop(PENDING_COUNTS, None)
+
+
+def bucket_counts(granularity, user_id=ALL_USERS, actions=(), since=None, until=None, max_rows=None):
+    """
+    Gives [(bucket, {action: count})] in bucket order for the buckets of
+    `granularity` from the one holding `since` up to `until` (exclusive),
+    counting logs of `user_id` or of all users.
+    Reads one primary key range, so the cost follows the number of buckets
+    and not the number of logs.
+    """
+    query = db.session.query(
+        ActivityRollup.bucket, ActivityRollup.action, ActivityRollup.count
+    ).filter(
+        ActivityRollup.granularity == granularity,
+        ActivityRollup.user_id == user_id,
+        # compaction leaves emptied rows behind
+        ActivityRollup.count > 0,
+    ).order_by(ActivityRollup.bucket, ActivityRollup.action)
+    if actions:
+        query = query.filter(ActivityRollup.action.in_(actions))
+    if since is not None:
+        query = query.filter(ActivityRollup.bucket >= truncate(since, granularity))
+    if until is not None:
+        query = query.filter(ActivityRollup.bucket < until)
+    if max_rows is not None:
+        query = query.limit(max_rows)
+
+    buckets = []
+    for bucket, action, count in query:
+        if not buckets or buckets[-1][0] != bucket:
+            buckets.append((bucket, {}))
+        buckets[-1][1][action] = count
+    return buckets
@@ -0,0 +1,48 @@
+import os
+import re
+
+from sqlalchemy.exc import DBAPIError
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'migrations')
+
+REVISION = re.compile(r"^revision = '(\w+)'", re.M)
+DOWN_REVISION = re.compile(r"^down_revision = (.*)$", re.M)
+
+
+class SchemaError(Exception):
+    """
+    The database schema is not the one of the migrations head
+    """
+
+
+def migration_heads(directory=MIGRATIONS_DIR):
+    """
+    Gives the revisions no migration script revises, read from the scripts
+    in `directory` without loading Alembic
+    """
+    revisions, revised = set(), set()
+    versions = os.path.join(directory, 'versions')
+    for name in os.listdir(versions):
+        if not name.endswith('.py'):
+            continue
+        with open(os.path.join(versions, name)) as f:
+            script = f.read()
+        revisions.add(REVISION.search(script).group(1))
+        # None, a revision or a tuple of them for merges
+        revised.update(re.findall(r"'(\w+)'", DOWN_REVISION.search(script).group(1)))
+    return revisions - revised
+
+
+def check_schema(engine, directory=MIGRATIONS_DIR):
+    """
+    Raises SchemaError unless the database of `engine` was migrated to
+    the heads of the migration scripts in `directory`
+    """
+    try:
+        current = {row[0] for row in engine.execute('SELECT version_num FROM alembic_version')}
+    except DBAPIError:
+        current = set()
+    heads = migration_heads(directory)
+    if current != heads:
+        raise SchemaError('Database schema is at {}, migrations head is {}, run `flask db upgrade`'.format(
+            ', '.join(sorted(current)) or 'no revision', ', '.join(sorted(heads))))
@@ -0,0 +1,114 @@
+import json
+from datetime import datetime
+from json.encoder import encode_basestring_ascii
+
+from flask import current_app
+from sqlalchemy import type_coerce
+from sqlalchemy.dialects.sqlite import DATETIME
+
+from service import db
+from service.models import User, ActivityLog
+
+API_TIMESTAMP = '%Y-%m-%dT%H:%M:%S.%fZ'
+# SQLAlchemy stores SQLite datetimes as 'YYYY-MM-DD HH:MM:SS.ffffff'
+SQLITE_TIMESTAMP_LENGTH = 26
+parse_sqlite_timestamp = DATETIME().result_processor(None, None)
+
+USER_JSON = '{"created_at":%s,"email":%s,"id":%s,"name":%s,"updated_at":%s}'
+LOG_JSON = '{"action":%s,"attributes":%s,"created_at":%s,"id":%s,"updated_at":%s,"user_id":%s}'
+
+
+def raw(column):
+    """
+    Gives column selected as stored, skipping its type's result processing
+    """
+    return type_coerce(column, db.Text).label(column.key)
+
+
+def lean_users():
+    """
+    Gives query of the raw User columns encode_user needs
+    """
+    return db.session.query(
+        raw(User.created_at), User.email, User.id, User.name, raw(User.updated_at)
+    )
+
+
+def lean_logs():
+    """
+    Gives query of the raw ActivityLog columns encode_log needs
+    """
+    return db.session.query(
+        raw(ActivityLog.action), raw(ActivityLog.full_attributes), raw(ActivityLog.created_at),
+        ActivityLog.id, raw(ActivityLog.updated_at), ActivityLog.user_id
+    )
+
+
+def api_timestamp(value):
+    """
+    Gives timestamp the way to_dict formats it from a datetime
+    or from the text SQLite stores
+    """
+    if value is None or isinstance(value, datetime):
+        return value and value.strftime(API_TIMESTAMP)
+    if len(value) == SQLITE_TIMESTAMP_LENGTH and value[10] == ' ':
+        return value[:10] + 'T' + value[11:] + 'Z'
+    return parse_sqlite_timestamp(value).strftime(API_TIMESTAMP)
+
+
+def quote(value):
+    """
+    Gives JSON of a string or None
+    """
+    return 'null' if value is None else encode_basestring_ascii(value)
+
+
+def encode_user(row):
+    """
+    Gives JSON of a lean_users row, byte for byte what jsonify writes for to_dict
+    """
+    created_at, email, id, name, updated_at = row
+    return USER_JSON % (
+        quote(api_timestamp(created_at)), quote(email), quote(id), quote(name),
+        quote(api_timestamp(updated_at)),
+    )
+
+
+def encode_log(row):
+    """
+    Gives JSON of a lean_logs row, byte for byte what jsonify writes for to_dict,
+    the attributes are already stored as canonical JSON and copied as they are
+    """
+    action, attributes, created_at, id, updated_at, user_id = row
+    if attributes is None:
+        attributes = 'null'
+    elif not isinstance(attributes, str):
+        # databases with a native JSON type hand back decoded values
+        attributes = json.dumps(attributes, sort_keys=True, separators=(',', ':'))
+    return LOG_JSON % (
+        quote(action), attributes, quote(api_timestamp(created_at)), quote(id),
+        quote(api_timestamp(updated_at)), quote(user_id),
+    )
+
+
+def list_body(key, encoded_rows, **members):
+    """
+    Gives jsonify compatible body of {key: [rows...], **members}
+    from already encoded rows
+    """
+    fields = {name: json.dumps(value) for name, value in members.items()}
+    fields[key] = '[' + ','.join(encoded_rows) + ']'
+    return '{' + ','.join(
+        '{}:{}'.format(quote(name), fields[name]) for name in sorted(fields)
+    ) + '}\n'
+
+
+def lean_json_enabled(compact=True):
+    """
+    Tells if the encoders above give what flask.json gives with current
+    settings, `compact` also requires jsonify not to pretty print
+    """
+    config = current_app.config
+    if compact and (config['JSONIFY_PRETTYPRINT_REGULAR'] or current_app.debug):
+        return False
+    return config['JSON_SORT_KEYS'] and config['JSON_AS_ASCII']
@@ -0,0 +1,93 @@
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import event, select
+
+from service import db
+from service.models import ActivityLog, Snapshot, SnapshotUser, User
+
+# session.info key holding created_at of the oldest log the transaction writes
+OLDEST_WRITTEN = 'oldest_written_log'
+
+
+def newest_snapshot():
+    """
+    Gives the most recent snapshot, None when there is none
+    """
+    return Snapshot.query.order_by(Snapshot.id.desc()).first()
+
+
+def take_snapshot():
+    """
+    Copies the user table into a new snapshot tagged with the position
+    of the newest log, without committing. Gives the snapshot.
+    """
+    newest = ActivityLog.query.with_entities(ActivityLog.created_at, ActivityLog.id).order_by(
+        ActivityLog.created_at.desc(), ActivityLog.id.desc()).first()
+    snapshot = Snapshot()
+    if newest is not None:
+        snapshot.log_created_at, snapshot.log_id = newest
+    db.session.add(snapshot)
+    db.session.flush()
+
+    users = User.__table__
+    db.session.execute(SnapshotUser.__table__.insert().from_select(
+        ['snapshot_id', 'id', 'email', 'name', 'created_at', 'updated_at'],
+        select([snapshot.id, users.c.id, users.c.email, users.c.name, users.c.created_at, users.c.updated_at])
+    ))
+    return snapshot
+
+
+def delete_snapshots(ids):
+    """
+    Deletes the snapshots with given ids and their users
+    """
+    if ids:
+        SnapshotUser.query.filter(SnapshotUser.snapshot_id.in_(ids)).delete(synchronize_session=False)
+        Snapshot.query.filter(Snapshot.id.in_(ids)).delete(synchronize_session=False)
+
+
+def prune_snapshots(keep):
+    """
+    Deletes all but the `keep` most recent snapshots
+    """
+    stale = Snapshot.query.with_entities(Snapshot.id).order_by(Snapshot.id.desc()).offset(keep)
+    delete_snapshots([row.id for row in stale])
+
+
+def clear_snapshots():
+    """
+    Deletes every snapshot
+    """
+    SnapshotUser.query.delete()
+    Snapshot.query.delete()
+    db.session.info.pop(OLDEST_WRITTEN, None)
+
+
+def discard_snapshots_since(created_at):
+    """
+    Makes the open transaction drop, when it commits, the snapshots taken
+    at or after created_at, a log written there is missing from them
+    and a rebuild starting from them would skip it
+    """
+    oldest = db.session.info.get(OLDEST_WRITTEN)
+    if oldest is None or created_at < oldest:
+        db.session.info[OLDEST_WRITTEN] = created_at
+
+
+@event.listens_for(SignallingSession, 'before_commit')
+def discard_stale_snapshots(session):
+    """
+    Drops the snapshots that miss logs written by the committing transaction
+    """
+    oldest = session.info.pop(OLDEST_WRITTEN, None)
+    if oldest is None:
+        return
+    stale = session.query(Snapshot.id).filter(Snapshot.log_created_at >= oldest)
+    delete_snapshots([row.id for row in stale])
+
+
+@event.listens_for(SignallingSession, 'after_rollback')
+def forget_oldest_written(session):
+    """
+    Nothing was written when the transaction is rolled back
+    """
+    session.info.pop(OLDEST_WRITTEN, None)
@@ -0,0 +1,53 @@
+from sqlalchemy import event
+
+# PRAGMA values set on every new SQLite connection, by profile name
+PROFILES = {
+    # SQLite defaults: rollback journal, synchronous=FULL
+    'default': {},
+    # readers never block the writer, commits fsync only at checkpoints
+    'performance': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'mmap_size': 268435456,
+        'cache_size': -65536,
+        'temp_store': 'MEMORY',
+        'busy_timeout': 5000,
+    },
+    # WAL concurrency but every commit is fsynced
+    'durable': {
+        'journal_mode': 'WAL',
+        'synchronous': 'FULL',
+        'cache_size': -65536,
+        'temp_store': 'MEMORY',
+        'busy_timeout': 5000,
+    },
+}
+
+
+def profile_pragmas(name, overrides=None):
+    """
+    Gives PRAGMA values of the named profile updated with `overrides`
+    """
+    if name not in PROFILES:
+        raise ValueError('Unknown SQLite profile {!r}, use one of: {}'.format(
+            name, ', '.join(sorted(PROFILES))))
+    pragmas = dict(PROFILES[name])
+    pragmas.update(overrides or {})
+    return pragmas
+
+
+def apply_pragmas(engine, pragmas):
+    """
+    Sets `pragmas` on every connection the engine opens from now on
+    """
+    if engine.dialect.name != 'sqlite' or not pragmas:
+        return
+
+    statements = ['PRAGMA {}={}'.format(name, value) for name, value in pragmas.items()]
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for statement in statements:
+            cursor.execute(statement)
+        cursor.close()
@@ -0,0 +1,79 @@
+import zlib
+
+from flask import Response, json, stream_with_context
+
+# rows fetched from the database per round trip while streaming
+STREAM_BATCH_SIZE = 1000
+# gzip level of compressed streams, favours throughput over ratio
+GZIP_LEVEL = 6
+
+
+def stream_list(key, rows, encode):
+    """
+    Gives response streaming rows as {key: [encode(row), ...]}.
+
+    Rows are meant to come from a query with yield_per, every one is
+    serialized on its own, so memory stays flat and the first bytes go out
+    before the query is exhausted. The body matches what jsonify gives.
+    """
+    def generate():
+        yield '{{"{}":['.format(key)
+        separator = ''
+        for row in rows:
+            yield separator + encode(row)
+            separator = ','
+        yield ']}\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+
+def stream_lines(rows, encode, compress=False):
+    """
+    Gives response streaming rows as newline delimited JSON,
+    gzip compressed on the fly with `compress`.
+
+    Lines are sent STREAM_BATCH_SIZE at a time and nothing else is held,
+    so memory stays flat however many rows a yield_per query gives.
+    """
+    def generate():
+        batch = []
+        for row in rows:
+            batch.append(encode(row))
+            if len(batch) >= STREAM_BATCH_SIZE:
+                yield '\n'.join(batch) + '\n'
+                batch = []
+        if batch:
+            yield '\n'.join(batch) + '\n'
+
+    body = gzip_chunks(generate()) if compress else generate()
+    response = Response(stream_with_context(body), mimetype='application/x-ndjson')
+    if compress:
+        response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def gzip_chunks(chunks):
+    """
+    Yields gzip stream of text chunks as they come
+    """
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode())
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def encode_to_dict(row):
+    """
+    Gives compact JSON of an ORM row's to_dict
+    """
+    return json.dumps(row.to_dict(), separators=(',', ':'))
+
+
+def is_streamed(args):
+    """
+    Tells if the request asks for a streamed response
+    """
+    return args.get('stream', '').lower() in ('1', 'true')
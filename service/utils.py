@@ -1,30 +1,76 @@
+import re
 from datetime import datetime
 
-from flask import jsonify
+from flask import current_app, jsonify
 from werkzeug.http import HTTP_STATUS_CODES
 
 from service import db
+from service.conditional import mark_data_changed
 from service.models import ActivityLog
+from service.rollups import count_activity
+from service.snapshots import discard_snapshots_since
+
+# SQLite refuses statements with more than 999 bound parameters
+IN_CLAUSE_CHUNK_SIZE = 500
 
 
 def add_activity_log(action, user_id, attributes):
     """
     Logs the Activity,
-    Get called when User's create/update/delete operation happens
+    Get called when User's create/update/delete operation happens,
+    the log is committed along with the user change by unit_of_work
     """
     log = ActivityLog()
     log.action = action
     log.user_id = user_id
     log.attributes = attributes
+    # set up front so the rollups count the log in its bucket
+    log.created_at = log.updated_at = datetime.utcnow()
     db.session.add(log)
-    db.session.commit()
+    count_activity([(action, user_id, log.created_at)])
+    discard_snapshots_since(log.created_at)
+    mark_data_changed()
     return log
 
 
+def unit_of_work(work, *args):
+    """
+    Runs work(*args) and commits everything it changed in one transaction,
+    nothing is kept when it raises. Gives what work returns.
+    With GROUP_COMMIT the work runs on the group commit writer thread
+    """
+    writer = current_app.extensions.get('group_commit')
+    if writer is not None:
+        return writer.submit(work, *args).result()
+    try:
+        result = work(*args)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return result
+
+
+def chunked(items, size=IN_CLAUSE_CHUNK_SIZE):
+    """
+    Yields successive lists of at most `size` items
+    """
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+TIMESTAMP_RE = re.compile(r"([0-9]{4})-([0-9]{2})-([0-9]{2})T([0-9]{2}):([0-9]{2}):([0-9]{2})\.([0-9]{6})Z\Z")
+
+
 def to_datetime(strng):
     """
-    retrun datetime instance from string
+    retrun datetime instance from string,
+    timestamps in the exact format we write skip the slow strptime
     """
+    match = TIMESTAMP_RE.match(strng) if isinstance(strng, str) else None
+    if match:
+        return datetime(*map(int, match.groups()))
     return datetime.strptime(strng, "%Y-%m-%dT%H:%M:%S.%fZ")
 
 
@@ -56,6 +102,13 @@ user_schema = {
              'required': True}
 }
 
+user_update_schema = {
+    "email": {'type': 'string',
+              'regex': "^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\\.[a-zA-Z0-9-.]+$"},
+    "name": {'type': 'string',
+             "minlength": 2}
+}
+
 log_schema = {
     "id": {'type': 'string',
            'regex': "^[a-f0-9]{8}-[a-f0-9]{4}-[1345][a-f0-9]{3}-[a-f0-9]{4}-[a-f0-9]{12}$",
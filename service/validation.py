@@ -0,0 +1,111 @@
+import re
+import threading
+from collections.abc import Mapping
+from datetime import datetime
+
+from service.utils import user_schema, user_update_schema, log_schema
+
+TYPES = {
+    'string': str,
+    'dict': Mapping,
+    'datetime': datetime,
+}
+
+
+class CompiledValidator(object):
+    """
+    Validates documents against a Cerberus schema compiled once into plain
+    Python checks.
+
+    Documents passing the compiled checks are valid without involving
+    Cerberus. Anything else is handed to a Cerberus Validator kept per
+    thread, so rejected documents get exactly the errors Cerberus gives.
+    """
+
+    def __init__(self, schema):
+        self.schema = schema
+        self.check = compile_schema(schema)
+        self.local = threading.local()
+
+    def errors(self, document):
+        """
+        Gives Cerberus errors of the document, empty dict when it is valid
+        """
+        if isinstance(document, dict) and self.check(document):
+            return {}
+        v = getattr(self.local, 'validator', None)
+        if v is None:
+            # Cerberus takes longer to import than the rest of the request
+            # path, it is only needed once a document is rejected
+            from cerberus import Validator
+            v = self.local.validator = Validator(self.schema)
+        if v.validate(document):
+            return {}
+        return v.errors
+
+
+def compile_schema(schema):
+    """
+    Gives function telling if a mapping satisfies every rule of the schema,
+    unknown fields are not allowed like in Cerberus by default
+    """
+    checks = {field: compile_rules(rules) for field, rules in schema.items()}
+    required = frozenset(field for field, rules in schema.items() if rules.get('required'))
+    known = frozenset(schema)
+
+    def check(document):
+        if not required.issubset(document) or not known.issuperset(document):
+            return False
+        for field, value in document.items():
+            if not checks[field](value):
+                return False
+        return True
+
+    return check
+
+
+def compile_rules(rules):
+    """
+    Gives function telling if a value satisfies the rules of one field,
+    raises ValueError for rules it does not know how to compile
+    """
+    unknown = set(rules) - {'type', 'required', 'regex', 'minlength', 'allowed', 'coerce', 'schema'}
+    if unknown:
+        raise ValueError('Can not compile rules: {}'.format(', '.join(sorted(unknown))))
+
+    kind = TYPES[rules['type']]
+    coerce = rules.get('coerce')
+    minlength = rules.get('minlength')
+    allowed = frozenset(rules['allowed']) if 'allowed' in rules else None
+    pattern = rules.get('regex')
+    if pattern is not None:
+        # same anchoring as Cerberus applies to its regex rule
+        if not pattern.endswith('$'):
+            pattern += '$'
+        pattern = re.compile(pattern)
+    subschema = compile_schema(rules['schema']) if 'schema' in rules else None
+
+    def check(value):
+        if coerce is not None:
+            try:
+                value = coerce(value)
+            except Exception:
+                return False
+        if not isinstance(value, kind):
+            return False
+        if minlength is not None and len(value) < minlength:
+            return False
+        if allowed is not None and value not in allowed:
+            return False
+        if pattern is not None and not pattern.match(value):
+            return False
+        if subschema is not None and not subschema(value):
+            return False
+        return True
+
+    return check
+
+
+user_validator = CompiledValidator(user_schema)
+user_update_validator = CompiledValidator(user_update_schema)
+log_validator = CompiledValidator(log_schema)
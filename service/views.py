@@ -1,13 +1,35 @@
+import gzip
+import heapq
 import logging
+from itertools import islice
+from operator import itemgetter
 
-from cerberus import Validator
 from flask import Blueprint
-from flask import jsonify, request
+from flask import current_app, json, jsonify, request
+from sqlalchemy import tuple_
 
 from service import db
-
-from service.models import User, ActivityLog
-from service.utils import add_activity_log, user_schema, log_schema, to_datetime, error_response
+from service.archive import archived_lines, clear_archive, remove_segment_files, segments
+from service.cache import track_all_users, track_user_changes
+from service.conditional import conditional, mark_data_changed
+
+from service.filters import FilterError, granularity, listed_actions, log_criteria, log_filters, timestamp
+from service.history import user_as_of, users_as_of
+from service.models import User, ActivityLog, ArchivedLog, keyset
+from service.pagination import (
+    PaginationError, decode_cursor, encode_cursor, is_descending, is_paginated, paginate,
+    parse_limit, sort_key
+)
+from service.parallel import apply_logs_parallel, validate_logs
+from service.replay import ReplayError, apply_logs, apply_log_stream
+from service.rollups import ALL_USERS, bucket_counts, clear_rollups
+from service.serialization import (
+    api_timestamp, encode_log, encode_user, lean_json_enabled, lean_logs, lean_users, list_body
+)
+from service.snapshots import clear_snapshots
+from service.streaming import STREAM_BATCH_SIZE, encode_to_dict, is_streamed, stream_lines, stream_list
+from service.utils import add_activity_log, error_response, to_datetime, unit_of_work
+from service.validation import log_validator, user_update_validator, user_validator
 
 logger = logging.getLogger(__name__)
 views_bp = Blueprint("views", __name__)
@@ -16,6 +38,153 @@ views_bp = Blueprint("views", __name__)
 # todo: set headers content-type
 
 
+# lean query of raw columns and its row encoder, by model
+LEAN_SERIALIZERS = {
+    User: (lean_users, encode_user),
+    ActivityLog: (lean_logs, encode_log),
+}
+
+
+def list_page(query, model):
+    """
+    Gives requested page of `query` and the cursor of the next one
+    """
+    return paginate(
+        query, model, request.args,
+        current_app.config['PAGE_MAX_LIMIT'],
+        current_app.config['LIST_MAX_ROWS']
+    )
+
+
+def list_response(key, model, *criteria):
+    """
+    Gives the requested page of `model` rows matching criteria as {key: [...]},
+    serialized straight from raw columns when the JSON settings allow it
+    """
+    lean = lean_json_enabled()
+    query = LEAN_SERIALIZERS[model][0]() if lean else model.query
+    try:
+        rows, next_cursor = list_page(query.filter(*criteria), model)
+    except PaginationError as e:
+        return error_response(400, str(e))
+
+    members = {'next': next_cursor} if is_paginated(request.args) else {}
+    if lean:
+        body = list_body(key, map(LEAN_SERIALIZERS[model][1], rows), **members)
+        return current_app.response_class(body, mimetype=current_app.config['JSONIFY_MIMETYPE'])
+    members[key] = [row.to_dict() for row in rows]
+    return jsonify(members)
+
+
+def stream_response(key, model, *criteria):
+    """
+    Gives streamed response of all `model` rows matching criteria as {key: [...]}
+    """
+    if lean_json_enabled(compact=False):
+        query, encode = LEAN_SERIALIZERS[model][0](), LEAN_SERIALIZERS[model][1]
+    else:
+        query, encode = model.query, encode_to_dict
+    try:
+        order = sort_key(model, request.args)
+    except PaginationError as e:
+        return error_response(400, str(e))
+    return stream_list(key, query.filter(*criteria).order_by(*order).yield_per(STREAM_BATCH_SIZE), encode)
+
+
+def export_start(args):
+    """
+    Gives (created_at, id) an export resumes after, None to start over
+    """
+    if 'after_id' in args:
+        log = db.session.query(ActivityLog.created_at, ActivityLog.id).filter(
+            ActivityLog.id == args['after_id']).first()
+        if log is None:
+            log = db.session.query(ArchivedLog.created_at, ArchivedLog.id).filter(
+                ArchivedLog.id == args['after_id']).first()
+        if log is None:
+            raise PaginationError('ActivityLog with ID: {} does not exist'.format(args['after_id']))
+        return tuple(log)
+    if 'after' in args:
+        return decode_cursor(args['after'])
+    return None
+
+
+def log_list_response(user_id=None):
+    """
+    Gives activity logs matching the filters of the query string,
+    only the ones of `user_id` when given,
+    streamed with `stream=true` otherwise paginated
+    """
+    try:
+        filters = log_filters(request.args)
+    except FilterError as e:
+        return error_response(400, str(e))
+    if user_id is not None:
+        filters = filters._replace(user_ids=[user_id])
+    if segments(current_app.config['ARCHIVE_DIR']):
+        return merged_log_response(filters)
+    if is_streamed(request.args):
+        return stream_response('logs', ActivityLog, *log_criteria(filters))
+    return list_response('logs', ActivityLog, *log_criteria(filters))
+
+
+def merged_log_response(filters):
+    """
+    Gives activity logs of the database merged in order with the archived
+    ones, paginated or streamed the same way as log_list_response
+    """
+    args = request.args
+    streamed = is_streamed(args)
+    max_limit = current_app.config['PAGE_MAX_LIMIT']
+    try:
+        descending = is_descending(args)
+        after = decode_cursor(args['after']) if 'after' in args and not streamed else None
+        limit = parse_limit(args.get('limit', max_limit), max_limit) if is_paginated(args) else None
+    except PaginationError as e:
+        return error_response(400, str(e))
+    if limit is None and not streamed:
+        limit = current_app.config['LIST_MAX_ROWS']
+
+    lean = lean_json_enabled(compact=not streamed)
+    query = lean_logs() if lean else ActivityLog.query
+    query = query.filter(*log_criteria(filters)).order_by(*sort_key(ActivityLog, args))
+    if after is not None:
+        position = tuple_(ActivityLog.created_at, ActivityLog.id)
+        query = query.filter(position < keyset(ActivityLog, *after) if descending else position > keyset(ActivityLog, *after))
+
+    # every log as (sort key, what the response holds of it)
+    if lean:
+        present_row, present_line = encode_log, bytes.decode
+    elif streamed:
+        present_row, present_line = encode_to_dict, lambda line: json.dumps(json.loads(line), separators=(',', ':'))
+    else:
+        present_row, present_line = ActivityLog.to_dict, json.loads
+    rows = query.yield_per(STREAM_BATCH_SIZE) if streamed else query.limit(limit + 1)
+    hot = (((api_timestamp(row.created_at), row.id), present_row(row)) for row in rows)
+    archived = (
+        (key, present_line(line)) for key, action, user_id, line in archived_lines(
+            current_app.config['ARCHIVE_DIR'], filters,
+            after and (api_timestamp(after[0]), after[1]), descending)
+    )
+    logs = heapq.merge(hot, archived, key=itemgetter(0), reverse=descending)
+
+    if streamed:
+        return stream_list('logs', logs, itemgetter(1))
+    logs = list(islice(logs, limit + 1))
+    members = {}
+    if is_paginated(args):
+        members['next'] = None
+        if len(logs) > limit:
+            created_at, id = logs[limit - 1][0]
+            members['next'] = encode_cursor(to_datetime(created_at), id)
+    logs = [log for key, log in logs[:limit]]
+    if lean:
+        body = list_body('logs', logs, **members)
+        return current_app.response_class(body, mimetype=current_app.config['JSONIFY_MIMETYPE'])
+    members['logs'] = logs
+    return jsonify(members)
+
+
 @views_bp.route("/health")
 def health():
     # check if connection to SQL is fine
@@ -25,7 +194,32 @@ def health():
     })
 
 
+@views_bp.route("/cache/stats")
+def cache_stats():
+    """
+    Gives hit, miss and eviction counters of the GET /users/<user_id> cache
+    and of the cached list responses
+    """
+    return jsonify({
+        'users': current_app.extensions['user_cache'].stats(),
+        'responses': current_app.extensions['response_cache'].stats(),
+    })
+
+
+@views_bp.route("/metrics")
+def metrics():
+    """
+    Gives per route request latency, SQL and payload size metrics
+    in Prometheus text format
+    """
+    collected = current_app.extensions.get('metrics')
+    if collected is None:
+        return error_response(404, 'Metrics are disabled')
+    return current_app.response_class(collected.render(), mimetype='text/plain; version=0.0.4')
+
+
 @views_bp.route("/users", methods=["GET"])
+@conditional
 def get_users():
     """
     Gives list of all users
@@ -40,12 +234,50 @@ def get_users():
             }
           ]
         }
+
+    Pass `limit` and/or `after` for a page ordered by creation,
+    the response then carries the cursor of the next page in `next`
+    which is null on the last page
+
+    Pass an `as_of` timestamp for the users as they were once every log
+    created up to it was applied, rebuilt from the closest snapshot
     """
-    users = User.query
-    data = {
-        'users': [user.to_dict() for user in users]
-    }
-    return jsonify(data)
+    if 'as_of' in request.args:
+        return history_response()
+    return list_response('users', User)
+
+
+def history_response():
+    """
+    Gives the requested page of the users as of the `as_of` query parameter
+    """
+    args = request.args
+    max_limit = current_app.config['PAGE_MAX_LIMIT']
+    try:
+        as_of = timestamp(args, 'as_of')
+        descending = is_descending(args)
+        after = decode_cursor(args['after']) if 'after' in args else None
+        limit = parse_limit(args.get('limit', max_limit), max_limit) if is_paginated(args) else None
+    except (FilterError, PaginationError) as e:
+        return error_response(400, str(e))
+    if limit is None:
+        limit = current_app.config['LIST_MAX_ROWS']
+
+    users = users_as_of(as_of, current_app.config['ARCHIVE_DIR'])
+    if descending:
+        users.reverse()
+    if after is not None:
+        after = (api_timestamp(after[0]), after[1])
+        key = itemgetter('created_at', 'id')
+        users = [data for data in users if (key(data) < after if descending else key(data) > after)]
+    members = {}
+    if is_paginated(args):
+        members['next'] = None
+        if len(users) > limit:
+            last = users[limit - 1]
+            members['next'] = encode_cursor(to_datetime(last['created_at']), last['id'])
+    members['users'] = users[:limit]
+    return jsonify(members)
 
 
 @views_bp.route("/users", methods=["POST"])
@@ -59,22 +291,12 @@ def new_user():
     """
     data = request.get_json() or {}
     # validate is all required fields are present or not
-    v = Validator(user_schema)
-    if not v.validate(data):
-        return error_response(400, v.errors)
+    errors = user_validator.errors(data)
+    if errors:
+        return error_response(400, errors)
 
-    # create user instance
-    user = User()
-    user.name = data['name']
-    user.email = data['email']
-
-    # save it to db
-    db.session.add(user)
-    db.session.commit()
-
-    data = user.to_dict()
-    # Add activity_log for user creation
-    add_activity_log('create', user.id, data)
+    # user and its activity_log are committed together
+    data = unit_of_work(create_user, data)
 
     response = jsonify(data)
     response.status_code = 201
@@ -92,13 +314,30 @@ def get_user(user_id):
               "name": str,
               "updated_at": datetime
             }
-    """
 
-    user = User.query.get(user_id)
-    if not user:
+    With an `as_of` timestamp, gives the user as it was once every log
+    created up to it was applied
+    """
+    if 'as_of' in request.args:
+        try:
+            as_of = timestamp(request.args, 'as_of')
+        except FilterError as e:
+            return error_response(400, str(e))
+        data = user_as_of(user_id, as_of, current_app.config['ARCHIVE_DIR'])
+    else:
+        data = current_app.extensions['user_cache'].get_or_load(user_id, lambda: load_user(user_id))
+    if data is None:
         return error_response(404, 'Given id does not exist')
 
-    return jsonify(user.to_dict())
+    return jsonify(data)
+
+
+def load_user(user_id):
+    """
+    Gives data of user from the database, None when it does not exist
+    """
+    user = User.query.get(user_id)
+    return user.to_dict() if user else None
 
 
 @views_bp.route("/users/<user_id>", methods=["PATCH"])
@@ -110,75 +349,181 @@ def update_user(user_id):
           "name": new_str
         }
     """
-    schema = {
-        "email": {'type': 'string',
-                  'regex': "^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\\.[a-zA-Z0-9-.]+$"},
-        "name": {'type': 'string',
-                 "minlength": 2}
-    }
     data = request.get_json() or {}
 
-    v = Validator(schema)
-    if not v.validate(data):
-        return error_response(400, v.errors)
+    errors = user_update_validator.errors(data)
+    if errors:
+        return error_response(400, errors)
 
-    user = User.query.get(user_id)
-    if not user:
+    data = unit_of_work(change_user, user_id, data)
+    if data is None:
+        return error_response(404, 'Given id does not exist')
+    return jsonify(data)
+
+
+@views_bp.route("/users/<user_id>", methods=["DELETE"])
+def delete_user(user_id):
+    """
+    Delete user details of provided user_id
+    """
+    data = unit_of_work(remove_user, user_id)
+    if data is None:
         return error_response(404, 'Given id does not exist')
+    response = jsonify()
+    response.status_code = 204
+    return response
+
+
+def create_user(data):
+    """
+    Adds new user with its create activity_log, gives the user's data
+    """
+    user = User()
+    user.name = data['name']
+    user.email = data['email']
+    db.session.add(user)
+    # flush to get the generated id and timestamps
+    db.session.flush()
+
+    data = user.to_dict()
+    add_activity_log('create', user.id, data)
+    return data
 
 
+def change_user(user_id, data):
+    """
+    Applies changes to user with its update activity_log,
+    gives the updated user's data or None when user does not exist
+    """
+    user = User.query.get(user_id)
+    if not user:
+        return None
+
     if data.get('name'):
         user.name = data['name']
     if data.get('email'):
         user.email = data['email']
-    db.session.commit()
-    data = user.to_dict()
+    track_user_changes([user.id])
 
-    # Add activity_log for user update
+    data = user.to_dict()
     add_activity_log('update', user.id, data)
-    return jsonify(data)
+    return data
 
 
-@views_bp.route("/users/<user_id>", methods=["DELETE"])
-def delete_user(user_id):
+def remove_user(user_id):
     """
-    Delete user details of provided user_id
+    Deletes user with its delete activity_log,
+    gives the deleted user's data or None when user does not exist
     """
     user = User.query.get(user_id)
     if not user:
-        return error_response(404, 'Given id does not exist')
-    db.session.delete(user)
-    db.session.commit()
+        return None
 
-    # Add activity_log for user delete
-    add_activity_log('delete', user_id, user.to_dict())
-    response = jsonify()
-    response.status_code = 204
-    return response
+    data = user.to_dict()
+    db.session.delete(user)
+    track_user_changes([user_id])
+    add_activity_log('delete', user_id, data)
+    return data
 
 
 @views_bp.route("/logs", methods=["GET"])
+@conditional
 def get_logs():
     """
-    Gives all activity logs
+    Gives all activity logs,
+    paginated with `limit` and `after` the same way as GET /users
+    or streamed whole with `stream=true`
+
+    Filtered with `action` and `user_id` (repeated or comma separated),
+    `since` and `until` timestamps bounding created_at, and ordered
+    newest first with `order=desc`
     """
-    logs = ActivityLog.query
+    return log_list_response()
+
+
+@views_bp.route("/logs/stats", methods=["GET"])
+@conditional
+def get_log_stats():
+    """
+    Gives number of activity logs per time bucket, read from the rollups
+    return: {
+          "granularity": "minute" | "hour" | "day",
+          "buckets": [
+            {
+              "bucket": datetime,
+              "counts": {action: int},
+              "total": int
+            }
+          ],
+          "total": int
+        }
+
+    Counts logs of one user with `user_id`, narrowed with `action`
+    (repeated or comma separated) and `since` and `until` timestamps
+    """
+    try:
+        unit = granularity(request.args)
+        buckets = bucket_counts(
+            unit, request.args.get('user_id', ALL_USERS), listed_actions(request.args),
+            timestamp(request.args, 'since'), timestamp(request.args, 'until'),
+            current_app.config['LIST_MAX_ROWS']
+        )
+    except FilterError as e:
+        return error_response(400, str(e))
+
     data = {
-        'logs': [log.to_dict() for log in logs]
+        'granularity': unit,
+        'buckets': [
+            {'bucket': api_timestamp(bucket), 'counts': counts, 'total': sum(counts.values())}
+            for bucket, counts in buckets
+        ],
     }
+    data['total'] = sum(bucket['total'] for bucket in data['buckets'])
     return jsonify(data)
 
 
+@views_bp.route("/logs/export", methods=["GET"])
+def export_logs():
+    """
+    Streams activity logs in (created_at, id) order as newline delimited
+    JSON, one log per line in the format POST /logs/replay takes
+    with Content-Type application/x-ndjson
+
+    Gzip compressed when Accept-Encoding allows it. Resumes after the log
+    with id `after_id`, or after an `after` cursor, and takes the same
+    filters as GET /logs
+    """
+    try:
+        filters = log_filters(request.args)
+        start = export_start(request.args)
+    except (FilterError, PaginationError) as e:
+        return error_response(400, str(e))
+
+    logs = lean_logs().filter(*log_criteria(filters))
+    if start is not None:
+        logs = logs.filter(tuple_(ActivityLog.created_at, ActivityLog.id) > keyset(ActivityLog, *start))
+    logs = logs.order_by(ActivityLog.created_at, ActivityLog.id).yield_per(STREAM_BATCH_SIZE)
+    compress = 'gzip' in request.accept_encodings
+
+    directory = current_app.config['ARCHIVE_DIR']
+    if not segments(directory):
+        return stream_lines(logs, encode_log, compress)
+    hot = (((api_timestamp(row.created_at), row.id), encode_log(row)) for row in logs)
+    archived = (
+        (key, line.decode()) for key, action, user_id, line in archived_lines(
+            directory, filters, start and (api_timestamp(start[0]), start[1]))
+    )
+    return stream_lines(heapq.merge(hot, archived, key=itemgetter(0)), itemgetter(1), compress)
+
+
 @views_bp.route("/logs/user/<user_id>", methods=["GET"])
+@conditional
 def get_logs_by_user(user_id):
     """
-    Gives all activity logs of particular user
+    Gives all activity logs of particular user,
+    paginated, filtered or streamed the same way as GET /logs
     """
-    logs = ActivityLog.query.filter_by(user_id=user_id)
-    data = {
-        'logs': [log.to_dict() for log in logs]
-    }
-    return jsonify(data)
+    return log_list_response(user_id)
 
 
 @views_bp.route("/logs/replay", methods=["POST"])
@@ -191,7 +536,28 @@ def replay_logs():
         {...ActivityLog data...}
       ]
     }
+
+    With REPLAY_WORKERS above 1, lists of at least PARALLEL_REPLAY_MIN_LOGS
+    logs are validated and applied by that many processes, with the same
+    outcome and errors.
+
+    With Content-Type application/x-ndjson the body holds one log per line,
+    it is applied in chunks of REPLAY_CHUNK_SIZE logs and committed as it
+    goes, answers with the number of applied logs: {"applied": int}.
+    Such a body may be gzip compressed, like GET /logs/export gives it
     """
+    if request.mimetype == 'application/x-ndjson':
+        lines = request.stream
+        if request.content_encoding == 'gzip':
+            lines = gzip.GzipFile(fileobj=request.stream)
+        try:
+            applied = apply_log_stream(lines, current_app.config['REPLAY_CHUNK_SIZE'])
+        except ReplayError as e:
+            return error_response(e.status_code, e.message)
+        except (OSError, EOFError):
+            # chunks committed before the corrupt part are kept
+            return error_response(400, 'Invalid gzip body')
+        return jsonify({'applied': applied})
 
     data = request.get_json() or {}
     if 'logs' not in data:
@@ -201,74 +567,39 @@ def replay_logs():
     if logs == []:
         User.query.delete()
         ActivityLog.query.delete()
+        clear_rollups()
+        clear_snapshots()
+        archived = clear_archive()
+        track_all_users()
+        mark_data_changed()
 
         db.session.commit()
+        remove_segment_files(current_app.config['ARCHIVE_DIR'], archived)
     else:
+        workers = current_app.config['REPLAY_WORKERS']
+        parallel = (
+            workers > 1 and isinstance(logs, list)
+            and len(logs) >= current_app.config['PARALLEL_REPLAY_MIN_LOGS']
+        )
         # validate if data sent is in right format
-        v = Validator(log_schema)
-        invalid_logs = [v.errors for log in logs if not v.validate(log)]
+        if parallel:
+            invalid_logs = validate_logs(logs, workers)
+        else:
+            invalid_logs = [errors for errors in map(log_validator.errors, logs) if errors]
         if invalid_logs:
             # if any data is invalid then throw 400
             return error_response(400, invalid_logs)
 
-        for log in logs:
-
-            user_data = log['attributes']
-
-            user = User.query.get(user_data['id'])
-
-            # create user
-            if log['action'] == 'create':
-                if user:
-                    return error_response(400, 'User with ID: {} already exist'.format(user_data['id']))
-                user = User()
-                user.id = user_data['id']
-                user = get_user_instance(user, user_data)
-                db.session.add(user)
-            # update user
-            elif log['action'] == 'update':
-                if not user:
-                    return error_response(404, 'User with ID: {} does not exist'.format(user_data['id']))
-                user = get_user_instance(user, user_data)
-            elif log['action'] == 'delete':
-                if not user:
-                    return error_response(404, 'User with ID: {} does not exist'.format(user_data['id']))
-                db.session.delete(user)
-
-            al = ActivityLog.query.get(log['id'])
-            if al:
-                return error_response(400, 'ActivityLog with ID: {} already exist'.format(user_data['id']))
+        try:
+            if parallel:
+                apply_logs_parallel(logs, workers)
             else:
-                # create activity log
-                al = ActivityLog()
-                db.session.add(activity_log_instance(al, log))
-
+                apply_logs(logs)
+        except ReplayError as e:
+            return error_response(e.status_code, e.message)
         db.session.commit()
 
     response = jsonify()
     response.status_code = 204
     return response
 
-
-def get_user_instance(user, user_data):
-    """
-    Gives User instance with mapped user_data
-    """
-    user.email = user_data['email']
-    user.name = user_data['name']
-    user.created_at = to_datetime(user_data['created_at'])
-    user.updated_at = to_datetime(user_data['updated_at'])
-    return user
-
-
-def activity_log_instance(al, log_data):
-    """
-    Gives ActivityLog instance with mapped log_data
-    """
-    al.created_at = to_datetime(log_data['created_at'])
-    al.updated_at = to_datetime(log_data['updated_at'])
-    al.attributes = log_data['attributes']
-    al.user_id = log_data['user_id']
-    al.action = log_data['action']
-    al.id = log_data['id']
-    return al
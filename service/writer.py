@@ -0,0 +1,98 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from service import db
+
+logger = logging.getLogger(__name__)
+
+# put on the queue to make the writer thread finish
+STOP = object()
+
+
+class GroupCommitWriter(object):
+    """
+    Runs write transactions of concurrent requests on a dedicated thread.
+
+    Work submitted within `window` seconds of each other, up to `max_batch`
+    of them, is applied in one transaction and committed at once, so the
+    requests share a single fsync and never compete for the SQLite lock.
+    When a work raises, the batch is rolled back and its works are retried
+    one transaction each, so one failing request does not fail the others.
+    """
+
+    def __init__(self, app, window, max_batch):
+        self.app = app
+        self.window = window
+        self.max_batch = max_batch
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name='group-commit-writer', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        """
+        Commits everything submitted so far and waits for the thread to end
+        """
+        if self.thread.is_alive():
+            self.queue.put(STOP)
+            self.thread.join()
+
+    def submit(self, work, *args):
+        """
+        Queues work(*args), gives Future resolved once its batch is committed
+        """
+        future = Future()
+        self.queue.put((future, work, args))
+        return future
+
+    def run(self):
+        with self.app.app_context():
+            stopping = False
+            while not stopping:
+                batch = [self.queue.get()]
+                if batch[0] is STOP:
+                    break
+                deadline = time.monotonic() + self.window
+                while len(batch) < self.max_batch:
+                    try:
+                        item = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+                    except queue.Empty:
+                        break
+                    if item is STOP:
+                        stopping = True
+                        break
+                    batch.append(item)
+                self.commit(batch)
+
+            # flush whatever was queued after stop was requested
+            pending = []
+            while not self.queue.empty():
+                item = self.queue.get()
+                if item is not STOP:
+                    pending.append(item)
+            if pending:
+                self.commit(pending)
+            db.session.remove()
+
+    def commit(self, batch):
+        results = []
+        try:
+            for future, work, args in batch:
+                results.append(work(*args))
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            if len(batch) == 1:
+                batch[0][0].set_exception(e)
+                return
+            logger.warning("Group commit of %s writes failed, retrying them one by one", len(batch))
+            for item in batch:
+                self.commit([item])
+            return
+
+        for (future, work, args), result in zip(batch, results):
+            future.set_result(result)
@@ -1,27 +1,95 @@
 -- TABLE
 CREATE TABLE ActivityLog
 (
-	id TEXT(36) not null
+	id BLOB not null
 		primary key,
 	action VARCHAR(255),
-	user_id VARCHAR(255)
+	user_id BLOB
 		references user,
 	attributes TEXT,
+	base_id BLOB,
 	created_at DATETIME,
 	updated_at DATETIME
 );
 CREATE TABLE user
 (
-	id TEXT(36) not null
+	id BLOB not null
 		primary key,
 	email VARCHAR(120),
 	name VARCHAR(255),
 	created_at DATETIME,
 	updated_at DATETIME
 );
- 
+ CREATE TABLE data_version
+(
+	id INTEGER not null
+		primary key,
+	version INTEGER not null
+);
+CREATE TABLE activity_rollup
+(
+	granularity VARCHAR(6) not null,
+	user_id VARCHAR(255) not null,
+	bucket DATETIME not null,
+	action VARCHAR(6) not null,
+	count INTEGER not null,
+	primary key (granularity, user_id, bucket, action)
+);
+CREATE TABLE snapshot
+(
+	id INTEGER not null
+		primary key,
+	log_created_at DATETIME,
+	log_id TEXT(36),
+	taken_at DATETIME
+);
+CREATE TABLE snapshot_user
+(
+	snapshot_id INTEGER not null
+		references snapshot,
+	id BLOB not null,
+	email VARCHAR(120),
+	name VARCHAR(255),
+	created_at DATETIME,
+	updated_at DATETIME,
+	primary key (snapshot_id, id)
+);
+CREATE TABLE archive_segment
+(
+	id INTEGER not null
+		primary key,
+	name VARCHAR(32) not null
+		unique,
+	count INTEGER not null,
+	first_created_at DATETIME not null,
+	first_log_id TEXT(36) not null,
+	last_created_at DATETIME not null,
+	last_log_id TEXT(36) not null,
+	archived_at DATETIME
+);
+CREATE TABLE archived_log
+(
+	id BLOB not null
+		primary key,
+	segment_id INTEGER not null
+		references archive_segment,
+	created_at DATETIME not null
+);
+
 -- INDEX
 CREATE INDEX ix_user_email
 	on user (email);
+CREATE INDEX ix_user_created_at_id
+	on user (created_at, id);
+CREATE INDEX ix_ActivityLog_created_at_id
+	on ActivityLog (created_at, id);
+CREATE INDEX ix_ActivityLog_user_id_created_at
+	on ActivityLog (user_id, created_at, id);
+CREATE INDEX ix_ActivityLog_action_created_at
+	on ActivityLog (action, created_at, id);
+CREATE INDEX ix_ActivityLog_base_id
+	on ActivityLog (base_id) where base_id IS NOT NULL;
+CREATE INDEX ix_snapshot_log_created_at
+	on snapshot (log_created_at);
 
  
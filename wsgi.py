@@ -0,0 +1,5 @@
+from service.app import create_app
+
+# served by gunicorn -c gunicorn.conf.py wsgi:app,
+# the database has to be migrated with `flask db upgrade` first
+app = create_app(config={"LEAN_STARTUP": True})